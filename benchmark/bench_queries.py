@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Per-call latency of configuration lookups and wcprod_db hot-path functions
+
+    python bench_queries.py [NUM_CALLS] [MAX_ENTRIES_PER_TABLE]
+
+Compares a config_id lookup written with an interpolated f-string (re-parsed for every
+config_id) against the same lookup with a ?-parameterized statement, with the sqlite3
+default statement cache (128) and with wcprod.db.STATEMENT_CACHE_SIZE. Then reports the
+per-call latency of wcprod_db functions on the same database.
+"""
+import os, sys, time, tempfile, sqlite3
+import numpy as np
+from wcprod import wcprod_project, wcprod_db
+from wcprod.db import STATEMENT_CACHE_SIZE
+
+PROJECT='bench'
+
+def timeit(func,args):
+	t0 = time.perf_counter()
+	for a in args:
+		func(a)
+	return (time.perf_counter()-t0)/len(args)*1.e6
+
+def main():
+	num_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	max_entries_per_table = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+	p = wcprod_project(dict(project=PROJECT,rmin=0,rmax=800,zmin=0,zmax=800,
+		gap_space=50,gap_angle=30,num_photons=100000000))
+
+	with tempfile.TemporaryDirectory() as d:
+		dbname = os.path.join(d,'bench.db')
+		db = wcprod_db(dbname)
+		db.register_project(p,max_entries_per_table,bulk=True)
+		num_tables = db.table_count(PROJECT)
+		print(f'Configurations: {p.num_configs} ... tables: {num_tables}')
+
+		rng = np.random.default_rng(0)
+		config_ids = rng.integers(0,p.num_configs,num_calls).tolist()
+		table_ids = db.table_ids(PROJECT,config_ids).tolist()
+		lookups = list(zip(config_ids,table_ids))
+
+		results = []
+		for cache in [128,STATEMENT_CACHE_SIZE]:
+			conn = sqlite3.connect(dbname,cached_statements=cache)
+			def interpolated(arg):
+				cid, tid = arg
+				conn.execute(f"SELECT * FROM cfg_{PROJECT}{tid} WHERE config_id={cid}").fetchall()
+			def parameterized(arg):
+				cid, tid = arg
+				conn.execute(f"SELECT * FROM cfg_{PROJECT}{tid} WHERE config_id=?",(cid,)).fetchall()
+			results.append((f'lookup, f-string (cache {cache})',timeit(interpolated,lookups)))
+			results.append((f'lookup, parameterized (cache {cache})',timeit(parameterized,lookups)))
+			conn.close()
+
+		paths = [os.path.join(d,f'file_{i}') for i in range(min(num_calls,2000))]
+		for path in paths:
+			open(path,'w').close()
+		records = list(zip(config_ids,paths))
+		results.append(('wcprod_db.table_id',timeit(lambda cid: db.table_id(PROJECT,cid),config_ids)))
+		results.append(('wcprod_db.get_config',timeit(lambda cid: db.get_config(PROJECT,cid),config_ids)))
+		results.append(('wcprod_db.exist_file',timeit(lambda path: db.exist_file(PROJECT,path),paths)))
+		results.append(('wcprod_db.register_file',timeit(lambda r: db.register_file(PROJECT,r[0],r[1],1000,1.),records)))
+		results.append(('wcprod_db.claim_config',timeit(lambda i: db.claim_config(PROJECT,size=10),range(min(num_calls,200)))))
+
+	print()
+	print(f'{"call":40s} latency [us]')
+	for name, t in results:
+		print(f'{name:40s} {t:12.1f}')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Compare the registration time of a project with different write paths
+
+    python bench_register_project.py [GAP_SPACE] [GAP_ANGLE] [MAX_ENTRIES_PER_TABLE]
+
+Modes
+  legacy : the register_project code path before streaming, reproduced in this script: all
+           configurations materialized up front, each table created by DataFrame.to_sql, then
+           ALTER TABLE ADD Timestamp and a full-table UPDATE of the Timestamp (each table is
+           rewritten twice after the insert)
+  stream : wcprod_db.register_project
+  bulk   : wcprod_db.register_project(bulk=True)
+  compact: wcprod_db.register_project(bulk=True,compact=True)
+
+Each mode writes a fresh database file in a temporary directory.
+"""
+import os, sys, time, tempfile, datetime
+import numpy as np
+import pandas as pd
+from wcprod import wcprod_project, wcprod_db
+
+def make_project(gap_space,gap_angle):
+	cfg = dict(project='bench',rmin=0,rmax=3200,zmin=-3000,zmax=3000,
+		gap_space=gap_space,gap_angle=gap_angle,num_photons=100000000)
+	return wcprod_project(cfg)
+
+def legacy(dbname,p,max_entries_per_table):
+	db = wcprod_db(dbname)
+	project = p.project
+	coords = p.configs
+	num_tables = int(np.ceil(len(coords) / max_entries_per_table))
+	entries = [int(len(coords)/num_tables)]*num_tables
+	entries[-1] += (len(coords) - sum(entries))
+	shotgun = p.n_phi_start == 0
+	columns = ['x','y','z','theta','phi','pos_id','dir_id'] if shotgun else ['r0','r1','phi0','phi1','z0','z1','pos_id']
+	cur = db._conn.cursor()
+	cmd  = "INSERT INTO project (name, rmin, rmax, zmin, zmax, gap_space, gap_angle, n_phi_start, num_config, num_tables, num_photons)"
+	cmd += f" VALUES ('{project}', {p.rmin}, {p.rmax}, {p.zmin}, {p.zmax}, {p.gap_space}, {p.gap_angle}, {p.n_phi_start}, {len(coords)}, {num_tables}, {p.num_photons})"
+	cur.execute(cmd)
+	cur.execute(f"CREATE TABLE map_{project} (table_id INTEGER PRIMARY KEY, config_range_min INT, config_range_max INT, photon_ctr INT, target_ctr INT, lock int)")
+	cur.execute(f"CREATE TABLE geo_{project} (geo_type INT, geo_id INT, val0 FLOAT, val1 FLOAT, val2 FLOAT, val3 FLOAT, val4 FLOAT, val5 FLOAT)")
+	for geo_type,values in enumerate([p.positions,p.directions,p.voxels]):
+		df = pd.DataFrame({f'val{i}':values[:,i] for i in range(values.shape[1])})
+		df.insert(0,'geo_id',np.arange(len(values)))
+		df.insert(0,'geo_type',geo_type)
+		df.to_sql(f"geo_{project}",db._conn,if_exists='append',index=False)
+	for table_index in range(num_tables):
+		start = sum(entries[:table_index])
+		end   = sum(entries[:(table_index+1)])
+		df = pd.DataFrame(coords[start:end],columns=columns)
+		df.insert(0,'config_id',np.arange(start,end))
+		df['pos_id'] = df['pos_id'].astype(int)
+		df['dir_id'] = df['dir_id'].astype(int) if shotgun else 0
+		df['file_ctr'] = 0
+		df['photon_ctr'] = 0
+		df.to_sql(f"cfg_{project}{table_index}",db._conn,index=False)
+		cur.execute(f"ALTER TABLE cfg_{project}{table_index} ADD Timestamp DATETIME")
+		current_timestamp = datetime.datetime.now().isoformat(" ",timespec='seconds')
+		cur.execute(f"UPDATE cfg_{project}{table_index} SET Timestamp = '{current_timestamp}'")
+		cur.execute(f"CREATE TABLE file_{project}{table_index} (file_id INTEGER PRIMARY KEY AUTOINCREMENT, config_id INT, file_path STRING, photon_ctr INT, duration FLOAT, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+		cmd  = f"INSERT INTO map_{project} (table_id, config_range_min, config_range_max, photon_ctr, target_ctr, lock) "
+		cmd += f"VALUES ({table_index}, {start}, {end-1}, 0, {len(df)*(p.num_photons)}, 0)"
+		cur.execute(cmd)
+	db._conn.commit()
+	cur.close()
+	db.check_integrity(project)
+
+def stream(dbname,p,max_entries_per_table):
+	wcprod_db(dbname).register_project(p,max_entries_per_table)
+
+def bulk(dbname,p,max_entries_per_table):
+	wcprod_db(dbname).register_project(p,max_entries_per_table,bulk=True)
+
+def compact(dbname,p,max_entries_per_table):
+	wcprod_db(dbname).register_project(p,max_entries_per_table,bulk=True,compact=True)
+
+def main():
+	gap_space = float(sys.argv[1]) if len(sys.argv) > 1 else 100.
+	gap_angle = float(sys.argv[2]) if len(sys.argv) > 2 else 10.
+	max_entries_per_table = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+
+	p = make_project(gap_space,gap_angle)
+	print(f'Configurations: {p.num_configs} ... max entries per table: {max_entries_per_table}')
+
+	results = []
+	for name, func in [('legacy',legacy),('stream',stream),('bulk',bulk),('compact',compact)]:
+		with tempfile.TemporaryDirectory() as d:
+			dbname = os.path.join(d,'bench.db')
+			p = make_project(gap_space,gap_angle)
+			t0 = time.time()
+			func(dbname,p,max_entries_per_table)
+			results.append((name,time.time()-t0,os.path.getsize(dbname)))
+
+	print()
+	print('mode      time [s]   DB size [MB]')
+	for name,t,size in results:
+		print(f'{name:8s} {t:9.2f} {size/1.e6:14.1f}')
+
+if __name__ == '__main__':
+	main()
@@ -61,18 +61,28 @@ if [ ! -f setup_job.yaml ]; then
     " > setup_job.yaml
 fi
 
-# Execute N times
-for (( i=1;i<=%d;i++ ))
+# Claim N configurations at once and execute each listed in the manifest
+manifest=$(singularity exec %s %s bash -c "wcprod_setup_voxel.py setup_job.yaml %d") 2>&1
+i=0
+while read -u 3 storage_path
 do
 
+ i=$((i+1))
  echo
  echo "Starting: run counter $i"
- storage_path=$(singularity exec %s %s bash -c "wcprod_setup_voxel.py setup_job.yaml") 2>&1
  
  cd ${storage_path}
  chmod +x ./*
 
  echo `date` && echo `date` >> log.txt  2>&1
+ # Keep the claimed configuration leased while the job runs (heartbeat every N seconds)
+ lease_id=$(awk '/^LeaseID:/ {print $2}' wrapup_job.yaml)
+ heartbeat_pid=""
+ if [ -n "${lease_id}" ]; then
+   ( while true; do singularity exec %s %s wcprod %s heartbeat %s ${lease_id} > /dev/null 2>&1; sleep %d; done ) &
+   heartbeat_pid=$!
+ fi
+
  echo
  echo "Running Geant4"
  echo `date` && echo `date` >> log.txt  2>&1
@@ -87,6 +97,9 @@ do
  echo "Wrapping up"
  echo `date` && echo `date` >> log.txt  2>&1
  singularity exec %s %s bash -c "wcprod_wrapup_voxel.py wrapup_job.yaml" >> log.txt  2>&1
+ if [ -n "${heartbeat_pid}" ]; then
+   kill ${heartbeat_pid}
+ fi
  
  echo
  echo "Convert to h5"
@@ -97,7 +110,7 @@ do
  echo "Finished!" >> log.txt  2>&1
  echo `date` && echo `date` >> log.txt  2>&1
  echo
-done
+done 3< ${manifest}
 
 echo
 echo "Exiting" >> log.txt  2>&1
@@ -135,7 +148,7 @@ def parse_config(cfg):
         print(f"ERROR: a container missing '{cfg['CONTAINER']}'")
         sys.exit(1)
 
-    db=wcprod.wcprod_db(cfg['WCPROD_DB_FILE'])
+    db=wcprod.open_db(cfg['WCPROD_DB_FILE'])
     if not db.exist_project(cfg['WCPROD_PROJECT']):
         print(f"ERROR: project '{cfg['WCPROD_PROJECT']}' not found in the database {cfg['WCPROD_DB_FILE']}.")
         sys.exit(1)
@@ -214,9 +227,14 @@ def main():
         os.path.join(cfg['WCPROD_STORAGE_ROOT'],cfg['WCPROD_PROJECT']),
         cfg['WCSIM_HOME'],
         cfg['CLUSTER_NAME'],
+        cfg['BIND_PATH'],
+        cfg['CONTAINER'],
         cfg['WCPROD_NLOOPS'],
         cfg['BIND_PATH'],
         cfg['CONTAINER'],
+        cfg['WCPROD_DB_FILE'],
+        cfg['WCPROD_PROJECT'],
+        cfg.get('HEARTBEAT_INTERVAL',600),
         cfg['BIND_PATH'],                         
         cfg['CONTAINER'],
         cfg['BIND_PATH'],
@@ -2,10 +2,12 @@
 import sys,os
 import shutil
 import subprocess
-from wcprod import wcprod_project,wcprod_db
+from wcprod import wcprod_project
+from wcprod.server import open_db, is_address, DB_OPTION_KEYS
 import numpy as np
 import yaml
 import time
+import socket
 
 TEMPLATE_WCSIM_RUN='''#!/bin/bash
 cd %s
@@ -16,6 +18,7 @@ source /src/scripts/sourceme.sh
 python3 ${DATATOOLS}/convert.py ./convert.yaml
 '''
 WRAPUP_CONFIG_FILE_NAME='wrapup_job.yaml'
+MANIFEST_FILE_NAME='manifest_%s.txt'
 
 TEMPLATE_G4='''/run/verbose                           1
 /tracking/verbose                      0
@@ -106,6 +109,7 @@ ERROR_MISSING_KEYWORD=3
 ERROR_MISSING_DBFILE=4
 ERROR_PROJECT_NOT_FOUND=5
 ERROR_STORAGE_CREATION=6
+ERROR_NO_CONFIG=7
 
 def parse_config(cfg_file):
 
@@ -121,7 +125,7 @@ def parse_config(cfg_file):
 				print('ERROR: configuration lacking a keyword:',key)
 				sys.exit(ERROR_MISSING_KEYWORD)
 
-		if not os.path.isfile(cfg['DBFile']):
+		if not is_address(cfg['DBFile']) and not os.path.isfile(cfg['DBFile']):
 			print(f"ERROR: DBFile '{cfg['DBFile']}' does not exist.")
 			sys.exit(ERROR_MISSING_DBFILE)
 
@@ -130,11 +134,43 @@ def parse_config(cfg_file):
 def main():
 
 	# Step 0: parse job configurations
-	if not len(sys.argv)==2:
-		print(f'ERROR: needs exactly 2 arguments ({len(sys.argv)} given) ')
-		sys.exit(ERROR_INVALID_ARG_COUNT)
+	if not len(sys.argv) in [2,3]:
+		print(f'ERROR: needs 2 or 3 arguments ({len(sys.argv)} given) ')
+		sys.exit(ERROR_MISSING_ARG_COUNT)
 
 	cfg = parse_config(sys.argv[1])
+	nconfigs = int(sys.argv[2]) if len(sys.argv) == 3 else 0
+
+	project  = cfg['Project']
+	cluster  = cfg['Cluster']
+
+	db=open_db(cfg['DBFile'],**{DB_OPTION_KEYS[key]:val for key,val in cfg.items() if key in DB_OPTION_KEYS})
+	if not db.exist_project(project):
+		print(f"ERROR: project '{project}' not found in the database {cfg['DBFile']}.")
+		sys.exit(ERROR_PROJECT_NOT_FOUND)
+
+	# claim configurations among the tables assigned to the current cluster
+	job_id = os.environ.get('SLURM_JOB_ID', f'{socket.gethostname()}:{os.getpid()}')
+	# the configurations of a manifest run one after the other: the i-th lease lasts (i+1) x LeaseTTL
+	claims = db.claim_configs(project, max(nconfigs,1), cluster, job_id, float(cfg.get('LeaseTTL', 86400)), stagger=True)
+	if len(claims) < 1:
+		print(f"ERROR: no configuration left to be claimed for the cluster '{cluster}'.")
+		sys.exit(ERROR_NO_CONFIG)
+
+	if db.retry_stats():
+		sys.stderr.write(f'DB transaction retries: {db.retry_stats()}\n')
+
+	if nconfigs < 1:
+		return prepare_run(cfg, claims[0])
+
+	# batch mode: prepare all run directories up front and list them in a manifest
+	manifest = os.path.abspath(MANIFEST_FILE_NAME % job_id)
+	storage_paths = [prepare_run(cfg, claim) for claim in claims]
+	with open(manifest, 'w') as f:
+		f.write('\n'.join(storage_paths)+'\n')
+	return manifest
+
+def prepare_run(cfg, claim):
 
 	dbfile   = cfg['DBFile']
 	project  = cfg['Project']
@@ -152,27 +188,16 @@ def main():
 	#rebin_gap_angle = cfg['Rebin_gap_angle']
 	#rebin_n_bins_phi0 = cfg['Rebin_n_bins_phi0']
 	#num_shards = cfg['Num_shards']
-	cluster = cfg['Cluster']
-
-	db=wcprod_db(dbfile)
-	if not db.exist_project(project):
-		print(f"ERROR: project '{project}' not found in the database {dbfile}.")
-		sys.exit(ERROR_PROJECT_NOT_FOUND)
 
-	# lock all tables first and unlock the ones needed for the current cluster
-	db.lock_table(project)
-	table_ids = db.get_table_ids(project, cluster)
-	for tid in table_ids:
-		db.unlock_table(project, tid)
-	cfg = db.get_random_config(project, prioritize=True, size=1000)
-	file_ctr = cfg['file_ctr']
-	config_id = cfg['config_id']
-	r0 = cfg['r0']
-	r1 = cfg['r1']
-	z0 = cfg['z0']
-	z1 = cfg['z1']
-	phi0 = cfg['phi0']
-	phi1 = cfg['phi1']
+	lease_id = claim['lease_id']
+	file_ctr = claim['file_ctr']
+	config_id = claim['config_id']
+	r0 = claim['r0']
+	r1 = claim['r1']
+	z0 = claim['z0']
+	z1 = claim['z1']
+	phi0 = claim['phi0']
+	phi1 = claim['phi1']
 
 	# Step 1: prepare/verify the storage space
 	unit_K=100
@@ -199,13 +224,18 @@ def main():
 		f.write(contents)
 
 	# Step 3: store the configuration for the wrapup file
-	wrapup_cfg = dict(DBFile=dbfile,Project=project,ConfigID=config_id,
+	wrapup_cfg = dict(DBFile=dbfile,Project=project,ConfigID=config_id,LeaseID=lease_id,
 		StartTime=time.time(),
 		Destination=storage_path,Output=out_file,
 		NPhotons=nphotons,NSubEvents=nsubevents,NEvents=nevents,)
+	# forward the DB connection options
+	wrapup_cfg.update({key:val for key,val in cfg.items() if key in DB_OPTION_KEYS})
+	if 'Journal' in cfg:
+		wrapup_cfg['Journal'] = cfg['Journal']
 	wrapup_file = WRAPUP_CONFIG_FILE_NAME
 	#wrapup_record = '%s/wrapup_%s_%09d_%03d.yaml' % (storage_path, project,config_id,file_ctr)
-	with open(f'{storage_path}/{wrapup_file}', 'a') as f:
+	# overwrite the file of a previous run in this directory (log.txt keeps a copy)
+	with open(f'{storage_path}/{wrapup_file}', 'w') as f:
 	    yaml.dump(wrapup_cfg, f, default_flow_style=False)
 	#with open(wrapup_record, 'w') as f:
     #		yaml.dump(wrapup_cfg, f, default_flow_style=False)
@@ -84,7 +84,7 @@ def main():
 		sys.exit(ERROR_STORAGE_NOT_PRESENT)
 
 	# Step 4: log to the database
-	db.register_file(project,config_id,storage_file,nphotons*nevents_recorded,tstart-time.time())
+	db.register_file(project,config_id,storage_file,nphotons*nevents_recorded,time.time()-tstart)
 
 	sys.exit(0)
 
@@ -3,6 +3,9 @@ import sys,os
 import shutil
 import subprocess
 from wcprod import wcprod_project,wcprod_db
+from wcprod.server import open_db, is_address, DB_OPTION_KEYS
+from wcprod.journal import append_record
+import sqlite3
 import numpy as np
 import yaml
 import time
@@ -16,6 +19,9 @@ ERROR_PROJECT_NOT_FOUND=6
 ERROR_OUTPUT_NOT_PRESENT=7
 ERROR_STORAGE_ALREADY_PRESENT=8
 
+# errors of a database access that fall back to the journal (RuntimeError/ConnectionError: through a wcprod server)
+DB_ERRORS=(sqlite3.Error,OSError,RuntimeError,ConnectionError)
+
 def parse_config(cfg_file):
 
 	if not os.path.isfile(cfg_file):
@@ -30,7 +36,8 @@ def parse_config(cfg_file):
 				print('ERROR: configuration lacking a keyword:',key)
 				sys.exit(ERROR_MISSING_KEYWORD)
 
-		if not os.path.isfile(cfg['DBFile']):
+		# with a Journal, the registration is recorded offline if the DB cannot be reached
+		if not 'Journal' in cfg and not is_address(cfg['DBFile']) and not os.path.isfile(cfg['DBFile']):
 			print(f"ERROR: DBFile '{cfg['DBFile']}' does not exist.")
 			sys.exit(ERROR_MISSING_DBFILE)
 
@@ -59,8 +66,21 @@ def main():
 		print(f"ERROR: the number of events expected ({nevents_expected}) != recorded in file ({nevents_recorded})")
 		sys.exit(ERROR_MISSING_EVENT)
 
-	db=wcprod_db(dbfile)
-	if not db.exist_project(project):
+	journal  = cfg.get('Journal')
+	lease_id = cfg.get('LeaseID')
+
+	try:
+		if not is_address(dbfile) and not os.path.isfile(dbfile):
+			raise OSError(f"DBFile '{dbfile}' does not exist")
+		db=open_db(dbfile,**{DB_OPTION_KEYS[key]:val for key,val in cfg.items() if key in DB_OPTION_KEYS})
+		project_found = db.exist_project(project)
+	except DB_ERRORS as e:
+		if journal is None:
+			raise
+		print(f"WARNING: cannot open the database ({e}), recording to the journal {journal}")
+		db=None
+
+	if db is not None and not project_found:
 		print(f"ERROR: project '{project}' not found in the database {dbfile}.")
 		sys.exit(ERROR_PROJECT_NOT_FOUND)
 
@@ -83,8 +103,26 @@ def main():
 		print(f"ERROR: storage file {storage_file} does not exist.")
 		sys.exit(ERROR_STORAGE_NOT_PRESENT)
 
-	# Step 4: log to the database
-	db.register_file(project,config_id,storage_file,nphotons*nevents_recorded,tstart-time.time())
+	# Step 4: log to the database (or the journal if the database is not available)
+	record = (project,config_id,storage_file,nphotons*nevents_recorded,time.time()-tstart)
+	if db is not None:
+		try:
+			db.register_file(*record)
+		except DB_ERRORS as e:
+			if journal is None:
+				raise
+			print(f"WARNING: failed to register the file ({e}), recording to the journal {journal}")
+			db=None
+	if db is None:
+		append_record(journal,*record,lease_id=lease_id)
+		sys.exit(0)
+
+	# Step 5: release the configuration claimed by the setup
+	if lease_id is not None:
+		db.release_config(project,lease_id)
+
+	if db.retry_stats():
+		sys.stderr.write(f'DB transaction retries: {db.retry_stats()}\n')
 
 	sys.exit(0)
 
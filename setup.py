@@ -24,10 +24,15 @@ setup(
     packages=['wcprod'],
     include_package_data=True,
     package_data={'wcprod': ['config/*.yaml']},
+    # the sqlite3 module must be linked against SQLite >= 3.35 (checked by wcprod.db.connect)
     install_requires=[
         'numpy',
         'plotly',
     ],
+    extras_require={
+        # KD-tree lookup of wcprod_db.nearest_config
+        'kdtree': ['scipy'],
+    },
     long_description=long_description,
     long_description_content_type='text/markdown',
 )
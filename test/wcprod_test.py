@@ -1,6 +1,8 @@
 # contents of conftest.py
+import os
 import pytest
 import sqlite3
+import numpy as np
 
 PROJECT_NAME='test_production'
 NUM_PHOTONS_PER_FILE=1000000
@@ -52,9 +54,17 @@ def test_get_project(db):
 
     assert len(project.positions)
 
+def test_config_slice(db,project):
+
+    p = db.get_project(PROJECT_NAME)
+    assert p.num_configs == project.num_configs
+    assert np.allclose(p.config_slice(100,250),project.configs[100:250])
+    cfg = db.get_config(PROJECT_NAME,p.num_configs-1)
+    assert np.allclose([cfg['x'],cfg['y'],cfg['z'],cfg['theta'],cfg['phi']],project.configs[-1,0:5])
+
 def test_list_all_tables(db):
 
-    assert len(db.list_all_tables()) == 8
+    assert len(db.list_all_tables()) == 15
 
 def test_list_positions(db,project):
 
@@ -67,7 +77,7 @@ def test_list_directions(db,project):
 def test_register_file(db,files):
 
     for i,f in enumerate(files):
-        db.register_file(PROJECT_NAME,i,f,NUM_PHOTONS_PER_FILE)
+        db.register_file(PROJECT_NAME,i,f,NUM_PHOTONS_PER_FILE,1.)
 
     assert len(db.list_files(PROJECT_NAME)) == len(files)
 
@@ -94,3 +104,552 @@ def test_table_id(db,project):
 
     assert db.table_id(PROJECT_NAME,len(project.configs)-1) == db.table_count(PROJECT_NAME)-1
 
+def test_table_ids(db,project):
+
+    config_ids = [0,len(project.configs)-1,len(project.configs),-1]
+    expected = [0,db.table_count(PROJECT_NAME)-1,-1,-1]
+    assert list(db.table_ids(PROJECT_NAME,config_ids)) == expected
+
+
+def test_claim_config(db):
+
+    c1 = db.claim_config(PROJECT_NAME,job_id='job1',ttl=60,size=1)
+    c2 = db.claim_config(PROJECT_NAME,job_id='job2',ttl=60,size=1)
+
+    assert c1['config_id'] != c2['config_id']
+    assert c1['lease_id'] != c2['lease_id']
+
+    assert db.release_config(PROJECT_NAME,c1['lease_id'])
+    assert db.release_config(PROJECT_NAME,c2['lease_id'])
+    assert not db.release_config(PROJECT_NAME,c2['lease_id'])
+
+def test_claim_configs(db):
+
+    claims = db.claim_configs(PROJECT_NAME,5,job_id='job3',ttl=60,size=3)
+
+    assert len(claims) == 5
+    assert len(set([c['config_id'] for c in claims])) == 5
+
+    for c in claims:
+        assert db.release_config(PROJECT_NAME,c['lease_id'])
+
+    claims = db.claim_configs(PROJECT_NAME,3,job_id='job4',ttl=60,stagger=True)
+    assert [round(c['expires']-claims[0]['expires']) for c in claims] == [0,60,120]
+    for c in claims:
+        assert db.release_config(PROJECT_NAME,c['lease_id'])
+
+def test_reap_leases(db):
+
+    import time
+    c1 = db.claim_config(PROJECT_NAME,job_id='alive',ttl=60,size=1)
+    c2 = db.claim_config(PROJECT_NAME,job_id='expired',ttl=0.5,size=1)
+    c3 = db.claim_config(PROJECT_NAME,job_id='silent',ttl=60,size=1)
+    assert db.heartbeat(PROJECT_NAME,c2['lease_id'])
+    time.sleep(1.)
+    assert db.heartbeat(PROJECT_NAME,c1['lease_id'],ttl=120)
+
+    report = db.reap_leases(PROJECT_NAME)
+    assert report['leases'] == 1 and report['running'] == 1 and report['jobs'] == ['expired']
+    assert not db.heartbeat(PROJECT_NAME,c2['lease_id'])
+    # a lease without heartbeat (queued run) is reaped only when it expires
+    assert db.reap_leases(PROJECT_NAME,older_than=0.5)['leases'] == 0
+    time.sleep(0.6)
+    report = db.reap_leases(PROJECT_NAME,older_than=0.5)
+    assert report['jobs'] == ['alive'] and report['running'] == 1
+    assert not db.release_config(PROJECT_NAME,c1['lease_id'])
+    assert db.release_config(PROJECT_NAME,c3['lease_id'])
+
+def test_register_files(db,files,tmp_path):
+
+    new_files = []
+    for i in range(3):
+        f = tmp_path / f"bulk{i}"
+        f.write_text(f'bulk{i}')
+        new_files.append(f)
+
+    nfiles = len(db.list_files(PROJECT_NAME))
+    records  = [(i+10,f,NUM_PHOTONS_PER_FILE,1.) for i,f in enumerate(new_files)]
+    records += [(0,files[0],NUM_PHOTONS_PER_FILE,1.), (-1,new_files[0],NUM_PHOTONS_PER_FILE,1.)]
+    assert db.register_files(PROJECT_NAME,records) == [True,True,True,False,False]
+
+    assert len(db.list_files(PROJECT_NAME)) == nfiles + len(new_files)
+    assert db.get_config(PROJECT_NAME,10)['photon_ctr'] == NUM_PHOTONS_PER_FILE
+
+def test_register_files_unindexed(project,tmp_path):
+
+    from wcprod import wcprod_db
+    other = wcprod_db(tmp_path / 'unindexed.db')
+    other.register_project(project,bulk=True,compact=True)
+    other._conn.execute(f'DROP TABLE filepath_{PROJECT_NAME}')
+    other._filepath_indexed.discard(PROJECT_NAME)
+    f = tmp_path / 'unindexed0'
+    f.write_text('unindexed0')
+    assert other.register_files(PROJECT_NAME,[(0,f,NUM_PHOTONS_PER_FILE,1.)]) == [True]
+    # the same path in another file table is a duplicate as well
+    last_config = len(project.positions)*len(project.directions)-1
+    assert other.table_id(PROJECT_NAME,last_config) != other.table_id(PROJECT_NAME,0)
+    assert other.register_files(PROJECT_NAME,[(last_config,f,NUM_PHOTONS_PER_FILE,1.)]) == [False]
+
+    # nor merged from another database
+    site = wcprod_db(tmp_path / 'unindexed_site.db')
+    site.register_project(project,bulk=True,compact=True)
+    assert site.register_files(PROJECT_NAME,[(last_config,f,NUM_PHOTONS_PER_FILE,1.)]) == [True]
+    assert other.merge_from(tmp_path / 'unindexed_site.db',PROJECT_NAME) == 0
+
+def test_ingest_journal(db,tmp_path):
+
+    from wcprod.journal import append_record
+    journal = tmp_path / 'journal.jsonl'
+    claim = db.claim_config(PROJECT_NAME,job_id='journal',ttl=60,size=1)
+    for i in range(3):
+        f = tmp_path / f"journal{i}"
+        f.write_text(f'journal{i}')
+        append_record(journal,PROJECT_NAME,20+i,f,NUM_PHOTONS_PER_FILE,1.,lease_id=claim['lease_id'] if i==0 else None)
+    with open(journal,'a') as f:
+        f.write('{"project": "truncated')
+
+    nfiles = len(db.list_files(PROJECT_NAME))
+    assert db.ingest_journal(journal,batch_size=2) == dict(records=3,registered=3,skipped=0,invalid=1)
+    assert len(db.list_files(PROJECT_NAME)) == nfiles + 3
+    assert db.get_config(PROJECT_NAME,21)['photon_ctr'] == NUM_PHOTONS_PER_FILE
+    assert not db.release_config(PROJECT_NAME,claim['lease_id'])
+
+    assert db.ingest_journal(journal) == dict(records=3,registered=0,skipped=3,invalid=1)
+    assert len(db.list_files(PROJECT_NAME)) == nfiles + 3
+
+    # a record appended after the torn line is kept
+    f = tmp_path / "journal3"
+    f.write_text('journal3')
+    append_record(journal,PROJECT_NAME,23,f,NUM_PHOTONS_PER_FILE,1.)
+    assert db.ingest_journal(journal) == dict(records=4,registered=1,skipped=3,invalid=1)
+
+def test_merge_from(db,project,tmp_path):
+
+    from wcprod import wcprod_db, wcprod_project
+    other = wcprod_db(tmp_path / 'site.db')
+    other.register_project(project,bulk=True,compact=True)
+    new_file = tmp_path / 'site0'
+    new_file.write_text('site0')
+    registered = db.list_files(PROJECT_NAME,config_id=10)[0]
+    assert other.register_files(PROJECT_NAME,[(10,registered,NUM_PHOTONS_PER_FILE,1.),(11,new_file,NUM_PHOTONS_PER_FILE,1.)]) == [True,True]
+    # a duplicated record in the source is merged once
+    cmd  = f"INSERT INTO file_{PROJECT_NAME}0 (config_id,file_path,photon_ctr,duration)"
+    cmd += f" SELECT config_id,file_path,photon_ctr,duration FROM file_{PROJECT_NAME}0 WHERE file_path=?"
+    other._conn.execute(cmd,(str(new_file),))
+    other._conn.commit()
+
+    nfiles = len(db.list_files(PROJECT_NAME))
+    photons = db.get_config(PROJECT_NAME,11)['photon_ctr']
+    table_photons = db._conn.execute(f'SELECT photon_ctr FROM map_{PROJECT_NAME} WHERE table_id=0').fetchone()[0]
+    assert db.merge_from(tmp_path / 'site.db',PROJECT_NAME) == 1
+    assert db.merge_from(tmp_path / 'site.db',PROJECT_NAME) == 0
+    assert len(db.list_files(PROJECT_NAME)) == nfiles + 1
+    assert db.exist_file(PROJECT_NAME,new_file)
+    assert db.get_config(PROJECT_NAME,11)['photon_ctr'] == photons + NUM_PHOTONS_PER_FILE
+    assert db._conn.execute(f'SELECT photon_ctr FROM map_{PROJECT_NAME} WHERE table_id=0').fetchone()[0] == table_photons + NUM_PHOTONS_PER_FILE
+    db.check_integrity(PROJECT_NAME)
+
+    other = wcprod_db(tmp_path / 'other.db')
+    other.register_project(wcprod_project(dict(project=PROJECT_NAME,rmin=0,rmax=200,zmin=0,zmax=400,
+        gap_space=40,gap_angle=10,num_photons=100000000)),bulk=True,compact=True)
+    with pytest.raises(ValueError):
+        db.merge_from(tmp_path / 'other.db',PROJECT_NAME)
+
+def test_iter_files(db,files):
+
+    paths = db.list_files(PROJECT_NAME)
+    assert list(db.iter_files(PROJECT_NAME,batch_size=1)) == paths
+    rows = list(db.iter_files(PROJECT_NAME,columns=['config_id','file_path','photon_ctr'],batch_size=2))
+    assert [row[1] for row in rows] == paths
+    assert all(photons == NUM_PHOTONS_PER_FILE for _,_,photons in rows)
+    assert db.list_files(PROJECT_NAME,config_id=0) == [str(files[0])]
+    with pytest.raises(ValueError):
+        next(db.iter_files(PROJECT_NAME,columns=['nonexistent']))
+
+def test_quoted_file_path(db,tmp_path):
+
+    f = tmp_path / "it's a file"
+    f.write_text('quoted')
+    assert db.register_file(PROJECT_NAME,3,f,NUM_PHOTONS_PER_FILE,1.)
+    assert db.exist_file(PROJECT_NAME,f)
+    assert str(f) in db.list_files(PROJECT_NAME,config_id=3)
+
+def test_build_filepath_index(db,files):
+
+    nfiles = len(db.list_files(PROJECT_NAME))
+    assert db.build_filepath_index(PROJECT_NAME) == nfiles
+    assert not db.register_file(PROJECT_NAME,db.table_count(PROJECT_NAME)*500000,files[0],NUM_PHOTONS_PER_FILE,1.)
+
+def test_get_project_meta(db,project):
+
+    meta = db.get_project_meta(PROJECT_NAME)
+
+    assert meta['num_photons'] == project.num_photons
+    assert meta['num_config'] == len(project.configs)
+    assert db.get_project_meta('not_a_project') is None
+    assert db.get_project(PROJECT_NAME) is db.get_project(PROJECT_NAME)
+
+def test_add_indexes(db):
+
+    db.add_indexes(PROJECT_NAME)
+
+    cur = db._conn.cursor()
+    cur.execute(f"EXPLAIN QUERY PLAN SELECT config_id FROM cfg_{PROJECT_NAME}0 ORDER BY photon_ctr ASC LIMIT 10")
+    assert 'photon_ctr' in ' '.join([str(r[-1]) for r in cur.fetchall()])
+    cur.close()
+
+def test_retry_on_busy(db):
+
+    import threading
+    from wcprod import wcprod_db
+    dbname = db._conn.execute("PRAGMA database_list").fetchall()[0][2]
+
+    db2 = wcprod_db(dbname,busy_timeout=0.01,max_retries=100,retry_delay=0.01)
+
+    holder = sqlite3.connect(dbname,check_same_thread=False)
+    holder.execute("BEGIN EXCLUSIVE")
+    timer = threading.Timer(0.3,holder.commit)
+    timer.start()
+
+    assert not db2.release_config(PROJECT_NAME,-1)
+    assert db2.retry_stats()['release_config'] > 0
+    timer.join()
+    holder.close()
+
+def test_server(db,tmp_path):
+
+    from wcprod.server import wcprod_server, wcprod_client
+    dbname = db._conn.execute("PRAGMA database_list").fetchall()[0][2]
+
+    server = wcprod_server(dbname,'tcp://127.0.0.1:0')
+    server.start()
+    try:
+        client = wcprod_client(server.address)
+        assert client.exist_project(PROJECT_NAME)
+
+        claim = client.claim_config(PROJECT_NAME,job_id='server',ttl=60)
+        f = tmp_path / 'served'
+        f.write_text('served')
+        assert client.register_file(PROJECT_NAME,claim['config_id'],str(f),NUM_PHOTONS_PER_FILE,1.)
+        assert client.release_config(PROJECT_NAME,claim['lease_id'])
+        assert db.exist_file(PROJECT_NAME,f)
+
+        with pytest.raises(ValueError):
+            client.table_id(PROJECT_NAME,-1)
+        with pytest.raises(AttributeError):
+            client.drop_project(PROJECT_NAME)
+        with pytest.raises(AttributeError):
+            client._call('drop_project',[PROJECT_NAME],dict())
+        # sqlite3 errors keep their type through the server
+        with pytest.raises(sqlite3.OperationalError):
+            client.list_files('nonexistent')
+        assert db.exist_project(PROJECT_NAME)
+        client.close()
+
+        # concurrent registrations are grouped by the server
+        import threading
+        results = []
+        def register(index):
+            c = wcprod_client(server.address)
+            paths = []
+            for i in range(5):
+                f = tmp_path / f'served_{index}_{i}'
+                f.write_text('served')
+                paths.append(str(f))
+            results.extend([c.register_file(PROJECT_NAME,index,p,NUM_PHOTONS_PER_FILE,1.) for p in paths])
+            c.close()
+        threads = [threading.Thread(target=register,args=(i,)) for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        assert results == [True]*20
+    finally:
+        server.shutdown()
+
+    # a unix: address never removes a file that is not a socket
+    with pytest.raises(ValueError):
+        wcprod_server(dbname,f'unix:{dbname}')
+    assert os.path.isfile(dbname)
+
+def test_check_integrity(db):
+
+    db.check_integrity(PROJECT_NAME)
+    db.check_integrity(PROJECT_NAME,workers=2)
+
+def test_check_integrity_incremental(db,tmp_path):
+
+    num_tables = db.table_count(PROJECT_NAME)
+    assert db.check_integrity(PROJECT_NAME) == num_tables
+    assert db.check_integrity(PROJECT_NAME,incremental=True) == 0
+
+    f = tmp_path / 'incremental'
+    f.write_text('incremental')
+    assert db.register_file(PROJECT_NAME,0,f,NUM_PHOTONS_PER_FILE,1.)
+    assert db.check_integrity(PROJECT_NAME,incremental=True) == 1
+    assert db.check_integrity(PROJECT_NAME,since='2000-01-01 00:00:00') >= 1
+    assert db.check_integrity(PROJECT_NAME,since='2100-01-01 00:00:00') == 0
+
+def test_query_region(db,project,tmp_path):
+
+    pos = db.list_positions(PROJECT_NAME)
+    r, phi = np.hypot(pos[:,0],pos[:,1]), np.mod(np.degrees(np.arctan2(pos[:,1],pos[:,0])),360.)
+    selected = (r >= 50) & (r <= 120) & (pos[:,2] >= 100) & (pos[:,2] <= 200) & ((phi >= 300) | (phi <= 45))
+    pos_ids = np.sort(pos[selected,3].astype(np.int64))
+    config_ids = db.query_region(PROJECT_NAME,rmin=50,rmax=120,zmin=100,zmax=200,phimin=300,phimax=45)
+    assert len(pos_ids) > 0
+    assert np.array_equal(np.unique(config_ids % len(pos)),pos_ids)
+    assert len(config_ids) == len(pos_ids)*len(db.list_directions(PROJECT_NAME))
+    assert len(db.query_region(PROJECT_NAME)) == project.num_configs
+    assert db.build_rtree(PROJECT_NAME) == len(pos)
+
+    from wcprod import wcprod_db, wcprod_project
+    vdb = wcprod_db(tmp_path / 'voxel.db')
+    vdb.register_project(wcprod_project(dict(project=PROJECT_NAME,rmin=0,rmax=350,zmin=-150,zmax=155,
+        gap_space=20,gap_angle=10,n_phi_start=4,num_photons=10000)),bulk=True)
+    vox = vdb.list_voxels(PROJECT_NAME)
+    selected = (vox[:,0] <= 100) & (vox[:,1] > 100) & (vox[:,4] <= 0) & (vox[:,5] > -20)
+    assert np.array_equal(vdb.query_region(PROJECT_NAME,rmin=100,rmax=100,zmin=-20,zmax=0),np.sort(vox[selected,6].astype(np.int64)))
+    assert len(vdb.query_region(PROJECT_NAME,rmin=100,rmax=100,zmin=-20,zmax=0,phimin=10,phimax=10)) == 2
+
+def test_locate_voxels(db,tmp_path):
+
+    from wcprod import wcprod_db, wcprod_project
+    vdb = wcprod_db(tmp_path / 'voxel.db')
+    p = wcprod_project(dict(project=PROJECT_NAME,rmin=0,rmax=350,zmin=-150,zmax=155,
+        gap_space=20,gap_angle=10,n_phi_start=4,num_photons=10000))
+    vdb.register_project(p,bulk=True)
+    assert np.array_equal(vdb.locate_voxels(PROJECT_NAME,p.positions),np.arange(len(p.voxels)))
+
+    rng = np.random.default_rng(0)
+    r, phi, z = rng.uniform(0,360,1000), rng.uniform(0,2*np.pi,1000), rng.uniform(-160,160,1000)
+    xyz = np.column_stack([r*np.cos(phi),r*np.sin(phi),z])
+    ids = vdb.locate_voxels(PROJECT_NAME,xyz)
+    phi = np.degrees(phi)
+    for i in range(len(xyz)):
+        inside = (p.voxels[:,0] <= r[i]) & (r[i] < p.voxels[:,1]) & (p.voxels[:,2] <= phi[i]) & (phi[i] < p.voxels[:,3]) & (p.voxels[:,4] <= z[i]) & (z[i] < p.voxels[:,5])
+        assert ids[i] == (np.where(inside)[0][0] if inside.any() else -1)
+    with pytest.raises(ValueError):
+        db.locate_voxels(PROJECT_NAME,xyz)
+
+def test_nearest_config(db):
+
+    pytest.importorskip('scipy')
+    import wcprod
+    config_ids = np.array([0,1234,5678,100000])
+    cfgs = [db.get_config(PROJECT_NAME,int(c)) for c in config_ids]
+    xyz = np.array([[c['x']+1.,c['y']-1.,c['z']+0.5] for c in cfgs])
+    dirs = np.array([[c['theta']+1.,c['phi']-1.] for c in cfgs])
+    assert np.array_equal(db.nearest_config(PROJECT_NAME,xyz,dirs),config_ids)
+    assert np.array_equal(db.nearest_config(PROJECT_NAME,xyz,wcprod.direction_vectors(dirs)*2.),config_ids)
+
+    # the duplicated directions at a pole resolve to the lowest dir_id
+    directions = db.get_project(PROJECT_NAME).directions
+    pole = np.where(np.isclose(directions[:,0],180.))[0]
+    assert len(pole) > 1
+    res = db.nearest_config(PROJECT_NAME,np.zeros(shape=(len(pole),3)),directions[pole])
+    assert np.all(res == res[0]) and db.get_config(PROJECT_NAME,int(res[0]))['dir_id'] == pole.min()
+
+def test_register_project_bulk(project,tmp_path):
+
+    from wcprod import wcprod_db
+    db = wcprod_db(tmp_path / 'bulk.db')
+    db.register_project(project,max_entries_per_table=5000,bulk=True)
+    assert db.table_count(PROJECT_NAME) == -(-project.num_configs//5000)
+    assert db._conn.execute("PRAGMA journal_mode").fetchone()[0] == 'delete'
+    assert db._conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+    assert db.get_config(PROJECT_NAME,project.num_configs-1)['config_id'] == project.num_configs-1
+
+def test_register_project_compact(db,project,tmp_path,files):
+
+    from wcprod import wcprod_db
+    cdb = wcprod_db(tmp_path / 'compact.db')
+    cdb.register_project(project,max_entries_per_table=5000,compact=True)
+    assert cdb.get_project_meta(PROJECT_NAME)['compact'] == 1
+    columns = [row[1] for row in cdb._conn.execute(f"PRAGMA table_info(cfg_{PROJECT_NAME}0)")]
+    assert columns == ['config_id','file_ctr','photon_ctr','Timestamp']
+
+    for config_id in [0,1234,project.num_configs-1]:
+        expected = db.get_config(PROJECT_NAME,config_id)
+        expected.update(file_ctr=0,photon_ctr=0)
+        assert cdb.get_config(PROJECT_NAME,config_id) == expected
+
+    assert cdb.register_file(PROJECT_NAME,5,files[0],NUM_PHOTONS_PER_FILE,1.)
+    assert cdb.get_config(PROJECT_NAME,5)['photon_ctr'] == NUM_PHOTONS_PER_FILE
+    claims = cdb.claim_configs(PROJECT_NAME,3)
+    for claim in claims:
+        cfg = db.get_config(PROJECT_NAME,claim['config_id'])
+        assert all(claim[key] == cfg[key] for key in ['x','y','z','theta','phi'])
+    assert set(cdb.get_random_config(PROJECT_NAME)) == set(['config_id','table_id','x','y','z','theta','phi','file_ctr'])
+    cdb.check_integrity(PROJECT_NAME)
+
+    # a job process reads only the geometry rows of its configurations
+    cdb = wcprod_db(tmp_path / 'compact.db')
+    claims = cdb.claim_configs(PROJECT_NAME,3)
+    for claim in claims:
+        cfg = db.get_config(PROJECT_NAME,claim['config_id'])
+        assert all(claim[key] == cfg[key] for key in ['x','y','z','theta','phi'])
+    assert cdb.get_config(PROJECT_NAME,project.num_configs-1)['dir_id'] == len(project.directions)-1
+    assert not PROJECT_NAME in cdb._projects
+
+    from wcprod import wcprod_project
+    vdb = wcprod_db(tmp_path / 'compact_voxel.db')
+    p = wcprod_project(dict(project=PROJECT_NAME,rmin=0,rmax=350,zmin=-150,zmax=155,
+        gap_space=20,gap_angle=10,n_phi_start=4,num_photons=10000))
+    vdb.register_project(p,max_entries_per_table=1000,compact=True)
+    vdb = wcprod_db(tmp_path / 'compact_voxel.db')
+    for config_id in [0,1234,len(p.voxels)-1]:
+        cfg = vdb.get_config(PROJECT_NAME,config_id)
+        assert [cfg[key] for key in ['r0','r1','phi0','phi1','z0','z1']] == p.voxels[config_id].tolist()
+        assert cfg['pos_id'] == config_id
+    assert not PROJECT_NAME in vdb._projects
+
+def test_sqlite_version(tmp_path,monkeypatch):
+
+    from wcprod import wcprod_db
+    monkeypatch.setattr(sqlite3,'sqlite_version_info',(3,31,1))
+    with pytest.raises(RuntimeError):
+        wcprod_db(tmp_path / 'old_sqlite.db')
+
+def test_project_table_without_compact(project,tmp_path):
+
+    from wcprod import wcprod_db
+    # the project table of a database created before the compact schema
+    dbname = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(dbname)
+    cmd  = "CREATE TABLE project (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, rmin FLOAT, rmax FLOAT, zmin FLOAT, zmax FLOAT,"
+    cmd += " gap_space FLOAT, gap_angle FLOAT, n_phi_start INT, num_config INT, num_tables INT, num_photons INT)"
+    conn.execute(cmd)
+    conn.execute("INSERT INTO project (name, num_photons) VALUES ('old', 1)")
+    conn.commit()
+
+    # opening the database does not write the schema
+    odb = wcprod_db(dbname)
+    assert odb.get_project_meta('old')['compact'] == 0
+    assert not conn.execute("SELECT name FROM pragma_table_info('project') WHERE name='compact'").fetchall()
+
+    # registering a project migrates the table
+    odb.register_project(project,bulk=True,compact=True)
+    assert wcprod_db(dbname).get_project_meta(PROJECT_NAME)['compact'] == 1
+    conn.close()
+
+def test_export_counters(db,tmp_path):
+
+    from wcprod import load_counters
+    num_config = db.get_project_meta(PROJECT_NAME)['num_config']
+    assert db.export_counters(PROJECT_NAME,tmp_path / 'counters') == num_config
+    counters = load_counters(tmp_path / 'counters')
+    assert len(counters['photon_ctr']) == len(counters['file_ctr']) == len(counters['timestamp']) == num_config
+    for config_id in [0,1,num_config-1]:
+        cfg = db.get_config(PROJECT_NAME,config_id)
+        assert counters['photon_ctr'][config_id] == cfg['photon_ctr']
+        assert counters['file_ctr'][config_id] == cfg['file_ctr']
+    assert counters['photon_ctr'].sum() == db._conn.execute(f'SELECT SUM(photon_ctr) FROM map_{PROJECT_NAME}').fetchone()[0]
+
+def test_progress(db):
+
+    report = db.progress(PROJECT_NAME)
+    assert report['num_tables'] == db.table_count(PROJECT_NAME) == len(report['table_completion'])
+    assert report['photon_ctr'] == db._conn.execute(f'SELECT SUM(photon_ctr) FROM map_{PROJECT_NAME}').fetchone()[0]
+    assert report['files'] == len(db.list_files(PROJECT_NAME))
+    assert report['photons'] > 0 and report['eta_hours'] > 0
+    assert 0 < report['completion'] < 1
+    assert set(report['cluster_completion']) == set(['s3df','cern','sukap','grid','idark','beluga'])
+    assert db.progress(PROJECT_NAME,window=1.e-9)['eta_hours'] is None
+
+def test_partition(db,project,tmp_path):
+
+    import wcprod
+    num_tables = db.table_count(PROJECT_NAME)
+    table_ids = [db.get_table_ids(PROJECT_NAME,cluster) for cluster in db.get_partition(PROJECT_NAME)]
+    assert sorted(sum(table_ids,[])) == list(range(num_tables))
+    assert all(isinstance(table_id,int) for table_id in db.get_table_ids(PROJECT_NAME,'S3DF'))
+    with pytest.raises(ValueError):
+        db.get_table_ids(PROJECT_NAME,'nowhere')
+    # the default split of earlier versions: int(0.15*N) tables per cluster, s3df the rest
+    for n in [1,7,20,99,274,1000]:
+        portion = int(0.15*n)
+        assert db._partition_bounds(list(wcprod.db.DEFAULT_PARTITION.values()),n) == [0,portion,2*portion,3*portion,4*portion,5*portion,n]
+
+    from wcprod import wcprod_db
+    pdb = wcprod_db(tmp_path / 'partition.db')
+    pdb.register_project(project,max_entries_per_table=5000,bulk=True,compact=True)
+    num_tables = pdb.table_count(PROJECT_NAME)
+    assert pdb.set_partition(PROJECT_NAME,'fast: 1\nslow: 1') == dict(fast=num_tables//2,slow=num_tables-num_tables//2)
+    assert pdb.get_partition(PROJECT_NAME) == dict(fast=1.,slow=1.)
+    assert pdb.get_project(PROJECT_NAME).partition == dict(fast=1.,slow=1.)
+    fast, slow = pdb.get_table_ids(PROJECT_NAME,'fast'), pdb.get_table_ids(PROJECT_NAME,'slow')
+    assert fast == list(range(num_tables//2))
+    assert all(pdb.table_id(PROJECT_NAME,c['config_id']) in fast for c in pdb.claim_configs(PROJECT_NAME,3,cluster='fast'))
+
+    records = []
+    for i,table_id in enumerate([0,1,2,slow[0]]):
+        f = tmp_path / f'partition{i}'
+        f.write_text(f'partition{i}')
+        records.append((table_id*5000,f,NUM_PHOTONS_PER_FILE if table_id in fast else NUM_PHOTONS_PER_FILE//10,1.))
+    assert all(pdb.register_files(PROJECT_NAME,records))
+    report = pdb.rebalance(PROJECT_NAME)
+    assert report['fast']['photons_per_hour'] > report['slow']['photons_per_hour'] > 0
+    assert report['fast']['tables'] > report['slow']['tables'] > 0
+    table_ids = [pdb.get_table_ids(PROJECT_NAME,cluster) for cluster in ['fast','slow']]
+    assert sorted(sum(table_ids,[])) == list(range(num_tables))
+    assert len(table_ids[0]) == report['fast']['tables']
+    assert pdb.progress(PROJECT_NAME)['cluster_completion'].keys() == set(['fast','slow'])
+
+def test_register_project_sharded(db,project,tmp_path):
+
+    from wcprod import wcprod_db
+    sdb = wcprod_db(str(tmp_path / 'sharded.db'))
+    sdb.register_project(project,max_entries_per_table=5000,shards=True)
+    shards = sdb.list_shards(PROJECT_NAME)
+    # one shard per cluster partition
+    partition = sdb.get_partition(PROJECT_NAME)
+    assert len(shards) == len(partition)
+    for s,cluster in zip(shards,partition):
+        assert sdb.get_table_ids(PROJECT_NAME,cluster) == list(range(s['table_min'],s['table_max']+1))
+    assert all(os.path.isfile(s['file_path']) for s in shards)
+    assert shards[0]['table_min'] == 0 and shards[-1]['table_max'] == sdb.table_count(PROJECT_NAME)-1
+    assert not sdb._conn.execute("SELECT name FROM sqlite_master WHERE name = ?",(f'cfg_{PROJECT_NAME}0',)).fetchone()
+
+    config_ids = [0,project.num_configs//2,project.num_configs-1]
+    for config_id in config_ids:
+        assert sdb.get_config(PROJECT_NAME,config_id) == db.get_config(PROJECT_NAME,config_id) | dict(file_ctr=0,photon_ctr=0)
+    files = [str(tmp_path / f'sharded{i}') for i in range(len(config_ids))]
+    for f in files:
+        open(f,'w').close()
+    records = [(config_id,files[i],NUM_PHOTONS_PER_FILE,1.) for i,config_id in enumerate(config_ids)]
+    assert all(sdb.register_files(PROJECT_NAME,records))
+    assert not any(sdb.register_files(PROJECT_NAME,records))
+    # a path registered in one shard is a duplicate in the others
+    assert not any(sdb.register_files(PROJECT_NAME,[(config_ids[-1],files[0],NUM_PHOTONS_PER_FILE,1.),(config_ids[0],files[-1],NUM_PHOTONS_PER_FILE,1.)]))
+    for config_id in config_ids:
+        assert sdb.get_config(PROJECT_NAME,config_id)['photon_ctr'] == NUM_PHOTONS_PER_FILE
+    assert all(sdb.exist_file(PROJECT_NAME,f) for f in files)
+    assert len(sdb.list_files(PROJECT_NAME)) == 3
+    assert sdb.progress(PROJECT_NAME)['photon_ctr'] == 3*NUM_PHOTONS_PER_FILE
+    assert len(sdb.claim_configs(PROJECT_NAME,3)) == 3
+    sdb.check_integrity(PROJECT_NAME,workers=2)
+
+    # nor merged from another database
+    other = wcprod_db(str(tmp_path / 'sharded_site.db'))
+    other.register_project(project,max_entries_per_table=5000,bulk=True,compact=True)
+    assert other.register_files(PROJECT_NAME,[(config_ids[-1],files[0],NUM_PHOTONS_PER_FILE,1.)]) == [True]
+    assert sdb.merge_from(tmp_path / 'sharded_site.db',PROJECT_NAME) == 0
+    assert len(sdb.list_files(PROJECT_NAME)) == 3
+
+    # a locked database file delays the map update of a shard registration but does not lose it
+    import threading
+    sdb2 = wcprod_db(str(tmp_path / 'sharded.db'),busy_timeout=0.01,max_retries=100,retry_delay=0.01)
+    photons = sdb2.progress(PROJECT_NAME)['photon_ctr']
+    locked = str(tmp_path / 'sharded_locked')
+    open(locked,'w').close()
+    holder = sqlite3.connect(str(tmp_path / 'sharded.db'),check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")
+    timer = threading.Timer(0.3,holder.commit)
+    timer.start()
+    assert sdb2.register_files(PROJECT_NAME,[(config_ids[1],locked,NUM_PHOTONS_PER_FILE,1.)]) == [True]
+    timer.join()
+    holder.close()
+    assert sdb2.retry_stats()['_write_map_photons'] > 0
+    assert sdb2.progress(PROJECT_NAME)['photon_ctr'] == photons + NUM_PHOTONS_PER_FILE
+
+    sdb.drop_project(PROJECT_NAME)
+    assert not any(os.path.isfile(s['file_path']) for s in shards)
@@ -1,3 +1,4 @@
 from .project import wcprod_project
 from .db import wcprod_db
+from .server import wcprod_server, wcprod_client, open_db
 from .utils import *
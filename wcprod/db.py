@@ -1,10 +1,13 @@
-import sqlite3, time, os
-import pandas as pd
-from contextlib import closing
+import sqlite3, time, os, sys
+import functools, random
+from contextlib import closing, contextmanager
 import numpy as np
 from tqdm import tqdm
 import datetime
+import yaml
 from .project import wcprod_project
+from . import utils
+from .journal import read_journal
 
 class TableNotFoundError(Exception):
     pass
@@ -13,9 +16,181 @@ class ProjectNotFoundError(Exception):
 class ProjectIntegrityError(Exception):
     pass
 
+# the minimum SQLite library version (DELETE ... RETURNING from 3.35, UPDATE ... FROM from 3.33)
+SQLITE_MIN_VERSION=(3,35,0)
+# the maximum number of host parameters in a single SQLite statement (SQLITE_MAX_VARIABLE_NUMBER before 3.32)
+SQLITE_MAX_VARIABLES=999
+# the number of prepared statements cached per connection: the hot-path statements are
+# distinct per configuration/file table, so the sqlite3 default (128) is too small for large projects
+STATEMENT_CACHE_SIZE=1024
+# the maximum backoff in seconds between retries of a write transaction
+RETRY_MAX_DELAY=30.
+# columns of a file table
+FILE_COLUMNS=['file_id','config_id','file_path','photon_ctr','duration','Timestamp']
+# partition of the tables among the clusters (name => weight) for a project without partition_{project} table
+DEFAULT_PARTITION=dict(cern=0.15,sukap=0.15,grid=0.15,idark=0.15,beluga=0.15,s3df=0.25)
+# cluster names of the default partition
+CLUSTERS=list(DEFAULT_PARTITION)
+# file names of the arrays written by wcprod_db.export_counters
+COUNTER_FILES=dict(photon_ctr='photon_ctr.npy',file_ctr='file_ctr.npy',timestamp='timestamp.npy')
+# geometry columns of a configuration in the shotgun (n_phi_start == 0) and voxel modes
+SHOTGUN_KEYS=['x','y','z','theta','phi']
+VOXEL_KEYS=['r0','r1','phi0','phi1','z0','z1']
+
+def connect(dbname:str,wal:bool=False,busy_timeout:float=60.,synchronous:str=None,cached_statements:int=STATEMENT_CACHE_SIZE):
+    """Open a SQLite connection configured for concurrent access
+
+    Parameters
+    ----------
+    dbname : str
+        Name of the database to connect or create if it does not exist
+
+    wal : bool (optional)
+        If True, switch the database to the write-ahead-log journal mode. WAL lets readers run
+        concurrently with a writer but requires all processes to be on the same host (no NFS).
+
+    busy_timeout : float (optional)
+        Seconds to wait for a lock held by another connection before failing with "database is locked"
+
+    synchronous : str (optional)
+        If provided, the synchronous level (OFF, NORMAL, FULL or EXTRA)
+
+    cached_statements : int (optional)
+        The number of prepared statements cached by the connection
+
+    Returns
+    -------
+    sqlite3.Connection
+        The connection
+    """
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise RuntimeError(f"wcprod requires SQLite {'.'.join(map(str,SQLITE_MIN_VERSION))} or newer (the sqlite3 module uses {sqlite3.sqlite_version})")
+    conn = sqlite3.connect(dbname,timeout=float(busy_timeout),cached_statements=int(cached_statements))
+    conn.execute(f"PRAGMA busy_timeout = {int(float(busy_timeout)*1000)}")
+    if wal:
+        conn.execute("PRAGMA journal_mode = WAL")
+    if synchronous is not None:
+        if not str(synchronous).upper() in ['OFF','NORMAL','FULL','EXTRA']:
+            raise ValueError(f"Invalid synchronous level: {synchronous}")
+        conn.execute(f"PRAGMA synchronous = {str(synchronous).upper()}")
+    return conn
+
+def retry_on_busy(func):
+    """Decorator to retry a write transaction when the database is locked
+
+    The decorated wcprod_db method is re-run after a jittered exponential backoff
+    (up to the max_retries given to the wcprod_db constructor). Retries are counted
+    per method and can be retrieved with wcprod_db.retry_stats().
+    """
+    @functools.wraps(func)
+    def wrapper(self,*args,**kwargs):
+        delay = self._retry_delay
+        for attempt in range(self._max_retries+1):
+            try:
+                return func(self,*args,**kwargs)
+            except sqlite3.OperationalError as e:
+                if not ('locked' in str(e) or 'busy' in str(e)) or attempt == self._max_retries:
+                    raise
+                self._conn.rollback()
+                self._retries[func.__name__] = self._retries.get(func.__name__,0) + 1
+                sys.stderr.write(f'{func.__name__}: {e} (retry {attempt+1}/{self._max_retries})\n')
+                time.sleep(random.uniform(0.5,1.0)*delay)
+                delay = min(2*delay,RETRY_MAX_DELAY)
+    return wrapper
+
+@contextmanager
+def _immediate(conn):
+    """Run a write transaction taking the write lock upfront (BEGIN IMMEDIATE)
+
+    Any pending transaction of the connection is finished first. The transaction is
+    committed at the end of the block, or rolled back if the block raises.
+    """
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def _check_table(cur,project:str,index:int,cfgmin:int,cfgmax:int,geo:dict):
+    """Integrity checks of the configuration and file tables with the given table ID (see wcprod_db.check_integrity)"""
+    cur.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='cfg_{project}{index}'")
+    if len(cur.fetchall()) < 1:
+        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} should but does not exist.")
+    rmin, rmax, zmin, zmax = geo['rmin'], geo['rmax'], geo['zmin'], geo['zmax']
+    pos_id_ctr, dir_id_ctr = geo['pos_id_ctr'], geo['dir_id_ctr']
+    # one scan of the table for all aggregates
+    if geo['compact']:
+        # geometry is derived from config_id and the geo table
+        cmd  = f"SELECT MIN(config_id), MAX(config_id), 0, 0 FROM cfg_{project}{index}"
+    elif geo['n_phi_start'] == 0:
+        cmd  = "SELECT MIN(config_id), MAX(config_id), MAX(pos_id), MAX(dir_id),"
+        cmd += f" MIN(ABS(x)), MAX(ABS(x)), MIN(ABS(y)), MAX(ABS(y)), MIN(z), MAX(z), MIN(theta), MAX(theta), MIN(phi), MAX(phi) FROM cfg_{project}{index}"
+    else:
+        cmd  = "SELECT MIN(config_id), MAX(config_id), MAX(pos_id), MAX(dir_id),"
+        cmd += f" MIN(r0), MAX(r0), MIN(r1), MAX(r1), MIN(phi0), MAX(phi0), MIN(phi1), MAX(phi1), MIN(z0), MAX(z0), MIN(z1), MAX(z1) FROM cfg_{project}{index}"
+    cur.execute(cmd)
+    res = cur.fetchall()[0]
+    cfg_min, cfg_max, pos_max, dir_max = res[0:4]
+    if cfg_min < cfgmin or cfgmax < cfg_max:
+        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has invalid config_id range {cfg_min}=>{cfg_max} (expected: {[cfgmin,cfgmax]})")
+    if pos_id_ctr <= pos_max:
+        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected maximum pos_id value {pos_max} (should be < {pos_id_ctr})")
+    if dir_id_ctr <= dir_max:
+        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected maximum dir_id value {dir_max} (should be < {dir_id_ctr})")
+    if geo['compact']:
+        pass
+    elif geo['n_phi_start'] == 0:
+        xmin, xmax, ymin, ymax, zmin2, zmax2, tmin, tmax, pmin, pmax = res[4:]
+        if xmin < rmin or rmax < xmax:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected abs(x) value range {xmin}=>{xmax} (expected {rmin}=>{rmax})")
+        if ymin < rmin or rmax < ymax:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected abs(y) value range {ymin}=>{ymax} (expected {rmin}=>{rmax})")
+        if zmin2 < zmin or zmax < zmax2:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected z value range {zmin2}=>{zmax2} (expected {zmin}=>{zmax})")
+        if tmin < 0 or 180 < tmax:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected theta value range {tmin}=>{tmax} (expected 0=>180)")
+        if pmin < 0 or 360 < pmax:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected phi value range {pmin}=>{pmax} (expected 0=>360)")
+    else:
+        r0min, r0max, r1min, r1max, phi0min, phi0max, phi1min, phi1max, z0min, z0max, z1min, z1max = res[4:]
+        if r0min < rmin or rmax < r0max:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected r0 value range {r0min}=>{r0max} (expected {rmin}=>{rmax})")
+        if r1min < rmin or rmax < r1max:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected r1 value range {r1min}=>{r1max} (expected {rmin}=>{rmax})")
+        if phi0min < 0 or 360 < phi0max:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected phi0 value range {phi0min}=>{phi0max} (expected 0=>360)")
+        if phi1min < 0 or 360 < phi1max:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected phi1 value range {phi1min}=>{phi1max} (expected 0=>360)")
+        if z0min < zmin or zmax < z0max:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected z0 value range {z0min}=>{z0max} (expected {zmin}=>{zmax})")
+        if z1min < zmin or zmax < z1max:
+            raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected z1 value range {z1min}=>{z1max} (expected {zmin}=>{zmax})")
+
+    # - file table
+    cmd = f"SELECT MIN(config_id),MAX(config_id) FROM file_{project}{index}"
+    cur.execute(cmd)
+    res = cur.fetchall()
+    if res[0][0] is not None and (res[0][0] < cfg_min or cfg_max < res[0][1]):
+        raise ProjectIntegrityError(f"File table file_{project}{index} contains unexpected config_id range {res[0][0]}=>{res[0][1]} (expected {cfg_min}=>{cfg_max})")
+
+# read-only connections of a check_integrity worker process (one per database or shard file)
+_check_conns = dict()
+
+def _check_table_worker(task:tuple):
+    """Run _check_table in a check_integrity worker process (task = database file + _check_table arguments)"""
+    dbname, task = task[0], task[1:]
+    if not dbname in _check_conns:
+        from urllib.request import pathname2url
+        _check_conns[dbname] = sqlite3.connect(f"file:{pathname2url(dbname)}?mode=ro",uri=True)
+    with closing(_check_conns[dbname].cursor()) as cur:
+        _check_table(cur,*task)
+
 class wcprod_db:
     
-    def __init__(self,dbname:str):
+    def __init__(self,dbname:str,wal:bool=False,busy_timeout:float=60.,synchronous:str=None,max_retries:int=8,retry_delay:float=0.1,cached_statements:int=STATEMENT_CACHE_SIZE):
         """Constructor
 
         Constructs API instance for WC production database.
@@ -25,41 +200,107 @@ class wcprod_db:
         ----------
         dbname : str
             Name of the database to connect or create if it does not exist
+
+        wal : bool (optional)
+            If True, use the write-ahead-log journal mode (see connect)
+
+        busy_timeout : float (optional)
+            Seconds to wait for a lock held by another connection
+
+        synchronous : str (optional)
+            If provided, the synchronous level (OFF, NORMAL, FULL or EXTRA)
+
+        max_retries : int (optional)
+            The number of times a write transaction is retried when the database is locked
+
+        retry_delay : float (optional)
+            The initial backoff in seconds between retries, doubled at each retry
+
+        cached_statements : int (optional)
+            The number of prepared statements cached by the connection (see connect)
         """
-        self._conn = sqlite3.connect(dbname)
+        self._conn = connect(dbname,wal,busy_timeout,synchronous,cached_statements)
+        self._connect_args = (wal,busy_timeout,synchronous,cached_statements)
+        self._dbname = None if str(dbname) == ':memory:' else os.path.abspath(dbname)
+        self._max_retries = int(max_retries)
+        self._retry_delay = float(retry_delay)
+        self._retries = dict()
+        # per-connection cache of wcprod_project instances and project table rows
+        self._projects = dict()
+        self._project_meta = dict()
+        self._ranges = dict()
+        # the number of positions of shotgun projects (see _with_geometry)
+        self._num_positions = dict()
+        # projects known to have the filepath_{project} index (only positive results are cached)
+        self._filepath_indexed = set()
+        # shard connections of sharded projects (None for a project stored in the main file)
+        self._shards = dict()
+        # KD-trees of the positions and directions of shotgun projects (see nearest_config)
+        self._kdtrees = dict()
         with closing(self._conn.cursor()) as cur:
             cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='project'")
             result = cur.fetchall()
             if len(result) < 1:
                 cmd  = "CREATE TABLE project "
                 cmd += " (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, rmin FLOAT, rmax FLOAT, zmin FLOAT, zmax FLOAT,"
-                cmd += " gap_space FLOAT, gap_angle FLOAT, n_phi_start INT, num_config INT, num_tables INT, num_photons INT)"
+                cmd += " gap_space FLOAT, gap_angle FLOAT, n_phi_start INT, num_config INT, num_tables INT, num_photons INT, compact INT DEFAULT 0)"
                 cur.execute(cmd)
+        # if the project table has the compact column (a database created before the compact schema
+        # lacks it until a project is registered: its projects are read as compact=0)
+        self._compact_column = False
     
-    def check_integrity(self,project:str):
+    def retry_stats(self):
+        """Report the number of retries of write transactions due to a locked database
+
+        Returns
+        -------
+        dict
+            The number of retries (value) per function name (key)
+        """
+        return dict(self._retries)
+
+    def check_integrity(self,project:str,workers:int=1,incremental:bool=False,since:str=None):
         """Test function for the database integrity
 
-        Runs integrity checks for a project performing read-only access to the database.
+        Runs integrity checks for a project performing read-only access to the project tables.
         The function can be used to check the minimal validity of a project.
         The function is run also within the register_project() function.
+        The time of the check is recorded per table in the integrity_{project} table.
 
         Parameters
         ----------
         project : str
             Name of the project to check the integrity
+
+        workers : int (optional)
+            The number of processes to check the configuration/file tables in parallel,
+            each with its own read-only connection (a database file is required)
+
+        incremental : bool (optional)
+            If True, check only the configuration/file tables modified since their last check
+
+        since : str (optional)
+            If provided, check only the tables modified since this UTC time ("YYYY-MM-DD HH:MM:SS")
+            regardless of the last check
+
+        Returns
+        -------
+        int
+            The number of configuration/file tables checked
         """
         with closing(self._conn.cursor()) as cur:
             if not self.exist_table("project"):
                 raise TableNotFoundError("The 'project' table not found (this may not be the database for wcprod_db)")
             # - project exists in the project table
-            cmd = f"SELECT rmin, rmax, zmin, zmax, gap_space, gap_angle, n_phi_start, num_config, num_tables, num_photons FROM project WHERE name = '{project}'"
-            cur.execute(cmd)
+            cmd  = "SELECT rmin, rmax, zmin, zmax, gap_space, gap_angle, n_phi_start, num_config, num_tables, num_photons,"
+            cmd += f" {'compact' if self._has_compact_column() else '0'} FROM project WHERE name = ?"
+            cur.execute(cmd,(project,))
             res = cur.fetchall()
             if len(res) < 1:
                 raise ProjectNotFoundError(f"Project '{project}' not found in the project table")
             if len(res) > 1:
                 raise ProjectIntegrityError(f"Found more than 1 entry with the name '{project}' in the project table")
-            rmin,rmax,zmin,zmax,gap_space,gap_angle,n_phi_start,num_config,num_tables,num_photons = res[0]
+            rmin,rmax,zmin,zmax,gap_space,gap_angle,n_phi_start,num_config,num_tables,num_photons,compact = res[0]
             # - geo table
             if not self.exist_table(f"geo_{project}"):
                 raise ProjectIntegrityError(f"Geometry table not found for the project '{project}'")
@@ -77,16 +318,16 @@ class wcprod_db:
             zero_ctr = cur.fetchall()[0][0]            
             if not zero_ctr == 0:
                 raise ProjectIntegrityError(f"Found unexpected geo_type values (must be 0 or 1)")
-            if not vox_id_ctr == num_config:
+            if n_phi_start > 0 and not vox_id_ctr == num_config:
                 raise ProjectIntegrityError(f"Voxel ID counters ({vox_id_ctr} is inconsistent with the config count {num_config}")
             if not (pos_id_ctr * dir_id_ctr) == num_config:
                 raise ProjectIntegrityError(f"Position and direction ID counters ({pos_id_ctr} and {dir_id_ctr}) are inconsistent with the config count {num_config}")
             # - map table
             if not self.exist_table(f"map_{project}"):
                 raise ProjectIntegrityError(f"Config mapping table not found for the project '{project}'")
-            cmd = f"SELECT table_id, config_range_min, config_range_max, photon_ctr, target_ctr FROM map_{project}"
+            cmd = f"SELECT table_id, config_range_min, config_range_max, photon_ctr, target_ctr FROM map_{project} ORDER BY table_id"
             cur.execute(cmd)
-            data_map = np.array(cur.fetchall())
+            data_map = np.array(cur.fetchall(),dtype=np.int64).reshape(-1,5)
             if not (len(data_map[:,0]) == len(np.unique(data_map[:,0])) == (data_map[:,0].max()+1)):
                 raise ProjectIntegrityError(f"Duplicate or lacking table_id in map_{project} table")
             if not len(data_map[:,0]) == num_tables:
@@ -94,65 +335,81 @@ class wcprod_db:
             nph_per_table = data_map[:,4] == (data_map[:,2]-data_map[:,1]+1)*num_photons
             if not nph_per_table.sum() == len(data_map[:,0]):
                 raise ProjectIntegrityError(f"Mismatch for the expected number of photons found in the table_ids: {np.where(nph_per_table == False)[0]}")
-            for i in range(len(data_map)):
-                cfgmin,cfgmax = data_map[i,1:3]
-                if not cfgmin < cfgmax:
-                    raise ProjectIntegrityError(f"Configuration range {cfgmin} => {cfgmax} is invalid (table {data_map[i,0]} in map_{project})")
-                if (i+1) < len(data_map) and cfgmax >= data_map[i+1,1]:
-                    raise ProjectIntegrityError(f"Configuration should not overlap: table {data_map[i,0]} range {cfgmin}=>{cfgmax} but the next table starts at {data_map[i+1,1]}")
-            # - cfg table tqdm
-            for index in tqdm(data_map[:,0]):
-                if not self.exist_table(f"cfg_{project}{index}"):
-                    raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} should but does not exist.")
-                cmd = f"SELECT MIN(config_id), MAX(config_id), MAX(pos_id), MAX(dir_id) FROM cfg_{project}{index}"
-                cur.execute(cmd)
-                cfg_min, cfg_max, pos_max, dir_max = cur.fetchall()[0]
-                if cfg_min < data_map[index,1] or data_map[index,2] < cfg_max:
-                    raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has invalid config_id range {cfg_min}=>{cfg_max} (expected: {data_map[index,1:3]})")
-                if pos_id_ctr <= pos_max:
-                    raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected maximum pos_id value {pos_max} (should be < {pos_id_ctr})")
-                if dir_id_ctr <= dir_max:
-                    raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected maximum dir_id value {dir_max} (should be < {dir_id_ctr})")
-                if n_phi_start == 0:
-                    cmd = f"SELECT MIN(ABS(x)), MAX(ABS(x)), MIN(ABS(y)), MAX(ABS(y)), MIN(z), MAX(z), MIN(theta), MAX(theta), MIN(phi), MAX(phi) FROM cfg_{project}{index}"
-                    cur.execute(cmd)
-                    xmin, xmax, ymin, ymax, zmin2, zmax2, tmin, tmax, pmin, pmax = cur.fetchall()[0]
-                    if xmin < rmin or rmax < xmax:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected abs(x) value range {xmin}=>{xmax} (expected {rmin}=>{rmax})")
-                    if ymin < rmin or rmax < ymax:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected abs(y) value range {ymin}=>{ymax} (expected {rmin}=>{rmax})")
-                    if zmin2 < zmin or zmax < zmax2:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected z value range {zmin2}=>{zmax2} (expected {zmin}=>{zmax})")
-                    if tmin < 0 or 180 < tmax:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected theta value range {tmin}=>{tmax} (expected 0=>180)")
-                    if pmin < 0 or 360 < pmax:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected phi value range {pmin}=>{pmax} (expected 0=>360)")
-                else:
-                    cmd = f"SELECT MIN(r0), MAX(r0), MIN(r1), MAX(r1), MIN(phi0), MAX(phi0), MIN(phi1), MAX(phi1), MIN(z0), MAX(z0), MIN(z1), MAX(z1) FROM cfg_{project}{index}"
-                    cur.execute(cmd)
-                    r0min, r0max, r1min, r1max, phi0min, phi0max, phi1min, phi1max, z0min, z0max, z1min, z1max = cur.fetchall()[0]
-                    if r0min < rmin or rmax < r0max:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected r0 value range {r0min}=>{r0max} (expected {rmin}=>{rmax})")
-                    if r1min < rmin or rmax < r1max:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected r1 value range {r1min}=>{r1max} (expected {rmin}=>{rmax})")
-                    if phi0min < 0 or 360 < phi0max:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected phi0 value range {phi0min}=>{phi0max} (expected 0=>360)")
-                    if phi1min < 0 or 360 < phi1max:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected phi1 value range {phi1min}=>{phi1max} (expected 0=>360)")
-                    if z0min < zmin or zmax < z0max:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected z0 value range {z0min}=>{z0max} (expected {zmin}=>{zmax})")
-                    if z1min < zmin or zmax < z1max:
-                        raise ProjectIntegrityError(f"Configuration table cfg_{project}{index} has unexpected z1 value range {z1min}=>{z1max} (expected {zmin}=>{zmax})")
-                    
-                
-                # - file table
-                cmd = f"SELECT MIN(config_id),MAX(config_id) FROM file_{project}{index}"
-                cur.execute(cmd)
-                res = cur.fetchall()
-                if res[0][0] is not None and (res[0][0] < cfg_min or cfg_max < res[0][1]):
-                    raise ProjectIntegrityError(f"File table file_{project}{index} contains unexpected config_id range {res[0][0]}=>{res[0][1]} (expected {cfg_min}=>{cfg_max})")
+            invalid = np.where(~(data_map[:,1] < data_map[:,2]))[0]
+            if len(invalid):
+                i = invalid[0]
+                raise ProjectIntegrityError(f"Configuration range {data_map[i,1]} => {data_map[i,2]} is invalid (table {data_map[i,0]} in map_{project})")
+            overlap = np.where(data_map[:-1,2] >= data_map[1:,1])[0]
+            if len(overlap):
+                i = overlap[0]
+                raise ProjectIntegrityError(f"Configuration should not overlap: table {data_map[i,0]} range {data_map[i,1]}=>{data_map[i,2]} but the next table starts at {data_map[i+1,1]}")
+            # - cfg and file tables (only those modified since the last check in the incremental mode)
+            cur.execute("SELECT CURRENT_TIMESTAMP")
+            started = cur.fetchall()[0][0]
+            last_file_ids = self._last_file_ids(project,data_map[:,0])
+            table_ids = data_map[:,0]
+            if isinstance(incremental,str):
+                incremental = incremental.lower() in ['true','1','yes']
+            if incremental or since is not None:
+                table_ids = self._modified_tables(project,table_ids,last_file_ids,since)
+                print(f'Checking {len(table_ids)}/{len(data_map)} tables modified since the last check')
+            geo = dict(rmin=rmin,rmax=rmax,zmin=zmin,zmax=zmax,n_phi_start=n_phi_start,pos_id_ctr=pos_id_ctr,dir_id_ctr=dir_id_ctr,compact=compact)
+            tasks = [(project,int(index),int(data_map[index,1]),int(data_map[index,2]),geo) for index in table_ids]
+            workers = int(workers)
+            if workers > 1 and self._dbname and os.path.isfile(self._dbname):
+                from concurrent.futures import ProcessPoolExecutor
+                tasks = [(self._table_path(project,task[1]),*task) for task in tasks]
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    for _ in tqdm(pool.map(_check_table_worker,tasks,chunksize=max(1,len(tasks)//(4*workers))),total=len(tasks)):
+                        pass
+            else:
+                for task in tqdm(tasks):
+                    with closing(self._table_conn(project,task[1]).cursor()) as table_cur:
+                        _check_table(table_cur,*task)
+
+            # record the verified tables
+            self._create_integrity_table(cur,project)
+            cmd = f"INSERT OR REPLACE INTO integrity_{project} (table_id, verified, file_id) VALUES (?,?,?)"
+            cur.executemany(cmd,[(int(index),started,last_file_ids[int(index)]) for index in table_ids])
+            self._conn.commit()
+            return len(table_ids)
+
+    def _modified_tables(self,project:str,table_ids,last_file_ids:dict,since:str=None):
+        """List the table IDs modified since the given time or, if not given, since the last integrity check
+
+        All counters of a configuration table are updated together with a new file record, so a table
+        is modified if a file record was added after the last check (or with a Timestamp after since).
+        """
+        modified = []
+        with closing(self._conn.cursor()) as cur:
+            if since is not None:
+                for index in table_ids:
+                    res = self._table_conn(project,index).execute(f"SELECT Timestamp FROM file_{project}{index} WHERE file_id = ?",(last_file_ids[int(index)],)).fetchall()
+                    if len(res) and res[0][0] >= str(since):
+                        modified.append(index)
+                return np.array(modified,dtype=np.int64)
+
+            verified = dict()
+            if self.exist_table(f"integrity_{project}"):
+                cur.execute(f"SELECT table_id, file_id FROM integrity_{project}")
+                verified = dict(cur.fetchall())
+            for index in table_ids:
+                if not int(index) in verified or verified[int(index)] < last_file_ids[int(index)]:
+                    modified.append(index)
+        return np.array(modified,dtype=np.int64)
+
+    def _last_file_ids(self,project:str,table_ids):
+        """Retrieve the latest file_id (0 for an empty table) of each file table"""
+        last = dict()
+        for index in table_ids:
+            res = self._table_conn(project,index).execute(f"SELECT MAX(file_id) FROM file_{project}{index}").fetchall()
+            last[int(index)] = res[0][0] or 0
+        return last
+
+    def _create_integrity_table(self,cur,project:str):
+        """Create the table recording the last integrity check time per table if it does not exist yet"""
+        cur.execute(f"CREATE TABLE IF NOT EXISTS integrity_{project} (table_id INTEGER PRIMARY KEY, verified DATETIME, file_id INT)")
 
-    
     def list_all_tables(self):
         """List all tables in the database
 
@@ -186,7 +443,9 @@ class wcprod_db:
     def get_project(self,project:str):
         """Retrieve project information from the database
 
-        Creates wcprod_project instance filled with information from the database
+        Creates wcprod_project instance filled with information from the database.
+        The instance is cached by this API instance and shared among calls until
+        the project is registered or dropped again through the same instance.
 
         Parameters
         ----------
@@ -198,36 +457,82 @@ class wcprod_db:
         wcprod_project
             Instance filled with information from the database
         """  
-        with closing(self._conn.cursor()) as cur:
+        if project in self._projects:
+            return self._projects[project]
+
+        meta = self.get_project_meta(project)
+        if meta is None:
+            return None
+
+        p=wcprod_project()
+        p._project = project
+        p._zmin, p._zmax, p._rmin, p._rmax = meta['zmin'], meta['zmax'], meta['rmin'], meta['rmax']
+        p._gap_space, p._gap_angle = meta['gap_space'], meta['gap_angle']
+        p._n_phi_start, p._num_photons = meta['n_phi_start'], meta['num_photons']
+
+        p._positions  = self.list_positions(project).reshape(-1,4)[:,0:3]
+        p._directions = self.list_directions(project).reshape(-1,3)[:,0:2]
+        p._voxels = self.list_voxels(project).reshape(-1,7)[:,0:6]
+        p._configs = None
+        p._partition = self.get_partition(project) if self.exist_table(f"partition_{project}") else dict()
+
+        self._projects[project] = p
+        return p
+
+    def get_project_meta(self,project:str):
+        """Retrieve the project table entry without the geometry
 
-            p=wcprod_project()
+        Lightweight alternative to get_project for reading the project parameters.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        Returns
+        -------
+        dict
+            The project table columns (name, rmin, rmax, zmin, zmax, gap_space, gap_angle,
+            n_phi_start, num_config, num_tables, num_photons, compact). None if the project does not exist.
+        """
+        if project in self._project_meta:
+            return self._project_meta[project]
 
-            cur.execute(f"SELECT zmin,zmax,rmin,rmax,gap_space,gap_angle,n_phi_start,num_photons FROM project WHERE name='{project}' LIMIT 1")
+        keys = ['name','rmin','rmax','zmin','zmax','gap_space','gap_angle','n_phi_start','num_config','num_tables','num_photons','compact']
+        columns = keys if self._has_compact_column() else keys[:-1]+['0']
+        with closing(self._conn.cursor()) as cur:
+            cur.execute(f"SELECT {','.join(columns)} FROM project WHERE name=? LIMIT 1",(project,))
             res=cur.fetchall()
             if len(res)<1:
                 return None
-            res=res[0]
-            p._project = project
-            p._zmin, p._zmax, p._rmin, p._rmax = res[0:4]
-            p._gap_space, p._gap_angle, p._n_phi_start, p._num_photons = res[4:]
-
-            p._positions  = self.list_positions(project)[:,0:3]
-            p._directions = self.list_directions(project)[:,0:2]
-            p._voxels = self.list_voxels(project)[:,0:6]
-
-            from wcprod.utils import coordinates, volumes
-            if p._n_phi_start == 0:
-                p._configs = coordinates(p.positions,p.directions)
-            else:
-                p._configs = volumes(p.voxels)
-
-            return p
+            self._project_meta[project] = dict(zip(keys,res[0]))
+            return self._project_meta[project]
+
+    def _has_compact_column(self):
+        """Check (and cache) if the project table has the compact column (only positive results are cached)"""
+        if not self._compact_column:
+            cmd = "SELECT name FROM pragma_table_info('project') WHERE name='compact'"
+            self._compact_column = len(self._conn.execute(cmd).fetchall()) > 0
+        return self._compact_column
+
+    def _invalidate(self,project:str):
+        """Drop cached information about the project"""
+        self._projects.pop(project,None)
+        self._project_meta.pop(project,None)
+        self._ranges.pop(project,None)
+        self._num_positions.pop(project,None)
+        self._filepath_indexed.discard(project)
+        self._kdtrees.pop(project,None)
+        shards = self._shards.pop(project,None)
+        if shards is not None:
+            for conn in shards[1]:
+                conn.close()
     
 
     def get_config(self,project:str,config_id:int):
         """Retrieve a job configuration from the database
 
-        Retrieve a job configuration (x,y,z,theta,phi) and production info (file and photon count produced so far).
+        Retrieve a job configuration (x,y,z,theta,phi) or (r0,r1,phi0,phi1,z0,z1) and production info (file and photon count produced so far).
 
         Parameters
         ----------
@@ -237,26 +542,93 @@ class wcprod_db:
         Returns
         -------
         dict
-            Contains (x,y,z,theta,phi) for running Geant4, config ID, and the number of files/photons produced so far.
+            Contains (x,y,z,theta,phi) or (r0,r1,phi0,phi1,z0,z1) for running Geant4, config ID, and the number of files/photons produced so far.
         """
-        with closing(self._conn.cursor()) as cur:
-            if self.get_project(project) is None:
-                print('Project',project,'does not exist')
-                return None
-            table_index = self.table_id(project,config_id)
-            cur.execute(f'SELECT config_id,x,y,z,theta,phi,pos_id,dir_id,file_ctr,photon_ctr FROM cfg_{project}{table_index} WHERE config_id={config_id}')
+        meta = self.get_project_meta(project)
+        if meta is None:
+            print('Project',project,'does not exist')
+            return None
+        if meta['compact']:
+            keys = ['config_id','file_ctr','photon_ctr']
+        elif meta['n_phi_start'] == 0:
+            keys = ['config_id']+SHOTGUN_KEYS+['pos_id','dir_id','file_ctr','photon_ctr']
+        else:
+            keys = ['config_id']+VOXEL_KEYS+['pos_id','dir_id','file_ctr','photon_ctr']
+        table_index = self.table_id(project,config_id)
+        with closing(self._table_conn(project,table_index).cursor()) as cur:
+            cur.execute(f'SELECT {",".join(keys)} FROM cfg_{project}{table_index} WHERE config_id=?',(int(config_id),))
             res=cur.fetchall()
             if len(res)<1:
                 print('Project',project,'config_id',config_id,'does not exist')
                 return None
-            res=res[0]
-            res=dict(config_id=res[0],
-                     x=res[1],y=res[2],z=res[3],
-                     theta=res[4],phi=res[5],
-                     pos_id=res[6],dir_id=res[7],
-                     file_ctr=res[8],
-                     photon_ctr=res[9],)
-            return res
+            if meta['compact']:
+                return self._with_geometry(project,[res[0]],['pos_id','dir_id','file_ctr','photon_ctr'])[0]
+            return dict(zip(keys,res[0]))
+
+    def _with_geometry(self,project:str,rows:list,keys:list):
+        """Make configuration dicts for a compact project
+
+        The geometry is derived from config_id and the geometry table. Only the geometry rows
+        of the given configurations are read, unless the project is cached (get_project).
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        rows : list
+            Tuples of config_id followed by the values of the keys other than pos_id/dir_id
+
+        keys : list
+            The keys that follow the geometry in the returned dicts (pos_id/dir_id are optional)
+
+        Returns
+        -------
+        list
+            List of dict with config_id, the geometry and the keys
+        """
+        shotgun = self.get_project_meta(project)['n_phi_start'] == 0
+        config_ids = np.array([row[0] for row in rows],dtype=np.int64)
+        if project in self._projects:
+            geometry = self._projects[project].config_rows(config_ids)
+        elif shotgun:
+            # same layout as utils.coordinates_at
+            if not project in self._num_positions:
+                cmd = f"SELECT COUNT(*) FROM geo_{project} WHERE geo_type = 0"
+                self._num_positions[project] = self._conn.execute(cmd).fetchone()[0]
+            pos_ids = config_ids % self._num_positions[project]
+            dir_ids = config_ids // self._num_positions[project]
+            geometry = np.column_stack([self._geo_rows(project,0,pos_ids,3),self._geo_rows(project,1,dir_ids,2),pos_ids,dir_ids])
+        else:
+            # same layout as utils.volumes_at
+            geometry = np.column_stack([self._geo_rows(project,2,config_ids,6),config_ids])
+        geo_keys = SHOTGUN_KEYS if shotgun else VOXEL_KEYS
+        values = [key for key in keys if not key in ['pos_id','dir_id']]
+        configs = []
+        for row, geo in zip(rows,geometry.tolist()):
+            cfg = dict(config_id=row[0])
+            cfg.update(zip(geo_keys,geo))
+            if 'pos_id' in keys:
+                cfg['pos_id'] = int(geo[len(geo_keys)])
+            if 'dir_id' in keys:
+                cfg['dir_id'] = int(geo[len(geo_keys)+1]) if shotgun else 0
+            cfg.update(zip(values,row[1:]))
+            configs.append(cfg)
+        return configs
+
+    def _geo_rows(self,project:str,geo_type:int,geo_ids,num_values:int):
+        """Read the values (val0 to val{num_values-1}) of the geometry table rows with the geo_type and geo_ids (in order)"""
+        geo_ids = np.asarray(geo_ids,dtype=np.int64)
+        unique = np.unique(geo_ids).tolist()
+        values = dict()
+        columns = ','.join([f'val{i}' for i in range(num_values)])
+        with closing(self._conn.cursor()) as cur:
+            for start in range(0,len(unique),SQLITE_MAX_VARIABLES-1):
+                chunk = unique[start:start+SQLITE_MAX_VARIABLES-1]
+                cmd = f"SELECT geo_id,{columns} FROM geo_{project} WHERE geo_type = ? AND geo_id IN ({','.join(['?']*len(chunk))})"
+                cur.execute(cmd,[geo_type]+chunk)
+                values.update({row[0]: row[1:] for row in cur.fetchall()})
+        return np.array([values[geo_id] for geo_id in geo_ids.tolist()],dtype=float).reshape(-1,num_values)
     
 
     def list_positions(self,project:str,pos_id:int=None):
@@ -280,9 +652,11 @@ class wcprod_db:
         """
         with closing(self._conn.cursor()) as cur:
             cmd = f"SELECT val0,val1,val2,geo_id FROM geo_{project} WHERE geo_type = 0 "
-            if pos_id:
-                cmd += f"AND geo_id={pos_id} "
-            cur.execute(cmd)
+            if pos_id is not None:
+                cmd += "AND geo_id=? "
+                cur.execute(cmd,(int(pos_id),))
+            else:
+                cur.execute(cmd)
             return np.array(cur.fetchall()).astype(float)
 
     
@@ -308,9 +682,11 @@ class wcprod_db:
         """
         with closing(self._conn.cursor()) as cur:
             cmd = f"SELECT val0,val1,geo_id FROM geo_{project} WHERE geo_type = 1 "
-            if dir_id:
-                cmd += f"AND geo_id={dir_id} "
-            cur.execute(cmd)
+            if dir_id is not None:
+                cmd += "AND geo_id=? "
+                cur.execute(cmd,(int(dir_id),))
+            else:
+                cur.execute(cmd)
             return np.array(cur.fetchall()).astype(float)
 
     def list_voxels(self,project:str,vox_id:int=None):
@@ -334,12 +710,193 @@ class wcprod_db:
         """
         with closing(self._conn.cursor()) as cur:
             cmd = f"SELECT val0,val1,val2,val3,val4,val5,geo_id FROM geo_{project} WHERE geo_type = 2 "
-            if vox_id:
-                cmd += f"AND geo_id={vox_id} "
-            cur.execute(cmd)
+            if vox_id is not None:
+                cmd += "AND geo_id=? "
+                cur.execute(cmd,(int(vox_id),))
+            else:
+                cur.execute(cmd)
             return np.array(cur.fetchall()).astype(float)
 
-    
+    def build_rtree(self,project:str):
+        """Build the R-tree spatial index of the project geometry
+
+        Creates (or re-creates) the rtree_{project} virtual table over the (r, phi, z) bounds of the
+        voxels (voxel mode) or of the positions (shotgun mode) used by query_region.
+        The index is built by register_project: use this function for a project registered before.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        Returns
+        -------
+        int
+            The number of voxels or positions indexed
+        """
+        meta = self.get_project_meta(project)
+        if meta is None:
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
+        if meta['n_phi_start'] > 0:
+            bounds = self._rtree_bounds(self.list_voxels(project),True)
+        else:
+            bounds = self._rtree_bounds(self.list_positions(project),False)
+        with closing(self._conn.cursor()) as cur:
+            with _immediate(self._conn):
+                cur.execute(f"DROP TABLE IF EXISTS rtree_{project}")
+                self._create_rtree(cur,project,bounds)
+        return len(bounds)
+
+    def query_region(self,project:str,rmin:float=None,rmax:float=None,zmin:float=None,zmax:float=None,phimin:float=None,phimax:float=None):
+        """List the configurations in a cylindrical region of the detector
+
+        Uses the R-tree index of the geometry (see build_rtree, built on the first call if missing).
+        A position (shotgun mode) is selected if it lies within the region (bounds included), and a
+        voxel (voxel mode) if it overlaps the region (voxels are half-open, [r0,r1) x [phi0,phi1) x [z0,z1)).
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        rmin, rmax : float (optional)
+            The radial range (default: unbounded)
+
+        zmin, zmax : float (optional)
+            The z range (default: unbounded)
+
+        phimin, phimax : float (optional)
+            The azimuthal range in degrees in [0,360]. The range wraps around 360 if phimin > phimax.
+
+        Returns
+        -------
+        ndarray
+            The configuration IDs (sorted). In the shotgun mode, all directions at the selected positions.
+        """
+        meta = self.get_project_meta(project)
+        if meta is None:
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
+        if not self.exist_table(f"rtree_{project}"):
+            print(f'Building the R-tree index of the project {project}')
+            self.build_rtree(project)
+
+        voxel = meta['n_phi_start'] > 0
+        bound = lambda val, default: default if val is None else float(val)
+        ranges = dict(r=(bound(rmin,-np.inf),bound(rmax,np.inf)),z=(bound(zmin,-np.inf),bound(zmax,np.inf)))
+        phimin, phimax = bound(phimin,0.), bound(phimax,360.)
+        phi_ranges = [(phimin,phimax)] if phimin <= phimax else [(phimin,360.),(0.,phimax)]
+
+        # R-tree (conservative single precision) bounds followed by the exact bounds (auxiliary columns)
+        def overlap(key,lo,hi,args):
+            args += [lo,hi,hi,lo]
+            return f"{key}max >= ? AND {key}min <= ? AND {key}0 <= ? AND {key}1 {'>' if voxel else '>='} ?"
+        ids = []
+        with closing(self._conn.cursor()) as cur:
+            for phi_range in phi_ranges:
+                args = []
+                conds = [overlap('r',*ranges['r'],args),overlap('z',*ranges['z'],args),overlap('phi',*phi_range,args)]
+                cur.execute(f"SELECT geo_id FROM rtree_{project} WHERE {' AND '.join(conds)}",args)
+                ids += [row[0] for row in cur.fetchall()]
+            if voxel:
+                return np.unique(np.array(ids,dtype=np.int64))
+            cur.execute(f"SELECT COUNT(*) FROM geo_{project} WHERE geo_type = 0")
+            num_positions = cur.fetchone()[0]
+            cur.execute(f"SELECT COUNT(*) FROM geo_{project} WHERE geo_type = 1")
+            num_directions = cur.fetchone()[0]
+        pos_ids = np.unique(np.array(ids,dtype=np.int64))
+        return np.sort((pos_ids[None,:] + num_positions*np.arange(num_directions,dtype=np.int64)[:,None]).ravel())
+
+    def locate_voxels(self,project:str,xyz_array):
+        """Find the voxel (= configuration ID) that contains each point
+
+        Vectorized inversion of the voxel geometry (see utils.locate_voxels): the ring and the
+        z layer are found by a binary search of the edges and the phi segment arithmetically.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project (voxel mode) to access in the database
+
+        xyz_array : ndarray
+            Shape (N,3) points
+
+        Returns
+        -------
+        ndarray
+            Shape (N,) voxel IDs (-1 for a point outside the voxels)
+        """
+        p = self.get_project(project)
+        if p.n_phi_start == 0:
+            raise ValueError(f"Project '{project}' has no voxels (use nearest_config)")
+        return utils.locate_voxels(p.voxels,xyz_array)
+
+    def nearest_config(self,project:str,xyz,dirs):
+        """Find the configuration with the nearest position and direction
+
+        The nearest position and the nearest direction (angle) are found with KD-trees (requires scipy).
+        Directions repeated in the grid (e.g. all phi at theta=0 or 180) resolve to the lowest dir_id.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project (shotgun mode) to access in the database
+
+        xyz : ndarray
+            Shape (N,3) points
+
+        dirs : ndarray
+            Shape (N,3) direction vectors, or (N,2) directions (theta, phi) in degrees
+
+        Returns
+        -------
+        ndarray
+            Shape (N,) configuration IDs
+        """
+        p = self.get_project(project)
+        if p.n_phi_start > 0:
+            raise ValueError(f"Project '{project}' is in the voxel mode (use locate_voxels)")
+        if not project in self._kdtrees:
+            from scipy.spatial import cKDTree
+            # one tree entry per distinct direction (the first = lowest dir_id), so that the poles do not tie
+            units = utils.direction_vectors(p.directions)
+            _, dir_map = np.unique(np.round(units,12),axis=0,return_index=True)
+            self._kdtrees[project] = (cKDTree(p.positions),cKDTree(units[dir_map]),dir_map)
+        pos_tree, dir_tree, dir_map = self._kdtrees[project]
+
+        xyz = np.asarray(xyz,dtype=float).reshape(-1,3)
+        dirs = np.asarray(dirs,dtype=float)
+        if dirs.shape[-1] == 2:
+            dirs = utils.direction_vectors(dirs)
+        else:
+            dirs = dirs.reshape(-1,3)
+            dirs = dirs / np.linalg.norm(dirs,axis=1,keepdims=True)
+        if not len(xyz) == len(dirs):
+            raise ValueError(f"The number of points ({len(xyz)}) and directions ({len(dirs)}) must match")
+        _, pos_ids = pos_tree.query(xyz)
+        _, dir_ids = dir_tree.query(dirs)
+        return pos_ids.astype(np.int64) + len(p.positions)*dir_map[dir_ids].astype(np.int64)
+
+    def _rtree_bounds(self,geo,voxel:bool):
+        """Compute (geo_id, r0, r1, phi0, phi1, z0, z1) of the voxels (N,6+1) or positions (N,3+1) listed by list_voxels/list_positions"""
+        bounds = np.zeros(shape=(len(geo),7),dtype=float)
+        if voxel:
+            bounds[:,0] = geo[:,6]
+            bounds[:,1:7] = geo[:,0:6]
+        else:
+            bounds[:,0] = geo[:,3]
+            bounds[:,1] = bounds[:,2] = np.hypot(geo[:,0],geo[:,1])
+            bounds[:,3] = bounds[:,4] = np.mod(np.degrees(np.arctan2(geo[:,1],geo[:,0])),360.)
+            bounds[:,5] = bounds[:,6] = geo[:,2]
+        return bounds
+
+    def _create_rtree(self,cur,project:str,bounds):
+        """Create and fill the R-tree index of the geometry (see build_rtree)"""
+        cmd  = f"CREATE VIRTUAL TABLE rtree_{project} USING rtree(geo_id, rmin, rmax, phimin, phimax, zmin, zmax,"
+        cmd += " +r0 FLOAT, +r1 FLOAT, +phi0 FLOAT, +phi1 FLOAT, +z0 FLOAT, +z1 FLOAT)"
+        cur.execute(cmd)
+        cmd = f"INSERT INTO rtree_{project} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)"
+        cur.executemany(cmd,((int(b[0]),*b[1:],*b[1:]) for b in bounds.tolist()))
+
     def get_random_config(self,project:str,prioritize:bool=True,size:int=1000):
         """Retrieve a job configuration to run in the production
 
@@ -362,8 +919,8 @@ class wcprod_db:
         dict
             Contains config/table IDs, (x,y,z,theta,phi)-or-(r0,r1,phi0,phi1,z0,z1), and the number of files produced so far
         """
-        p = self.get_project(project)
-        max_photons = p.num_photons
+        meta = self.get_project_meta(project)
+        max_photons = meta['num_photons']
         with closing(self._conn.cursor()) as cur:
             table_id = -1
             if not prioritize:
@@ -376,25 +933,30 @@ class wcprod_db:
                     print("No result to be prioritized: the production is finished.")
                     return None
                 table_id = res[0][0]
-            if p._n_phi_start == 0:
-                cmd = f"SELECT config_id,x,y,z,theta,phi,file_ctr FROM cfg_{project}{table_id} WHERE photon_ctr < {max_photons}"
+            if meta['compact']:
+                cmd = f"SELECT config_id,file_ctr FROM cfg_{project}{table_id} WHERE photon_ctr < ?"
+
+            elif meta['n_phi_start'] == 0:
+                cmd = f"SELECT config_id,x,y,z,theta,phi,file_ctr FROM cfg_{project}{table_id} WHERE photon_ctr < ?"
         
             else:
-                cmd = f"SELECT config_id,r0,r1,phi0,phi1,z0,z1,file_ctr FROM cfg_{project}{table_id} WHERE photon_ctr < {max_photons}"
+                cmd = f"SELECT config_id,r0,r1,phi0,phi1,z0,z1,file_ctr FROM cfg_{project}{table_id} WHERE photon_ctr < ?"
 
                 
             if prioritize:
-                cmd += f" ORDER BY photon_ctr ASC"
-            if size>0:
-                cmd += f" LIMIT {size}"
-            cur.execute(cmd)
-            res = cur.fetchall()
+                cmd += " ORDER BY photon_ctr ASC"
+            cmd += " LIMIT ?"
+            res = self._table_conn(project,table_id).execute(cmd,(max_photons,int(size) if int(size)>0 else -1)).fetchall()
             
             seed = round(time.time()*1.e6) % (2**32)
             np.random.seed(seed)
             res = res[int(np.random.random()*len(res))]
 
-            if p._n_phi_start == 0:                
+            if meta['compact']:
+                cfg = self._with_geometry(project,[res],['file_ctr'])[0]
+                cfg['table_id'] = table_id
+                return cfg
+            elif meta['n_phi_start'] == 0:
                 return dict(config_id=res[0],table_id=table_id,
                             x=res[1],y=res[2],z=res[3],theta=res[4],phi=res[5],
                             file_ctr=res[6],
@@ -405,6 +967,7 @@ class wcprod_db:
                             file_ctr=res[7],
                             )
 
+    @retry_on_busy
     def lock_table(self,project:str,table_id:int=None):
         """Lock tables with the specified table ID
 
@@ -427,13 +990,14 @@ class wcprod_db:
                 cur.execute(cmd)
 
             else:
-                cmd = f"UPDATE map_{project} SET lock = 1 WHERE table_id = {int(table_id)}"
-                cur.execute(cmd)
+                cmd = f"UPDATE map_{project} SET lock = 1 WHERE table_id = ?"
+                cur.execute(cmd,(int(table_id),))
 
             # finish transaction
             self._conn.commit()
 
 
+    @retry_on_busy
     def unlock_table(self,project:str,table_id:int=None):
         """Unlock tables with the specified table ID
 
@@ -456,8 +1020,8 @@ class wcprod_db:
                 cur.execute(cmd)
 
             else:
-                cmd = f"UPDATE map_{project} SET lock = 0 WHERE table_id = {int(table_id)}"
-                cur.execute(cmd)
+                cmd = f"UPDATE map_{project} SET lock = 0 WHERE table_id = ?"
+                cur.execute(cmd,(int(table_id),))
 
             # finish transaction
             self._conn.commit()
@@ -465,8 +1029,9 @@ class wcprod_db:
     def get_table_ids(self, project:str, cluster:str):
         """Retrieve the table IDs for the specified project and cluster
 
-        Retrieve the table IDs for the specified project and cluster.
-        The cluster is a string that can be used to group tables for a specific purpose.
+        Retrieve the table IDs assigned to the cluster in the assignment_{project} table
+        (see set_partition and rebalance). For a project without partition, the tables are split
+        in contiguous blocks according to DEFAULT_PARTITION.
 
         Parameters
         ----------
@@ -481,27 +1046,447 @@ class wcprod_db:
         list
             The list of table IDs
         """
-        all_table_ids = np.linspace(0, self.table_count(project), self.table_count(project))
-        portion = int(0.15*len(all_table_ids))
-        if cluster.lower() == "s3df":
-            return all_table_ids[5*portion:]
-        elif cluster.lower() == "cern":
-            return all_table_ids[:portion]
-        elif cluster.lower() == "sukap":
-            return all_table_ids[portion:2*portion]
-        elif cluster.lower() == "grid":
-            return all_table_ids[2*portion:3*portion]
-        elif cluster.lower() == "idark":
-            return all_table_ids[3*portion:4*portion]
-        elif cluster.lower() == "beluga":
-            return all_table_ids[4*portion:5*portion]
-        else:
-            raise ValueError(f"Invalid cluster name: {cluster}")
+        cluster = str(cluster).lower()
+        partition = self.get_partition(project)
+        if not cluster in partition:
+            raise ValueError(f"Invalid cluster name: {cluster} (partition: {list(partition)})")
+        if self.exist_table(f"assignment_{project}"):
+            with closing(self._conn.cursor()) as cur:
+                cur.execute(f"SELECT table_id FROM assignment_{project} WHERE cluster = ? ORDER BY table_id",(cluster,))
+                return [row[0] for row in cur.fetchall()]
+        bounds = self._partition_bounds(list(partition.values()),self.table_count(project))
+        index = list(partition).index(cluster)
+        return list(range(bounds[index],bounds[index+1]))
+
+    def get_partition(self,project:str):
+        """Retrieve the partition of the tables among the clusters
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        Returns
+        -------
+        dict
+            The weight (value) per cluster name (key). DEFAULT_PARTITION if the project has no partition.
+        """
+        if not self.exist_table(f"partition_{project}"):
+            return dict(DEFAULT_PARTITION)
+        with closing(self._conn.cursor()) as cur:
+            cur.execute(f"SELECT cluster, weight FROM partition_{project} ORDER BY rowid")
+            return dict(cur.fetchall())
+
+    @retry_on_busy
+    def set_partition(self,project:str,partition):
+        """Define the clusters of a project and assign the tables to them
+
+        The tables are split in contiguous blocks with sizes proportional to the cluster weights.
+        The weights are stored in the partition_{project} table and the assignment of each table
+        in the assignment_{project} table (see get_table_ids). Use rebalance to move unfinished
+        tables according to the measured throughput of each cluster.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        partition : dict or str
+            The weight (value) per cluster name (key), or a YAML file (or string) of the same mapping
+
+        Returns
+        -------
+        dict
+            The number of tables (value) assigned to each cluster (key)
+        """
+        if not self.exist_project(project):
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
+        if isinstance(partition,str):
+            if os.path.isfile(partition):
+                partition = yaml.safe_load(open(partition,'r'))
+            else:
+                partition = yaml.safe_load(partition)
+        if not isinstance(partition,dict) or len(partition) < 1:
+            raise ValueError(f"Invalid partition (must be a mapping of cluster name => weight): {partition}")
+        partition = {str(cluster).lower(): float(weight) for cluster,weight in partition.items()}
+        if min(partition.values()) < 0 or sum(partition.values()) <= 0:
+            raise ValueError(f"Partition weights must be non-negative with a positive sum: {partition}")
+
+        clusters = list(partition)
+        bounds = self._partition_bounds(list(partition.values()),self.table_count(project))
+        assignment = [(table_id,cluster) for i,cluster in enumerate(clusters) for table_id in range(bounds[i],bounds[i+1])]
+        with closing(self._conn.cursor()) as cur:
+            with _immediate(self._conn):
+                self._create_partition_tables(cur,project)
+                cur.execute(f"DELETE FROM partition_{project}")
+                cur.executemany(f"INSERT INTO partition_{project} (cluster,weight) VALUES (?,?)",partition.items())
+                cur.execute(f"DELETE FROM assignment_{project}")
+                cur.executemany(f"INSERT INTO assignment_{project} (table_id,cluster) VALUES (?,?)",assignment)
+        # the cached project carries the partition
+        self._projects.pop(project,None)
+        return {cluster: int(bounds[i+1]-bounds[i]) for i,cluster in enumerate(clusters)}
+
+    @retry_on_busy
+    def rebalance(self,project:str,window:float=24.):
+        """Reassign the unfinished tables to the clusters according to their measured throughput
+
+        The throughput of a cluster is the number of photons in the files registered in the last
+        window hours in the tables currently assigned to it. A cluster without files in the window
+        is given the throughput of its partition weight at the average photons per hour per weight
+        of the other clusters. The unfinished tables are then split in contiguous blocks so that
+        the remaining photons of each cluster are proportional to its throughput. Finished tables
+        keep their assignment.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        window : float (optional)
+            The time window in hours to measure the throughput
+
+        Returns
+        -------
+        dict
+            photons_per_hour and the number of unfinished tables (value) per cluster (key).
+            Empty if no file was registered in the window (the assignment is kept).
+        """
+        if not self.exist_project(project):
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
+        window = float(window)
+        if window <= 0:
+            raise ValueError(f"The throughput window must be positive (given: {window})")
+
+        partition = self.get_partition(project)
+        owner = dict()
+        for cluster in partition:
+            owner.update({table_id: cluster for table_id in self.get_table_ids(project,cluster)})
+
+        with closing(self._conn.cursor()) as cur:
+            cur.execute(f"SELECT table_id, photon_ctr, target_ctr FROM map_{project} ORDER BY table_id")
+            data_map = np.array(cur.fetchall(),dtype=np.int64).reshape(-1,3)
+
+        # photons per hour of each cluster in the window (file tables are indexed by Timestamp)
+        start = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=window)).strftime('%Y-%m-%d %H:%M:%S')
+        rates = dict.fromkeys(partition,0.)
+        for table_id in data_map[:,0]:
+            if not int(table_id) in owner:
+                continue
+            cmd = f"SELECT TOTAL(photon_ctr) FROM file_{project}{table_id} WHERE Timestamp >= ?"
+            rates[owner[int(table_id)]] += self._table_conn(project,table_id).execute(cmd,(start,)).fetchone()[0] / window
+        measured = [cluster for cluster in partition if rates[cluster] > 0]
+        if len(measured) < 1:
+            print(f'No file registered in the last {window} hours: keeping the current assignment')
+            return dict()
+        weight = sum([partition[cluster] for cluster in measured])
+        rate_per_weight = sum([rates[cluster] for cluster in measured]) / weight if weight > 0 else 0.
+        speed = np.array([rates[c] if rates[c] > 0 else partition[c]*rate_per_weight for c in partition])
+
+        # split the remaining photons of the unfinished tables in proportion to the throughput
+        unfinished = data_map[data_map[:,1] < data_map[:,2]]
+        remaining = np.cumsum(unfinished[:,2]-unfinished[:,1])
+        middle = remaining - (unfinished[:,2]-unfinished[:,1])/2.
+        edges = np.cumsum(speed)[:-1] / speed.sum() * (remaining[-1] if len(remaining) else 0)
+        clusters = list(partition)
+        assigned = [clusters[i] for i in edges.searchsorted(middle,side='right')]
+        owner.update({int(table_id): cluster for table_id,cluster in zip(unfinished[:,0],assigned)})
+
+        with closing(self._conn.cursor()) as cur:
+            with _immediate(self._conn):
+                self._create_partition_tables(cur,project)
+                cur.execute(f"SELECT COUNT(*) FROM partition_{project}")
+                if cur.fetchone()[0] < 1:
+                    cur.executemany(f"INSERT INTO partition_{project} (cluster,weight) VALUES (?,?)",partition.items())
+                cur.executemany(f"INSERT OR REPLACE INTO assignment_{project} (table_id,cluster) VALUES (?,?)",owner.items())
+        return {c: dict(photons_per_hour=float(rates[c]),tables=assigned.count(c)) for c in clusters}
+
+    def _partition_bounds(self,weights:list,num_tables:int):
+        """Split num_tables into contiguous blocks in proportion to the weights (returns len(weights)+1 boundaries)
+
+        Each block but the last has int(weight/total*num_tables) tables and the last one the rest,
+        which reproduces the split of DEFAULT_PARTITION in earlier versions (int(0.15*num_tables) tables
+        for each cluster but s3df).
+        """
+        weights = np.asarray(weights,dtype=float)
+        bounds = [0]
+        for weight in weights[:-1]:
+            bounds.append(bounds[-1] + int(weight * num_tables / weights.sum()))
+        return bounds + [int(num_tables)]
+
+    def _create_partition_tables(self,cur,project:str):
+        """Create the partition and table assignment tables for the project if they do not exist yet"""
+        cur.execute(f"CREATE TABLE IF NOT EXISTS partition_{project} (cluster TEXT PRIMARY KEY, weight FLOAT)")
+        cur.execute(f"CREATE TABLE IF NOT EXISTS assignment_{project} (table_id INTEGER PRIMARY KEY, cluster TEXT)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS assignment_{project}_cluster ON assignment_{project} (cluster)")
+
+    def claim_config(self,project:str,cluster:str=None,job_id:str=None,ttl:float=86400.,size:int=1000):
+        """Claim a job configuration to run in the production
+
+        Pick a configuration and lease it to the caller in one BEGIN IMMEDIATE transaction.
+        The lease is recorded in the lease_{project} table and excludes the configuration
+        from later claims until it is released (release_config) or expires after ttl seconds.
+        Replaces the get_random_config + lock_table/unlock_table sequence for batch jobs.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        cluster : str (optional)
+            If provided, limit the claim to the tables assigned to the cluster (see get_table_ids)
+
+        job_id : str (optional)
+            An identifier of the job claiming the configuration (e.g. the batch job ID)
+
+        ttl : float (optional)
+            The lease lifetime in seconds
+
+        size : int (optional)
+            The number of least-produced configurations to perform a random sampling
+
+        Returns
+        -------
+        dict
+            Same contents as get_random_config with the lease_id and lease expiration time added.
+            None if there is no configuration left to be claimed.
+        """
+        res = self.claim_configs(project,1,cluster,job_id,ttl,size)
+        if len(res)<1:
+            return None
+        return res[0]
+
+    @retry_on_busy
+    def claim_configs(self,project:str,n:int,cluster:str=None,job_id:str=None,ttl:float=86400.,size:int=1000,stagger:bool=False):
+        """Claim multiple job configurations to run in the production
+
+        Batch version of claim_config: pick and lease up to n distinct configurations in one transaction.
+        Configurations are sampled from the least-produced tables first, moving on to the next table
+        when a table runs out of configurations that can be claimed.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        n : int
+            The number of configurations to claim
+
+        cluster : str (optional)
+            If provided, limit the claim to the tables assigned to the cluster (see get_table_ids)
+
+        job_id : str (optional)
+            An identifier of the job claiming the configurations (e.g. the batch job ID)
+
+        ttl : float (optional)
+            The lease lifetime in seconds
+
+        size : int (optional)
+            The number of least-produced configurations per table to perform a random sampling
+
+        stagger : bool (optional)
+            If True, the i-th lease (from 0) first expires after (i+1)*ttl seconds, for a job that
+            runs the configurations one after the other (heartbeats extend each lease by ttl)
+
+        Returns
+        -------
+        list
+            List of dict (see claim_config). Can be shorter than n if the production is nearly finished.
+        """
+        n = int(n)
+        if isinstance(stagger,str):
+            stagger = stagger.lower() in ['true','1','yes']
+        with closing(self._conn.cursor()) as cur:
+            meta = self.get_project_meta(project)
+            if meta is None:
+                raise ProjectNotFoundError(f"Project '{project}' not found in the project table")
+            max_photons = meta['num_photons']
+            if meta['compact']:
+                keys = ['config_id','file_ctr']
+            elif meta['n_phi_start'] == 0:
+                keys = ['config_id']+SHOTGUN_KEYS+['file_ctr']
+            else:
+                keys = ['config_id']+VOXEL_KEYS+['file_ctr']
+
+            cmd = f"SELECT table_id FROM map_{project} WHERE photon_ctr < target_ctr"
+            if cluster is not None:
+                table_ids = self.get_table_ids(project,cluster)
+                if len(table_ids) < 1:
+                    print(f"No table assigned to the cluster {cluster}")
+                    return []
+                cmd += f" AND table_id IN ({','.join([str(tid) for tid in table_ids])})"
+            cmd += " ORDER BY photon_ctr ASC"
+
+            with _immediate(self._conn):
+                self._create_lease_table(cur,project)
+                now = time.time()
+                cur.execute(cmd)
+                claims = []
+                for table_id, in cur.fetchall():
+                    limit = max(int(size),n-len(claims)) if int(size)>0 else -1
+                    table_conn = self._table_conn(project,table_id)
+                    if table_conn is self._conn:
+                        cmd  = f"SELECT {','.join(keys)} FROM cfg_{project}{table_id} WHERE photon_ctr < ?"
+                        cmd += f" AND config_id NOT IN (SELECT config_id FROM lease_{project} WHERE expires > ?)"
+                        cmd += " ORDER BY photon_ctr ASC LIMIT ?"
+                        cur.execute(cmd,(max_photons,now,limit))
+                        res = cur.fetchall()
+                    else:
+                        # the lease table is in the main file: filter the leased configurations of a shard here
+                        cur.execute(f"SELECT config_id FROM lease_{project} WHERE table_id = ? AND expires > ?",(table_id,now))
+                        leased = set([row[0] for row in cur.fetchall()])
+                        cmd = f"SELECT {','.join(keys)} FROM cfg_{project}{table_id} WHERE photon_ctr < ? ORDER BY photon_ctr ASC LIMIT ?"
+                        res = table_conn.execute(cmd,(max_photons,limit+len(leased) if limit>0 else -1)).fetchall()
+                        res = [row for row in res if not row[0] in leased][:limit if limit>0 else None]
+                    if len(res)<1:
+                        continue
+                    picked = [res[index] for index in np.random.choice(len(res),min(len(res),n-len(claims)),replace=False)]
+                    if meta['compact']:
+                        picked = self._with_geometry(project,picked,['file_ctr'])
+                    else:
+                        picked = [dict(zip(keys,row)) for row in picked]
+                    for claim in picked:
+                        claim['table_id'] = table_id
+                        claims.append(claim)
+                    if len(claims) >= n:
+                        break
+
+                cmd  = f"INSERT INTO lease_{project} (config_id, table_id, job_id, cluster, claimed, expires, ttl) VALUES (?,?,?,?,?,?,?)"
+                for i,claim in enumerate(claims):
+                    claim['expires'] = now+float(ttl)*(i+1 if stagger else 1)
+                    cur.execute(cmd,(claim['config_id'],claim['table_id'],job_id,cluster,now,claim['expires'],float(ttl)))
+                    claim['lease_id'] = cur.lastrowid
+
+            if len(claims)<1:
+                print("No configuration left to be claimed.")
+            return claims
+
+    @retry_on_busy
+    def release_config(self,project:str,lease_id:int):
+        """Release a configuration claimed by claim_config
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        lease_id : int
+            The lease ID returned by claim_config
+
+        Returns
+        -------
+        bool
+            True = the lease was found and released
+        """
+        with closing(self._conn.cursor()) as cur:
+            if not self.exist_table(f"lease_{project}"):
+                return False
+            cur.execute(f"DELETE FROM lease_{project} WHERE lease_id = ?",(int(lease_id),))
+            released = cur.rowcount > 0
+            self._conn.commit()
+            return released
+
+    @retry_on_busy
+    def heartbeat(self,project:str,lease_id:int,ttl:float=None):
+        """Report that the job holding a lease is alive
+
+        Records the time of the heartbeat (and of the first heartbeat as the start of the run)
+        and extends the lease by its time to live, so that a running job keeps its configuration
+        while an abandoned lease expires (see reap_leases).
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        lease_id : int
+            The lease ID returned by claim_config
+
+        ttl : float (optional)
+            If provided, the new time to live of the lease in seconds (default: the ttl given at the claim)
+
+        Returns
+        -------
+        bool
+            True = the lease was found (False = it was released or reaped)
+        """
+        with closing(self._conn.cursor()) as cur:
+            if not self.exist_table(f"lease_{project}"):
+                return False
+            now = time.time()
+            with _immediate(self._conn):
+                self._create_lease_table(cur,project)
+                cmd  = f"UPDATE lease_{project} SET started = COALESCE(started, ?), heartbeat = ?,"
+                if ttl is None:
+                    cmd += " expires = ? + COALESCE(ttl, expires - COALESCE(heartbeat, claimed)) WHERE lease_id = ?"
+                    cur.execute(cmd,(now,now,now,int(lease_id)))
+                else:
+                    cmd += " expires = ? WHERE lease_id = ?"
+                    cur.execute(cmd,(now,now,now+float(ttl),int(lease_id)))
+                alive = cur.rowcount > 0
+            return alive
+
+    @retry_on_busy
+    def reap_leases(self,project:str,older_than:float=None):
+        """Return the configurations of expired or abandoned leases to the pool
+
+        Deletes the expired leases and, if older_than is provided, the leases of runs in progress
+        without heartbeat in the last older_than seconds, in one statement. Leases that never sent
+        a heartbeat (e.g. waiting in a job manifest) are reaped only when they expire.
+        The time lost to abandoned runs is the time between the first and the last heartbeat
+        of the deleted leases (runs that never sent a heartbeat are not counted).
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        older_than : float (optional)
+            The time in seconds since the last heartbeat after which a lease is abandoned
+
+        Returns
+        -------
+        dict
+            The number of leases reaped, of those with a run in progress (heartbeat),
+            the hours lost to abandoned runs, and the IDs of the jobs that held the leases
+        """
+        report = dict(leases=0,running=0,hours_lost=0.,jobs=[])
+        with closing(self._conn.cursor()) as cur:
+            if not self.exist_table(f"lease_{project}"):
+                return report
+            now = time.time()
+            with _immediate(self._conn):
+                self._create_lease_table(cur,project)
+                cmd = f"DELETE FROM lease_{project} WHERE expires <= ?"
+                args = [now]
+                if older_than is not None:
+                    cmd += " OR heartbeat < ?"
+                    args.append(now-float(older_than))
+                cur.execute(cmd + " RETURNING job_id, started, heartbeat",args)
+                reaped = cur.fetchall()
+        report['leases'] = len(reaped)
+        report['running'] = len([r for r in reaped if r[1] is not None])
+        report['hours_lost'] = sum([r[2]-r[1] for r in reaped if r[1] is not None]) / 3600.
+        report['jobs'] = sorted(set([r[0] for r in reaped if r[0] is not None]))
+        return report
+
+    def _create_lease_table(self,cur,project:str):
+        """Create the lease table for the project if it does not exist yet"""
+        cmd  = f"CREATE TABLE IF NOT EXISTS lease_{project} (lease_id INTEGER PRIMARY KEY AUTOINCREMENT, config_id INT, table_id INT,"
+        cmd += " job_id TEXT, cluster TEXT, claimed FLOAT, expires FLOAT, started FLOAT, heartbeat FLOAT, ttl FLOAT)"
+        cur.execute(cmd)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS lease_{project}_config ON lease_{project} (config_id, expires)")
+        # migrate a lease table created before heartbeats (and per-lease ttl) were introduced
+        cur.execute(f"SELECT name FROM pragma_table_info('lease_{project}')")
+        columns = [row[0] for row in cur.fetchall()]
+        for column in ['started','heartbeat','ttl']:
+            if not column in columns:
+                cur.execute(f"ALTER TABLE lease_{project} ADD {column} FLOAT")
 
     def list_files(self,project:str,config_id:int=None,table_id:int=None):
         """Retrieve a list of files produced in the production
 
-        Download a list of files produced (for a specific config_id and table_id, if provided)
+        Download a list of files produced (for a specific config_id and table_id, if provided).
+        Use iter_files to stream a large catalog without holding it in memory.
 
         Parameters
         ----------
@@ -519,33 +1504,82 @@ class wcprod_db:
         list
             The paths to the produced files.
         """        
+        return list(self.iter_files(project,config_id,table_id))
+
+    def iter_files(self,project:str,config_id:int=None,table_id:int=None,columns:list=None,batch_size:int=10000):
+        """Iterate over the files produced in the production
+
+        Files are read in batches ordered by file_id (keyset pagination), so the memory usage
+        does not depend on the number of files.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        config_id : int (optional)
+            If provided, limit the query to the specified configuration
+
+        table_id : int (optional)
+            If provided, limit the query to the specified subgroup (table)
+
+        columns : list (optional)
+            If provided, yield tuples of these file table columns (file_id, config_id, file_path,
+            photon_ctr, duration, Timestamp) instead of the file paths. A comma-separated str is accepted.
+
+        batch_size : int (optional)
+            The number of rows fetched per query
+
+        Yields
+        ------
+        str or tuple
+            The path to a produced file, or the requested columns
+        """
         if config_id is not None:
+            config_id = int(config_id)
             check = self.table_id(project,config_id)
             if table_id is None:
                 table_id = check
             else:
-                assert check == table_id
-        table_ids = []
+                assert check == int(table_id)
         if table_id is None:
-            table_ids = np.arange(self.table_count(project))
+            table_ids = range(self.table_count(project))
         else:
-            table_ids = [table_id]
-        
-        flist=[]
-        with closing(self._conn.cursor()) as cur:
-            for table_index in table_ids:
-                cmd = f"SELECT file_path FROM file_{project}{table_index} "
-                if config_id:
-                    cmd += f"WHERE config_id={config_id}"
-                cur.execute(cmd)
-                flist = flist + [fs[0] for fs in cur.fetchall()]
-        return flist
+            table_ids = [int(table_id)]
+
+        if isinstance(columns,str):
+            columns = columns.split(',')
+        keys = ['file_path'] if columns is None else list(columns)
+        invalid = [key for key in keys if not key in FILE_COLUMNS]
+        if len(invalid):
+            raise ValueError(f"Invalid file table columns {invalid} (valid: {FILE_COLUMNS})")
+        batch_size = int(batch_size)
+
+        for table_index in table_ids:
+            with closing(self._table_conn(project,table_index).cursor()) as cur:
+                cmd = f"SELECT file_id, {','.join(keys)} FROM file_{project}{table_index} WHERE file_id > ?"
+                args = []
+                if config_id is not None:
+                    cmd += " AND config_id = ?"
+                    args.append(config_id)
+                cmd += " ORDER BY file_id LIMIT ?"
+                last = -1
+                while True:
+                    cur.execute(cmd,(last,*args,batch_size))
+                    rows = cur.fetchall()
+                    for row in rows:
+                        yield row[1] if columns is None else row[1:]
+                    if len(rows) < batch_size:
+                        break
+                    last = rows[-1][0]
 
     
     def exist_file(self,project:str,file_path:str):
         """Check if a file is already in the database
 
-        Loop over file tables and check if the specified file exists in the project
+        Look up the project-wide file path index (filepath_{project} table).
+        For a database created before the index was introduced, loop over file tables instead
+        (run build_filepath_index once to migrate).
 
         Parameters
         ----------
@@ -561,17 +1595,134 @@ class wcprod_db:
             True = file exists in the database
         """
         file_path = os.path.abspath(file_path)
+        if self._shard_conns(project) is not None:
+            # each shard holds the index of its own files
+            for conn in self._shard_conns(project)[1]:
+                if len(conn.execute(f"SELECT 1 FROM filepath_{project} WHERE file_path=?",(file_path,)).fetchall()):
+                    return True
+            return False
         with closing(self._conn.cursor()) as cur:
+            if self._has_filepath_index(project):
+                cur.execute(f"SELECT 1 FROM filepath_{project} WHERE file_path=?",(file_path,))
+                return len(cur.fetchall())>0
             table_count = self.table_count(project)
             for table_index in range(table_count):
-                cmd = f"SELECT file_path FROM file_{project}{table_index} WHERE file_path='{file_path}'"
-                cur.execute(cmd)
+                cmd = f"SELECT file_path FROM file_{project}{table_index} WHERE file_path=?"
+                cur.execute(cmd,(file_path,))
                 res = cur.fetchall()
                 if len(res)>0:
                     return True
             return False
-        
-    
+
+    def build_filepath_index(self,project:str):
+        """Create and backfill the project-wide file path index
+
+        Migration for a database created before the filepath_{project} table was introduced.
+        The table holds one row per registered file path (unique) and the file table ID.
+        Safe to run more than once.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        Returns
+        -------
+        int
+            The number of file paths in the index
+        """
+        if not self.exist_project(project):
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
+
+        num_tables = self.table_count(project)
+        conns = self._project_conns(project)
+        for conn in conns:
+            with closing(conn.cursor()) as cur:
+                self._create_filepath_table(cur,project)
+        num_files = 0
+        for index in tqdm(range(num_tables)):
+            with closing(self._table_conn(project,index).cursor()) as cur:
+                cur.execute(f"INSERT OR IGNORE INTO filepath_{project} (file_path, table_id) SELECT file_path, {index} FROM file_{project}{index}")
+                cur.execute(f"SELECT COUNT(*) FROM file_{project}{index}")
+                num_files += cur.fetchall()[0][0]
+        num_paths = 0
+        for conn in conns:
+            conn.commit()
+            num_paths += conn.execute(f"SELECT COUNT(*) FROM filepath_{project}").fetchall()[0][0]
+        if num_paths < num_files:
+            print(f'Found {num_files - num_paths} duplicated file paths in the file tables')
+        return num_paths
+
+    def _has_filepath_index(self,project:str):
+        """Check (and cache) if the project has the filepath_{project} table"""
+        if not project in self._filepath_indexed and self.exist_table(f"filepath_{project}"):
+            self._filepath_indexed.add(project)
+        return project in self._filepath_indexed
+
+    def _create_filepath_table(self,cur,project:str):
+        """Create the file path index table for the project if it does not exist yet"""
+        cur.execute(f"CREATE TABLE IF NOT EXISTS filepath_{project} (file_path TEXT PRIMARY KEY, table_id INT) WITHOUT ROWID")
+
+    def list_shards(self,project:str):
+        """List the shard files of a sharded project
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        Returns
+        -------
+        list
+            List of dict (shard_id, file_path, table_min, table_max). Empty if the project is not sharded.
+        """
+        if not self.exist_table(f"shard_{project}"):
+            return []
+        keys = ['shard_id','file_path','table_min','table_max']
+        with closing(self._conn.cursor()) as cur:
+            cur.execute(f"SELECT {','.join(keys)} FROM shard_{project} ORDER BY table_min")
+            shards = [dict(zip(keys,row)) for row in cur.fetchall()]
+        for shard in shards:
+            shard['file_path'] = self._shard_path(shard['file_path'])
+        return shards
+
+    def _shard_path(self,file_path:str):
+        """Resolve a shard file path (stored relative to the main database file)"""
+        if os.path.isabs(file_path):
+            return file_path
+        return os.path.join(os.path.dirname(self._dbname),file_path)
+
+    def _shard_conns(self,project:str):
+        """Retrieve (and cache) the last table ID and the connection of each shard (None if the project is not sharded)"""
+        if not project in self._shards:
+            shards = self.list_shards(project)
+            if len(shards) < 1:
+                self._shards[project] = None
+            else:
+                table_max = np.array([shard['table_max'] for shard in shards],dtype=np.int64)
+                conns = [connect(shard['file_path'],*self._connect_args) for shard in shards]
+                self._shards[project] = (table_max, conns, [shard['file_path'] for shard in shards])
+        return self._shards[project]
+
+    def _table_conn(self,project:str,table_id:int):
+        """Retrieve the connection to the file that holds the configuration/file tables with the table ID"""
+        shards = self._shard_conns(project)
+        if shards is None:
+            return self._conn
+        return shards[1][int(shards[0].searchsorted(int(table_id)))]
+
+    def _table_path(self,project:str,table_id:int):
+        """Retrieve the path to the file that holds the configuration/file tables with the table ID"""
+        shards = self._shard_conns(project)
+        if shards is None:
+            return self._dbname
+        return shards[2][int(shards[0].searchsorted(int(table_id)))]
+
+    def _project_conns(self,project:str):
+        """Retrieve the connections to all files that hold configuration/file tables of the project"""
+        shards = self._shard_conns(project)
+        return [self._conn] if shards is None else shards[1]
+
     def exist_table(self,table_name:str):
         """Check if the table exists in the database
 
@@ -585,9 +1736,9 @@ class wcprod_db:
         bool
             True = table exists in the database
         """
-        cmd=f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'"
+        cmd="SELECT name FROM sqlite_master WHERE type='table' AND name=?"
         with closing(self._conn.cursor()) as cur:
-            cur.execute(cmd)
+            cur.execute(cmd,(table_name,))
             return len(cur.fetchall())>0
                 
 
@@ -605,9 +1756,8 @@ class wcprod_db:
             True = project exists in the database
         """
         with closing(self._conn.cursor()) as cur:
-            cur.execute(f"SELECT name FROM project")
-            result = [v[0] for v in cur.fetchall()]
-        return project in result
+            cur.execute("SELECT 1 FROM project WHERE name=?",(project,))
+            return len(cur.fetchall())>0
     
 
     def table_count(self,project:str):
@@ -651,22 +1801,179 @@ class wcprod_db:
         int
             The configuration table ID
         """
+        # scalar version of table_ids (avoids the array overhead for a single lookup)
+        config_id = int(config_id)
+        table_ids, range_min, range_max = self._table_ranges(project)
+        index = int(range_min.searchsorted(config_id,side='right'))-1
+        if index < 0 or config_id > range_max[index]:
+            raise ValueError(f"invalid config id: {config_id}")
+        return int(table_ids[index])
+
+    def table_ids(self,project:str,config_ids):
+        """Retrieve the sub-table IDs that contain the specified configurations.
+
+        Vectorized version of table_id using the cached configuration ranges of the map table.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        config_ids : array_like
+            The configuration ID keys
+
+        Returns
+        -------
+        ndarray
+            The configuration table IDs (-1 for an invalid configuration ID)
+        """
+        table_ids, range_min, range_max = self._table_ranges(project)
+        config_ids = np.asarray(config_ids,dtype=np.int64)
+        index = np.searchsorted(range_min,config_ids,side='right')-1
+        valid = (index >= 0) & (config_ids <= range_max[np.clip(index,0,None)])
+        return np.where(valid,table_ids[np.clip(index,0,None)],-1)
+
+    def _table_ranges(self,project:str):
+        """Retrieve (and cache) the table IDs and configuration ranges sorted by config_range_min"""
+        if not project in self._ranges:
+            with closing(self._conn.cursor()) as cur:
+                cur.execute(f"SELECT table_id, config_range_min, config_range_max FROM map_{project} ORDER BY config_range_min")
+                data_map = np.array(cur.fetchall(),dtype=np.int64).reshape(-1,3)
+            self._ranges[project] = (data_map[:,0], data_map[:,1], data_map[:,2])
+        return self._ranges[project]
+
+    def export_counters(self,project:str,path:str):
+        """Export the production counters of all configurations to numpy files
+
+        Writes photon_ctr.npy, file_ctr.npy (int64) and timestamp.npy (datetime64[s], the last
+        update of each configuration) in the directory path. The arrays are indexed by config_id
+        and are written one configuration table at a time through a memory map, so the memory
+        usage is bounded by one table. Use wcprod.utils.load_counters to read them back.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        path : str
+            The output directory (created if it does not exist)
+
+        Returns
+        -------
+        int
+            The number of configurations exported
+        """
+        meta = self.get_project_meta(project)
+        if meta is None:
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
+        num_config = meta['num_config']
+
+        os.makedirs(path,exist_ok=True)
+        open_memmap = np.lib.format.open_memmap
+        photon_ctr = open_memmap(os.path.join(path,COUNTER_FILES['photon_ctr']),mode='w+',dtype=np.int64,shape=(num_config,))
+        file_ctr   = open_memmap(os.path.join(path,COUNTER_FILES['file_ctr']),mode='w+',dtype=np.int64,shape=(num_config,))
+        timestamp  = open_memmap(os.path.join(path,COUNTER_FILES['timestamp']),mode='w+',dtype='datetime64[s]',shape=(num_config,))
+
+        table_ids, range_min, range_max = self._table_ranges(project)
+        for table_id in tqdm(table_ids):
+            with closing(self._table_conn(project,table_id).cursor()) as cur:
+                cur.execute(f"SELECT config_id, file_ctr, photon_ctr, Timestamp FROM cfg_{project}{table_id}")
+                config_ids, files, photons, times = zip(*cur.fetchall())
+                config_ids = np.array(config_ids,dtype=np.int64)
+                photon_ctr[config_ids] = photons
+                file_ctr[config_ids]   = files
+                timestamp[config_ids]  = np.array(times,dtype='datetime64[s]')
+        for data in [photon_ctr,file_ctr,timestamp]:
+            data.flush()
+        return num_config
+
+    def progress(self,project:str,window:float=24.):
+        """Report the production progress
+
+        Completion is computed from the photon counters of the map table. The throughput is
+        computed from the files registered in the last window hours (file table Timestamp and
+        duration) and used to estimate the time to completion.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        window : float (optional)
+            The time window in hours to compute the recent throughput
+
+        Returns
+        -------
+        dict
+            completion: the fraction of the target photons produced (overall, per table and per cluster),
+            tables_complete: the number of tables that reached the target,
+            files/photons/duration: the files, photons and total job duration registered in the window,
+            photons_per_hour/photons_per_cpu_hour: the throughput in the window,
+            eta_hours/eta: the estimated time to completion in hours and as UTC time
+            (None if there is no recent throughput)
+        """
+        meta = self.get_project_meta(project)
+        if meta is None:
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
+        window = float(window)
+        if window <= 0:
+            raise ValueError(f"The throughput window must be positive (given: {window})")
+
         with closing(self._conn.cursor()) as cur:
-            cmd = f"SELECT table_id FROM map_{project} WHERE config_range_min <= {config_id} AND {config_id} <= config_range_max"
-            cur.execute(cmd)
-            res = cur.fetchall()
-            if len(res) < 1:
-                raise ValueError(f"invalid config id: {config_id}")
-            if len(res) > 1:
-                raise RuntimeError(f"Found >1 table id ({res}) corresponding to the config id {config_id}")
-            return res[0][0]
+            cur.execute(f"SELECT table_id, photon_ctr, target_ctr FROM map_{project} ORDER BY table_id")
+            data_map = np.array(cur.fetchall(),dtype=np.int64).reshape(-1,3)
+            table_ids, photon_ctr, target_ctr = data_map[:,0], data_map[:,1], data_map[:,2]
+            done = np.minimum(photon_ctr,target_ctr)
+            completion = done / np.maximum(target_ctr,1)
+
+            # aggregates of the files registered within the window (file tables are indexed by Timestamp)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            start = (now - datetime.timedelta(hours=window)).strftime('%Y-%m-%d %H:%M:%S')
+            recent = np.zeros(shape=(len(table_ids),3),dtype=float)
+            for i,table_id in enumerate(table_ids):
+                # ABS: the wrapup scripts used to record the job duration with a negative sign
+                cmd = f"SELECT COUNT(*), TOTAL(photon_ctr), TOTAL(ABS(duration)) FROM file_{project}{table_id} WHERE Timestamp >= ?"
+                recent[i] = self._table_conn(project,table_id).execute(cmd,(start,)).fetchone()
+            files, photons, duration = recent.sum(axis=0)
+
+        clusters = dict()
+        for cluster in self.get_partition(project):
+            ids = np.asarray(self.get_table_ids(project,cluster),dtype=np.int64)
+            clusters[cluster] = float(done[ids].sum() / max(target_ctr[ids].sum(),1))
+
+        photons_per_hour = photons / window
+        remaining = int((target_ctr - done).sum())
+        eta_hours = remaining / photons_per_hour if photons_per_hour > 0 else None
+        try:
+            eta = (now + datetime.timedelta(hours=eta_hours)).strftime('%Y-%m-%d %H:%M:%S')
+        except (TypeError,OverflowError):
+            eta = None
+        return dict(project=project,
+                    completion=float(done.sum() / max(target_ctr.sum(),1)),
+                    photon_ctr=int(photon_ctr.sum()),
+                    target_ctr=int(target_ctr.sum()),
+                    tables_complete=int((photon_ctr >= target_ctr).sum()),
+                    num_tables=len(table_ids),
+                    table_completion=completion,
+                    cluster_completion=clusters,
+                    window_hours=window,
+                    files=int(files),
+                    photons=int(photons),
+                    duration=float(duration),
+                    photons_per_hour=float(photons_per_hour),
+                    photons_per_cpu_hour=float(photons / duration * 3600.) if duration > 0 else None,
+                    eta_hours=eta_hours,
+                    eta=eta,
+                    )
     
 
-    def register_project(self,p:wcprod_project,max_entries_per_table:int=1000000):
+    def register_project(self,p:wcprod_project,max_entries_per_table:int=1000000,bulk:bool=False,compact:bool=False,shards:bool=False):
         """Register a new project
 
         Register a new project information from wcprod_project instance.
         Can specify the size of sub-tables: keep it in the order of 1E6 for reasonably fast queries.
+        The configurations of each table are generated from the geometry grids when the table is
+        written, so the peak memory is bounded by one table rather than the whole project.
 
         Parameters
         ----------
@@ -676,16 +1983,69 @@ class wcprod_db:
         max_entries_per_table : int
             The maximum size of single configuration/file database table. 
 
+        bulk : bool (optional)
+            If True, load the tables with synchronous=OFF and journal_mode=MEMORY and create the
+            indexes after all tables are filled. Faster, but the database can be corrupted if the
+            machine crashes during the registration. The previous settings are restored afterwards.
+
+        compact : bool (optional)
+            If True, configuration tables store only the counters (file_ctr, photon_ctr, Timestamp)
+            and the geometry is derived from config_id and the geometry table when read.
+            Makes the database several times smaller.
+
+        shards : bool (optional)
+            If True, store the configuration/file tables in shard files next to the database file,
+            one per cluster of the project partition (DEFAULT_PARTITION if none) holding the block
+            of table IDs initially assigned to the cluster (see set_partition). The project, map,
+            geometry and lease tables stay in the database file. File registrations to different
+            shards do not wait for each other. The shards are not changed by rebalance.
+
         """
         if self.exist_project(p.project):
             raise ValueError(f'Project with the name {p.project} already exists in the database')
-            
-        # create dataframes to create configuration tables.
-        coords = p.configs
-        num_tables = int(np.ceil(len(coords) / max_entries_per_table))
-        entries = [int(len(coords)/num_tables)]*num_tables
-        entries[-1] += (len(coords) - sum(entries))
-        assert sum(entries) == len(coords)
+        self._invalidate(p.project)
+
+        max_entries_per_table = int(max_entries_per_table)
+        if isinstance(bulk,str):
+            bulk = bulk.lower() in ['true','1','yes']
+        if isinstance(compact,str):
+            compact = compact.lower() in ['true','1','yes']
+        if isinstance(shards,str):
+            shards = shards.lower() in ['true','1','yes']
+        if shards:
+            num_tables = int(np.ceil(p.num_configs / max_entries_per_table))
+            self._create_shards(p.project,list((p.partition or DEFAULT_PARTITION).values()),num_tables)
+        if bulk:
+            conns = [self._conn] + ([] if self._shard_conns(p.project) is None else self._shard_conns(p.project)[1])
+            settings = []
+            for conn in conns:
+                conn.commit()
+                settings.append((conn.execute("PRAGMA synchronous").fetchone()[0],conn.execute("PRAGMA journal_mode").fetchone()[0]))
+            try:
+                for conn in conns:
+                    conn.execute("PRAGMA synchronous = OFF")
+                    conn.execute("PRAGMA journal_mode = MEMORY")
+                self._register_project(p,max_entries_per_table,bulk,compact)
+            finally:
+                for conn, (synchronous, journal_mode) in zip(conns,settings):
+                    conn.commit()
+                    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+                    conn.execute(f"PRAGMA synchronous = {synchronous}")
+        else:
+            self._register_project(p,max_entries_per_table,bulk,compact)
+        if len(p.partition):
+            print('Assigning tables to clusters',list(p.partition))
+            self.set_partition(p.project,p.partition)
+        print('Running integrity check')
+        self.check_integrity(p.project)
+        print('Successfully created project',p.project)
+
+    def _register_project(self,p:wcprod_project,max_entries_per_table:int,bulk:bool,compact:bool):
+        """Create the tables of a new project (see register_project)"""
+        # split configurations into tables: all tables have the same size except the last one
+        num_configs = p.num_configs
+        num_tables = int(np.ceil(num_configs / max_entries_per_table))
+        table_size = int(num_configs / num_tables)
 
         with closing(self._conn.cursor()) as cur:
 
@@ -695,93 +2055,175 @@ class wcprod_db:
             
             # Register the project
             print('Registering project',project)
-            cmd = f"INSERT INTO project (name, rmin, rmax, zmin, zmax, gap_space, gap_angle, n_phi_start, num_config, num_tables, num_photons)"
-            cmd += f" VALUES ('{p.project}', {p.rmin}, {p.rmax}, {p.zmin}, {p.zmax}, {p.gap_space}, {p.gap_angle}, {p.n_phi_start}, {len(p.configs)}, {num_tables}, {p.num_photons})"
-            #print(cmd)
-            cur.execute(cmd)
+            if not self._has_compact_column():
+                # migrate a database created before the compact schema was introduced
+                try:
+                    cur.execute("ALTER TABLE project ADD compact INT DEFAULT 0")
+                except sqlite3.OperationalError as e:
+                    # added by another process in the meantime
+                    if not 'duplicate column' in str(e):
+                        raise
+                self._compact_column = True
+            cmd = "INSERT INTO project (name, rmin, rmax, zmin, zmax, gap_space, gap_angle, n_phi_start, num_config, num_tables, num_photons, compact)"
+            cmd += " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            cur.execute(cmd,(p.project,p.rmin,p.rmax,p.zmin,p.zmax,p.gap_space,p.gap_angle,p.n_phi_start,num_configs,num_tables,p.num_photons,int(compact)))
 
             # Create a management table
             print('Creating a cross-table management db')
             cmd = f"CREATE TABLE map_{project} (table_id INTEGER PRIMARY KEY, config_range_min INT, config_range_max INT, photon_ctr INT, target_ctr INT, lock int)"
             cur.execute(cmd)
+
+            # Create a lease table for claim_config
+            self._create_lease_table(cur,project)
+
+            # Create a project-wide file path index (one per shard file for a sharded project)
+            table_curs = {conn: conn.cursor() for conn in self._project_conns(project)}
+            for table_cur in table_curs.values():
+                self._create_filepath_table(table_cur,project)
             
             # Create a geometry table
             print('Creating a geometry table')
             cmd = f"CREATE TABLE geo_{project} (geo_type INT, geo_id INT, val0 FLOAT, val1 FLOAT, val2 FLOAT, val3 FLOAT, val4 FLOAT, val5 FLOAT)"
             cur.execute(cmd)
-            df=pd.DataFrame(dict(geo_type=np.zeros(len(p.positions),dtype=int),
-                                 geo_id=np.arange(len(p.positions),dtype=int),
-                                 val0=p.positions[:,0],
-                                 val1=p.positions[:,1],
-                                 val2=p.positions[:,2],
-                                 )
-            ) 
-            df.to_sql(f"geo_{project}",self._conn,if_exists='append',index=False)
-            df=pd.DataFrame(dict(geo_type=np.ones(len(p.directions),dtype=int),
-                                 geo_id=np.arange(len(p.directions),dtype=int),
-                                 val0=p.directions[:,0],
-                                 val1=p.directions[:,1],
-                                )
-            )
-            df.to_sql(f"geo_{project}",self._conn,if_exists='append',index=False)
-            df = pd.DataFrame(dict(geo_type=np.full(len(p.voxels), 2, dtype=int),
-                                   geo_id=np.arange(len(p.voxels), dtype=int),
-                                   val0=p.voxels[:, 0],
-                                   val1=p.voxels[:, 1],
-                                   val2=p.voxels[:, 2],
-                                   val3=p.voxels[:, 3],
-                                   val4=p.voxels[:, 4],
-                                   val5=p.voxels[:, 5],
-                                   )
-            )
-            df.to_sql(f"geo_{project}", self._conn, if_exists='append', index=False)
-
-            # Create a configuration table
-            print(f'Creating configuration and file tables: {num_tables} tables covering ({len(p.configs)} entries, can take time...)')
+            cmd = f"INSERT INTO geo_{project} VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            cur.executemany(cmd,((0,i,*pos,None,None,None) for i,pos in enumerate(p.positions.tolist())))
+            cur.executemany(cmd,((1,i,*dir,None,None,None,None) for i,dir in enumerate(p.directions.tolist())))
+            cur.executemany(cmd,((2,i,*vox) for i,vox in enumerate(p.voxels.tolist())))
+            if p.n_phi_start > 0:
+                bounds = self._rtree_bounds(np.column_stack([p.voxels,np.arange(len(p.voxels))]),True)
+            else:
+                bounds = self._rtree_bounds(np.column_stack([p.positions,np.arange(len(p.positions))]),False)
+            try:
+                self._create_rtree(cur,project,bounds)
+            except sqlite3.OperationalError as e:
+                print(f'Skipping the R-tree index of the geometry ({e})')
+
+            if compact:
+                columns = 'config_id INTEGER PRIMARY KEY, file_ctr INT, photon_ctr INT, Timestamp DATETIME'
+            else:
+                geo_keys = SHOTGUN_KEYS if p.n_phi_start == 0 else VOXEL_KEYS
+                columns  = ', '.join(['config_id INTEGER']+[f'{key} FLOAT' for key in geo_keys])
+                columns += ', pos_id INT, dir_id INT, file_ctr INT, photon_ctr INT, Timestamp DATETIME'
+
+            # Create configuration tables
+            print(f'Creating configuration and file tables: {num_tables} tables covering ({num_configs} entries, can take time...)')
             for table_index in tqdm(range(num_tables)):
-                start = sum(entries[:table_index])
-                end   = sum(entries[:(table_index+1)])
-                #print(np.arange(start,end).astype(int).shape,np.zeros(shape=(end-start),dtype=int).shape,coords[start:end,5].astype(int).shape,coords[start:end,6].astype(int).shape,coords[start:end,3].shape,coords[:,4].shape)
-                if p.n_phi_start == 0:
-                    df=pd.DataFrame(dict(config_id=np.arange(start,end).astype(int),
-                                         x=coords[start:end,0],y=coords[start:end,1],z=coords[start:end,2],
-                                         theta=coords[start:end,3],phi=coords[start:end,4],
-                                         pos_id=coords[start:end,5].astype(int),
-                                         dir_id=coords[start:end,6].astype(int),
-                                         file_ctr=np.zeros(shape=(end-start),dtype=int),
-                                         photon_ctr=np.zeros(shape=(end-start),dtype=int),
-                                        )
-                                    )
-                else:
-                    df = pd.DataFrame(dict(config_id=np.arange(start, end).astype(int),
-                                           r0=coords[start:end, 0], r1=coords[start:end, 1],
-                                           phi0=coords[start:end, 2], phi1=coords[start:end,3],
-                                           z0=coords[start:end, 4], z1=coords[start:end,5],
-                                           pos_id=coords[start:end, 6].astype(int),
-                                           dir_id=np.zeros(shape=(end-start), dtype=int),
-                                           file_ctr=np.zeros(shape=(end - start), dtype=int),
-                                           photon_ctr=np.zeros(shape=(end - start), dtype=int),
-                                           )
-                                      )
-                df.to_sql(cfg_tablename+str(table_index),self._conn, index=False)
-                cur.execute(f"ALTER TABLE {cfg_tablename}{table_index} ADD Timestamp DATETIME")
-                current_timestamp = datetime.datetime.now().isoformat(" ",timespec='seconds')
-                cur.execute(f"UPDATE {cfg_tablename}{table_index} SET Timestamp = '{current_timestamp}'")
+                start = table_index * table_size
+                end   = num_configs if table_index+1 == num_tables else start + table_size
+                table_cur = table_curs[self._table_conn(project,table_index)]
+                table_cur.execute(f"CREATE TABLE {cfg_tablename}{table_index} ({columns})")
+                self._insert_configs(table_cur,f'{cfg_tablename}{table_index}',p,start,end,compact)
 
                 # Create a file table
-                cur.execute(f"CREATE TABLE {file_tablename}{table_index} (file_id INTEGER PRIMARY KEY AUTOINCREMENT, config_id INT, file_path STRING, photon_ctr INT, duration FLOAT, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+                table_cur.execute(f"CREATE TABLE {file_tablename}{table_index} (file_id INTEGER PRIMARY KEY AUTOINCREMENT, config_id INT, file_path STRING, photon_ctr INT, duration FLOAT, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
                 
                 # Register the table ID 
                 cmd  = f"INSERT INTO map_{project} (table_id, config_range_min, config_range_max, photon_ctr, target_ctr, lock) "
-                cmd += f"VALUES ({table_index}, {start}, {end-1}, 0, {len(df)*(p.num_photons)}, 0)"
-                cur.execute(cmd)
-                
+                cmd += "VALUES (?, ?, ?, 0, ?, 0)"
+                cur.execute(cmd,(table_index,start,end-1,(end-start)*p.num_photons))
+
+                # Create indexes for config_id lookups and prioritized sampling
+                if not bulk:
+                    self._create_cfg_indexes(table_cur,project,table_index,compact)
+                    self._create_file_indexes(table_cur,project,table_index)
+
+            if bulk:
+                print('Creating indexes')
+                for table_index in tqdm(range(num_tables)):
+                    table_cur = table_curs[self._table_conn(project,table_index)]
+                    self._create_cfg_indexes(table_cur,project,table_index,compact)
+                    self._create_file_indexes(table_cur,project,table_index)
+            self._create_map_indexes(cur,project)
+            for conn, table_cur in table_curs.items():
+                table_cur.close()
+                conn.commit()
             self._conn.commit()
-            print('Running integrity check')
-            self.check_integrity(project)
-            print('Successfully created project',project)
 
+    def _create_shards(self,project:str,weights:list,num_tables:int):
+        """Create the shard table and files of a new project, one per partition block of tables (see register_project)"""
+        if self._dbname is None:
+            raise ValueError('A sharded project requires a database file')
+        base = os.path.splitext(os.path.basename(self._dbname))[0]
+        bounds = self._partition_bounds(weights,num_tables)
+        rows = []
+        for table_min, table_max in zip(bounds[:-1],bounds[1:]):
+            if table_max <= table_min:
+                # a cluster without tables
+                continue
+            file_path = f'{base}_{project}_shard{len(rows)}.db'
+            if os.path.exists(self._shard_path(file_path)):
+                raise ValueError(f'Shard file {self._shard_path(file_path)} already exists')
+            rows.append((len(rows),file_path,table_min,table_max-1))
+        print(f'Creating {len(rows)} shard files')
+        with closing(self._conn.cursor()) as cur:
+            cur.execute(f"CREATE TABLE shard_{project} (shard_id INTEGER PRIMARY KEY, file_path TEXT, table_min INT, table_max INT)")
+            cur.executemany(f"INSERT INTO shard_{project} VALUES (?, ?, ?, ?)",rows)
+        self._conn.commit()
+        self._shards.pop(project,None)
+
+    def _insert_configs(self,cur,tablename:str,p:wcprod_project,start:int,end:int,compact:bool):
+        """Write the configurations in [start,end) (see wcprod_project.config_slice) with a prepared statement"""
+        config_ids = range(start,end)
+        current_timestamp = datetime.datetime.now().isoformat(" ",timespec='seconds')
+        if compact:
+            cur.executemany(f"INSERT INTO {tablename} VALUES (?, ?, ?, ?)",((cid,0,0,current_timestamp) for cid in config_ids))
+            return
+        coords = p.config_slice(start,end)
+        if p.n_phi_start == 0:
+            geometry = coords[:,0:5].tolist()
+            pos_ids = coords[:,5].astype(int).tolist()
+            dir_ids = coords[:,6].astype(int).tolist()
+        else:
+            geometry = coords[:,0:6].tolist()
+            pos_ids = coords[:,6].astype(int).tolist()
+            dir_ids = [0]*len(coords)
+        rows = ((cid,*geo,pid,did,0,0,current_timestamp) for cid,geo,pid,did in zip(config_ids,geometry,pos_ids,dir_ids))
+        cur.executemany(f"INSERT INTO {tablename} VALUES ({', '.join(['?']*(len(geometry[0])+6))})",rows)
+
+    def add_indexes(self,project:str):
+        """Create the indexes used for prioritized sampling and configuration lookups
+
+        Migration for a database created before the indexes were introduced in register_project.
+        Creates an index on (photon_ctr, config_id) and a unique index on config_id for every
+        configuration table, an index on Timestamp for every file table, an index on
+        (photon_ctr, lock) for the map table, and an index on (geo_type, geo_id) for the geometry table.
+        Safe to run more than once.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+        """
+        if not self.exist_project(project):
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
+
+        num_tables = self.table_count(project)
+        compact = self.get_project_meta(project)['compact']
+        for index in tqdm(range(num_tables)):
+            with closing(self._table_conn(project,index).cursor()) as cur:
+                self._create_cfg_indexes(cur,project,index,compact)
+                self._create_file_indexes(cur,project,index)
+        with closing(self._conn.cursor()) as cur:
+            self._create_map_indexes(cur,project)
+        for conn in self._project_conns(project):
+            conn.commit()
+        self._conn.commit()
+
+    def _create_cfg_indexes(self,cur,project:str,table_index:int,compact:bool=False):
+        """Create the indexes of a configuration table if they do not exist yet"""
+        # config_id is the primary key of a compact configuration table
+        if not compact:
+            cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS cfg_{project}{table_index}_config_id ON cfg_{project}{table_index} (config_id)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS cfg_{project}{table_index}_photon_ctr ON cfg_{project}{table_index} (photon_ctr, config_id)")
 
+    def _create_file_indexes(self,cur,project:str,table_index:int):
+        """Create the indexes of a file table if they do not exist yet"""
+        cur.execute(f"CREATE INDEX IF NOT EXISTS file_{project}{table_index}_Timestamp ON file_{project}{table_index} (Timestamp)")
+
+    def _create_map_indexes(self,cur,project:str):
+        """Create the indexes of the map and geometry tables if they do not exist yet"""
+        cur.execute(f"CREATE INDEX IF NOT EXISTS map_{project}_photon_ctr ON map_{project} (photon_ctr, lock)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS geo_{project}_geo_id ON geo_{project} (geo_type, geo_id)")
 
     def drop_project(self,project:str):
         """Drop a project from the database
@@ -795,20 +2237,41 @@ class wcprod_db:
         if not self.exist_project(project):
             raise ProjectNotFoundError(f"Project '{project}' not found in the project table.")
 
+        self._invalidate(project)
         num_tables = self.table_count(project)
-        with closing(self._conn.cursor()) as cur:
-            for index in range(num_tables):
+        for index in range(num_tables):
+            with closing(self._table_conn(project,index).cursor()) as cur:
                 cmd = f"DROP TABLE cfg_{project}{index}"
                 cur.execute(cmd)
                 cmd = f"DROP TABLE file_{project}{index}"
                 cur.execute(cmd)
+        shards = self.list_shards(project)
+        with closing(self._conn.cursor()) as cur:
+            cmd = f"DROP TABLE IF EXISTS shard_{project}"
+            cur.execute(cmd)
             cmd = f"DROP TABLE map_{project}"
             cur.execute(cmd)
             cmd = f"DROP TABLE geo_{project}"
             cur.execute(cmd)
-            cmd = f"DELETE FROM project WHERE name='{project}'"
+            cmd = f"DROP TABLE IF EXISTS lease_{project}"
+            cur.execute(cmd)
+            cmd = f"DROP TABLE IF EXISTS filepath_{project}"
+            cur.execute(cmd)
+            cmd = f"DROP TABLE IF EXISTS integrity_{project}"
+            cur.execute(cmd)
+            cmd = f"DROP TABLE IF EXISTS partition_{project}"
+            cur.execute(cmd)
+            cmd = f"DROP TABLE IF EXISTS assignment_{project}"
             cur.execute(cmd)
+            cmd = f"DROP TABLE IF EXISTS rtree_{project}"
+            cur.execute(cmd)
+            cmd = "DELETE FROM project WHERE name=?"
+            cur.execute(cmd,(project,))
         self._conn.commit()
+        # close and remove the shard files
+        self._invalidate(project)
+        for shard in shards:
+            os.remove(shard['file_path'])
         
     def register_file(self,project:str,config_id:int,file_path:str,num_photons:int,duration:float):    
         """Register a new file
@@ -831,39 +2294,344 @@ class wcprod_db:
 
         duration : float
             The time in seconds that has taken to produce this file
+
+        Returns
+        -------
+        bool
+            True = the file is newly registered
         """
-        # Check if the file exists and physical
-        if not os.path.isfile(file_path):
-            print('File not exist:',file_path)
-            return False
-        
-        file_path = os.path.abspath(file_path)
-        
-        # Check if the config id is valid
-        if self.get_config(project,config_id) is None:
-            return False
-        
-        # Check if the same path exists in the DB already
-        if self.exist_file(project,file_path):
-            print('File already registered in the DB')
-            return False
-        
-        # Register
+        return self.register_files(project,[(config_id,file_path,num_photons,duration)])[0]
+
+    @retry_on_busy
+    def register_files(self,project:str,records):
+        """Register many new files at once
+
+        Bulk version of register_file. Records are grouped by the configuration table ID,
+        checked for duplicates with one query per table, and written with executemany in
+        one transaction together with the file/photon counter increments.
+
+        Parameters
+        ----------
+        project : str
+            The name of a project to access in the database
+
+        records : iterable
+            Iterable of (config_id, file_path, num_photons, duration) tuples
+
+        Returns
+        -------
+        list
+            List of bool, one per record: True = the file is newly registered
+        """
+        records = [(int(r[0]),os.path.abspath(r[1]),int(r[2]),float(r[3])) for r in records]
+        registered = [False]*len(records)
+        if len(records) < 1:
+            return registered
+
+        table_ids = self.table_ids(project,[r[0] for r in records])
+
+        # group records by table while removing in-batch duplicates and missing files
+        groups = dict()
+        seen = set()
+        for i,(config_id,file_path,num_photons,duration) in enumerate(records):
+            if table_ids[i] < 0:
+                print('Project',project,'config_id',config_id,'does not exist')
+                continue
+            if file_path in seen:
+                print('File duplicated in the input:',file_path)
+                continue
+            if not os.path.isfile(file_path):
+                print('File not exist:',file_path)
+                continue
+            seen.add(file_path)
+            groups.setdefault(int(table_ids[i]),[]).append(i)
+
+        sharded = self._shard_conns(project) is not None
+        indexed = sharded or self._has_filepath_index(project)
+        current_timestamp = datetime.datetime.now().isoformat(" ",timespec='seconds')
+
+        # one transaction per file holding the tables (the database file or a shard)
+        conns = dict()
+        for table_id, members in groups.items():
+            conns.setdefault(self._table_conn(project,table_id),[]).append((table_id,members))
+        for conn, tables in conns.items():
+            photons = dict()
+            with closing(conn.cursor()) as cur:
+                with _immediate(conn):
+                    existing = self._registered_paths(cur,project,[records[i][1] for _,members in tables for i in members],indexed)
+                    if len(existing):
+                        print(f'{len(existing)} files already registered in the DB')
+                    for table_id, members in tables:
+                        members = [i for i in members if not records[i][1] in existing]
+                        if len(members) < 1:
+                            continue
+                        self._register_table_files(cur,project,table_id,members,records,indexed,current_timestamp)
+                        photons[table_id] = sum([records[i][2] for i in members])
+                        for i in members:
+                            registered[i] = True
+                    if not sharded:
+                        self._add_map_photons(cur,project,photons)
+
+            if sharded:
+                # the map table is in the database file: update it in a short transaction of its own
+                self._update_map_photons(project,photons,increment=True)
+
+        return registered
+
+    def _registered_paths(self,cur,project:str,paths:list,indexed:bool):
+        """Return the set of file paths registered in the DB already (see register_files)
+
+        Look up the file path index of every shard (sharded project), the file path index, or every
+        file table of the project for a DB without the index (same check as exist_file).
+        """
+        if self._shard_conns(project) is not None:
+            # each shard indexes its own files (the shard of cur is read within its transaction)
+            tables = [(cur if conn is cur.connection else conn,f"filepath_{project}") for conn in self._shard_conns(project)[1]]
+        elif indexed:
+            tables = [(cur,f"filepath_{project}")]
+        else:
+            tables = [(cur,f"file_{project}{table_id}") for table_id in range(self.table_count(project))]
+        existing = set()
+        for start in range(0,len(paths),SQLITE_MAX_VARIABLES):
+            chunk = paths[start:start+SQLITE_MAX_VARIABLES]
+            for reader, table in tables:
+                res = reader.execute(f"SELECT file_path FROM {table} WHERE file_path IN ({','.join(['?']*len(chunk))})",chunk)
+                existing.update([fs[0] for fs in res.fetchall()])
+        return existing
+
+    def _register_table_files(self,cur,project:str,table_id:int,members:list,records:list,indexed:bool,timestamp:str):
+        """Insert the new files of one file table and increment the configuration counters (see register_files)"""
+        if indexed:
+            cmd = f"INSERT INTO filepath_{project} (file_path,table_id) VALUES (?,?)"
+            cur.executemany(cmd,[(records[i][1],table_id) for i in members])
+        cmd = f"INSERT INTO file_{project}{table_id} (config_id,file_path,photon_ctr,duration) VALUES (?,?,?,?)"
+        cur.executemany(cmd,[records[i] for i in members])
+
+        ctrs = dict()
+        for i in members:
+            file_ctr, photon_ctr = ctrs.get(records[i][0],(0,0))
+            ctrs[records[i][0]] = (file_ctr+1, photon_ctr+records[i][2])
+        cmd = f"UPDATE cfg_{project}{table_id} SET file_ctr = file_ctr+?, photon_ctr = photon_ctr+?, Timestamp = ? WHERE config_id = ?"
+        cur.executemany(cmd,[(f,p,timestamp,c) for c,(f,p) in ctrs.items()])
+
+    def _update_map_photons(self,project:str,photons:dict,increment:bool):
+        """Update the map table of a sharded project after the files are committed in a shard
+
+        The update is retried on its own: a retry of the calling method would find the files
+        registered already and skip it. Raises ProjectIntegrityError if the lock is never free.
+        """
+        try:
+            self._write_map_photons(project,photons,increment)
+        except sqlite3.OperationalError as e:
+            raise ProjectIntegrityError(f"Files committed but map_{project} photon counters not updated ({e}): {photons}") from e
+
+    @retry_on_busy
+    def _write_map_photons(self,project:str,photons:dict,increment:bool):
+        """Increment (or set) the map table photon counters in a transaction of their own (see _update_map_photons)"""
         with closing(self._conn.cursor()) as cur:
-                            
-            # retrieve the table id
-            table_id = self.table_id(project,config_id)
-            cmd = f"INSERT INTO file_{project}{table_id} (config_id,file_path,photon_ctr,duration) VALUES ({config_id},'{file_path}',{num_photons},{duration});"
-            cur.execute(cmd)
+            with _immediate(self._conn):
+                if increment:
+                    self._add_map_photons(cur,project,photons)
+                else:
+                    self._set_map_photons(cur,project,photons)
 
-            current_timestamp = datetime.datetime.now().isoformat(" ",timespec='seconds')
-            cmd = f"UPDATE cfg_{project}{table_id} SET file_ctr = file_ctr+1, photon_ctr = photon_ctr+{num_photons}, Timestamp = '{current_timestamp}' WHERE config_id = {config_id};"
-            cur.execute(cmd)
-            
-            cmd = f"UPDATE map_{project} SET photon_ctr = photon_ctr + {num_photons} WHERE table_id = {table_id}"
-            cur.execute(cmd)
-            # Check if it's registered correctly
-            
-            
-            # finish transaction
-            self._conn.commit()
+    def _add_map_photons(self,cur,project:str,photons:dict):
+        """Increment the photon counters of the map table (table_id => number of photons)"""
+        cmd = f"UPDATE map_{project} SET photon_ctr = photon_ctr + ? WHERE table_id = ?"
+        cur.executemany(cmd,[(num,table_id) for table_id,num in photons.items() if num > 0])
+
+    def ingest_journal(self,*journals,batch_size:int=10000):
+        """Register the files recorded in offline journal files
+
+        Replays journals written by wcprod.journal.append_record (e.g. by a wrapup job that
+        could not reach the database). Records are registered with register_files in batches
+        of batch_size per project, and the leases recorded with them are released. Files
+        registered already are skipped, so a journal can be ingested more than once.
+
+        Parameters
+        ----------
+        journals : str
+            Paths to the journal files
+
+        batch_size : int (optional)
+            The maximum number of records registered in one register_files call
+
+        Returns
+        -------
+        dict
+            The number of records read, newly registered, skipped, and invalid journal lines
+        """
+        batch_size = int(batch_size)
+        summary = dict(records=0,registered=0,skipped=0,invalid=0)
+        batches = dict()
+
+        def flush(project):
+            records, lease_ids = batches.pop(project)
+            if not self.exist_project(project):
+                print(f'Project {project} not found: skipping {len(records)} journal records')
+                summary['skipped'] += len(records)
+                return
+            registered = sum(self.register_files(project,records))
+            summary['registered'] += registered
+            summary['skipped'] += len(records) - registered
+            if len(lease_ids) and self.exist_table(f"lease_{project}"):
+                with closing(self._conn.cursor()) as cur:
+                    cur.executemany(f"DELETE FROM lease_{project} WHERE lease_id = ?",[(i,) for i in lease_ids])
+                    self._conn.commit()
+
+        for journal in journals:
+            for record in read_journal(journal):
+                if record is None:
+                    summary['invalid'] += 1
+                    continue
+                summary['records'] += 1
+                records, lease_ids = batches.setdefault(record['project'],([],[]))
+                records.append((record['config_id'],record['file_path'],record['num_photons'],record['duration']))
+                if record['lease_id'] is not None:
+                    lease_ids.append(record['lease_id'])
+                if len(records) >= batch_size:
+                    flush(record['project'])
+
+        for project in list(batches):
+            flush(project)
+
+        return summary
+
+    @retry_on_busy
+    def merge_from(self,other_db_path:str,project:str):
+        """Merge the files registered in another copy of the database
+
+        Attaches the other database (e.g. a site-local copy), checks that the project has the same
+        geometry and configuration tables, and copies the file records with paths not registered
+        in this database yet. The configuration and map counters of the updated tables are then
+        recomputed from the file tables. Each file that holds configuration/file tables is
+        updated in one transaction with set-based statements.
+
+        Parameters
+        ----------
+        other_db_path : str
+            The path to the database file to merge from
+
+        project : str
+            The name of a project to merge
+
+        Returns
+        -------
+        int
+            The number of files newly registered
+        """
+        other_db_path = os.path.abspath(other_db_path)
+        if not os.path.isfile(other_db_path):
+            raise FileNotFoundError(f"Database file not found: {other_db_path}")
+        if other_db_path == self._dbname:
+            raise ValueError("Cannot merge a database into itself")
+        if not self.exist_project(project):
+            raise ProjectNotFoundError(f"Project '{project}' not found in the project table")
+
+        # validate the geometry and the table layout, and locate the tables of the other database
+        keys = ['rmin','rmax','zmin','zmax','gap_space','gap_angle','n_phi_start','num_config','num_tables']
+        self._conn.commit()
+        self._conn.execute("ATTACH DATABASE ? AS merge_src",(other_db_path,))
+        try:
+            with closing(self._conn.cursor()) as cur:
+                ours, theirs = [cur.execute(f"SELECT {','.join(keys)} FROM {db}.project WHERE name = ?",(project,)).fetchall() for db in ['main','merge_src']]
+                if len(theirs) < 1:
+                    raise ProjectNotFoundError(f"Project '{project}' not found in {other_db_path}")
+                mismatch = [key for key,a,b in zip(keys,ours[0],theirs[0]) if not a == b]
+                if len(mismatch):
+                    raise ValueError(f"Project '{project}' in {other_db_path} has a different geometry ({', '.join(mismatch)})")
+                layout, other_layout = [cur.execute(f"SELECT table_id, config_range_min, config_range_max FROM {db}.map_{project} ORDER BY table_id").fetchall() for db in ['main','merge_src']]
+                if not layout == other_layout:
+                    raise ValueError(f"Project '{project}' in {other_db_path} has different configuration tables (max_entries_per_table)")
+                cur.execute("SELECT name FROM merge_src.sqlite_master WHERE type='table' AND name=?",(f"shard_{project}",))
+                if len(cur.fetchall()):
+                    cur.execute(f"SELECT file_path, table_max FROM merge_src.shard_{project} ORDER BY table_min")
+                    sources = [(os.path.join(os.path.dirname(other_db_path),path),table_max) for path,table_max in cur.fetchall()]
+                else:
+                    sources = [(other_db_path,len(layout)-1)]
+        finally:
+            self._conn.execute("DETACH DATABASE merge_src")
+
+        # group the tables by the (target, source) pair of files
+        groups = dict()
+        source_max = np.array([table_max for path,table_max in sources],dtype=np.int64)
+        for table_id,_,_ in layout:
+            source = sources[int(source_max.searchsorted(table_id))][0]
+            groups.setdefault((self._table_conn(project,table_id),source),[]).append(table_id)
+
+        sharded = self._shard_conns(project) is not None
+        indexed = sharded or self._has_filepath_index(project)
+        current_timestamp = datetime.datetime.now().isoformat(" ",timespec='seconds')
+        merged = 0
+        for (conn,source),tables in groups.items():
+            photons = dict()
+            conn.commit()
+            conn.execute("ATTACH DATABASE ? AS merge_src",(source,))
+            try:
+                with closing(conn.cursor()) as cur:
+                    with _immediate(conn):
+                        for table_id in tables:
+                            num_files = self._merge_table(cur,project,table_id,indexed,current_timestamp)
+                            if num_files > 0:
+                                merged += num_files
+                                cur.execute(f"SELECT COALESCE(SUM(photon_ctr),0) FROM cfg_{project}{table_id}")
+                                photons[table_id] = cur.fetchone()[0]
+                        if not sharded:
+                            self._set_map_photons(cur,project,photons)
+            finally:
+                conn.execute("DETACH DATABASE merge_src")
+
+            if sharded and len(photons):
+                # the map table is in the database file: update it in a short transaction of its own
+                self._update_map_photons(project,photons,increment=False)
+
+        print(f'Merged {merged} files from {other_db_path}')
+        return merged
+
+    def _merge_table(self,cur,project:str,table_id:int,indexed:bool,timestamp:str):
+        """Copy the new file records of one file table from the attached merge_src database and recompute the configuration counters (see merge_from)
+
+        Returns the number of file records copied.
+        """
+        table = f"{project}{table_id}"
+        cur.execute(f"SELECT COALESCE(MAX(file_id),0) FROM file_{table}")
+        last_file_id = cur.fetchone()[0]
+
+        # paths registered already: the path index of the database (or shard), or every file table without it
+        if indexed:
+            registered = [f"filepath_{project}"]
+        else:
+            registered = [f"file_{project}{index}" for index in range(self.table_count(project))]
+        if self._shard_conns(project) is not None:
+            # the paths registered in the other shards are not visible from this one: list them in a temporary table
+            cur.execute(f"SELECT file_path FROM merge_src.file_{table} WHERE file_path NOT IN (SELECT file_path FROM filepath_{project})")
+            others = self._registered_paths(cur,project,[row[0] for row in cur.fetchall()],indexed)
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS merge_registered (file_path TEXT PRIMARY KEY) WITHOUT ROWID")
+            cur.execute("DELETE FROM temp.merge_registered")
+            cur.executemany("INSERT INTO temp.merge_registered (file_path) VALUES (?)",[(path,) for path in others])
+            registered.append("temp.merge_registered")
+        # the first record of each path in the source
+        cmd  = f"INSERT INTO file_{table} (config_id,file_path,photon_ctr,duration,Timestamp)"
+        cmd += f" SELECT config_id,file_path,photon_ctr,duration,Timestamp FROM merge_src.file_{table}"
+        cmd += f" WHERE file_id IN (SELECT MIN(file_id) FROM merge_src.file_{table} GROUP BY file_path)"
+        for name in registered:
+            cmd += f" AND file_path NOT IN (SELECT file_path FROM {name})"
+        cmd += " ORDER BY file_id"
+        cur.execute(cmd)
+        num_files = cur.rowcount
+        if num_files < 1:
+            return 0
+        if indexed:
+            cmd = f"INSERT OR IGNORE INTO filepath_{project} (file_path,table_id) SELECT file_path, ? FROM file_{table} WHERE file_id > ?"
+            cur.execute(cmd,(int(table_id),last_file_id))
+
+        cmd  = f"UPDATE cfg_{table} SET file_ctr = s.file_ctr, photon_ctr = s.photon_ctr, Timestamp = ?"
+        cmd += f" FROM (SELECT config_id, COUNT(*) AS file_ctr, SUM(photon_ctr) AS photon_ctr FROM file_{table} GROUP BY config_id) AS s"
+        cmd += f" WHERE cfg_{table}.config_id = s.config_id AND (cfg_{table}.file_ctr != s.file_ctr OR cfg_{table}.photon_ctr != s.photon_ctr)"
+        cur.execute(cmd,(timestamp,))
+        return num_files
+
+    def _set_map_photons(self,cur,project:str,photons:dict):
+        """Set the photon counters of the map table (table_id => number of photons)"""
+        cmd = f"UPDATE map_{project} SET photon_ctr = ? WHERE table_id = ?"
+        cur.executemany(cmd,[(num,table_id) for table_id,num in photons.items()])
@@ -0,0 +1,85 @@
+import os, json, hashlib
+
+# keys of a journal record (besides the checksum)
+JOURNAL_KEYS=['project','config_id','file_path','num_photons','duration','lease_id']
+
+def _checksum(record:dict):
+    """sha256 of the record keys in a canonical JSON form"""
+    payload = json.dumps([record.get(key) for key in JOURNAL_KEYS],separators=(',',':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def append_record(path:str,project:str,config_id:int,file_path:str,num_photons:int,duration:float,lease_id:int=None):
+    """Append a file registration record to a journal file
+
+    Used in place of wcprod_db.register_file when the database cannot be reached. Each record
+    is one JSON line with a sha256 checksum, and the file is fsync-ed before returning so that
+    a record is either complete on disk or detected as corrupt by read_journal. A record is
+    started on a new line if a previous write was torn (no trailing newline).
+    Replay journals with wcprod_db.ingest_journal.
+
+    Parameters
+    ----------
+    path : str
+        The journal file (created if it does not exist)
+
+    project : str
+        The name of a project
+
+    config_id : int
+        The configuration ID of the file
+
+    file_path : str
+        The path to the file (converted to an absolute path)
+
+    num_photons : int
+        The number of photons simulated in the file
+
+    duration : float
+        The time taken to produce the file
+
+    lease_id : int (optional)
+        The lease ID returned by claim_config, released at ingest
+    """
+    record = dict(project=str(project),config_id=int(config_id),file_path=os.path.abspath(file_path),
+        num_photons=int(num_photons),duration=float(duration),
+        lease_id=None if lease_id is None else int(lease_id))
+    record['sha256'] = _checksum(record)
+    with open(path,'a+b') as f:
+        line = json.dumps(record)+'\n'
+        if f.seek(0,os.SEEK_END) > 0:
+            f.seek(-1,os.SEEK_END)
+            if f.read(1) != b'\n':
+                line = '\n'+line
+        f.write(line.encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_journal(path:str):
+    """Read the file registration records of a journal file
+
+    Lines that are not valid JSON or fail the checksum (e.g. a partial write) are reported and skipped.
+
+    Parameters
+    ----------
+    path : str
+        The journal file written by append_record
+
+    Returns
+    -------
+    generator
+        Yields the records (dict of JOURNAL_KEYS), or None for each invalid line
+    """
+    with open(path,'r') as f:
+        for lineno,line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                valid = record.pop('sha256',None) == _checksum(record)
+            except (ValueError,AttributeError):
+                valid = False
+            if not valid:
+                print(f'Invalid journal record (line {lineno+1}): {path}')
+                yield None
+                continue
+            yield {key: record.get(key) for key in JOURNAL_KEYS}
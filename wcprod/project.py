@@ -1,5 +1,6 @@
 import os, yaml
-from .utils import positions, directions, voxels, coordinates, volumes
+import numpy as np
+from .utils import positions, directions, voxels, coordinates_at, volumes_at
 
 class wcprod_project:
         
@@ -25,14 +26,17 @@ class wcprod_project:
         self._gap_angle = float(cfg['gap_angle'])
         self._n_phi_start = int(cfg.get('n_phi_start', 0))
         self._num_photons = int(cfg['num_photons'])        
+        # optional weights of the clusters sharing the production (see wcprod_db.set_partition)
+        self._partition = dict(cfg.get('partition') or {})
         self._positions  = positions(self.zmin,self.zmax,self.rmin,self.rmax,self.gap_space)
         self._directions = directions(self.gap_angle, self.n_phi_start)
         
         if self._n_phi_start == 0:
-            self._configs    = coordinates(self.positions,self.directions)
+            self._voxels     = np.zeros(shape=(0,6),dtype=float)
         else:
             self._voxels, self._positions = voxels(self.zmin,self.zmax,self.rmin,self.rmax,self.gap_space,self.n_phi_start)
-            self._configs = volumes(self.voxels)
+        # configs are generated on demand (see config_slice)
+        self._configs = None
             
     def __str__(self):
         msg=f'''
@@ -45,7 +49,7 @@ class wcprod_project:
         Starting n phi: {self.n_phi_start}
         Sampling points: {self.positions.shape[0]}
         Sampling directions: {self.directions.shape[0]}
-        Sampling configs: {self.configs.shape[0]}
+        Sampling configs: {self.num_configs}
         Photons per config: {self.num_photons} 
         '''
         return msg    
@@ -73,10 +77,59 @@ class wcprod_project:
     @property
     def voxels(self): return self._voxels
     @property
-    def configs(self): return self._configs
+    def partition(self): return self._partition
+    @property
+    def configs(self):
+        if self._configs is None:
+            self._configs = self.config_slice(0,self.num_configs)
+        return self._configs
+    @property
+    def num_configs(self):
+        if self._n_phi_start == 0:
+            return len(self.positions) * len(self.directions)
+        return len(self.voxels)
     @property
     def num_photons(self): return self._num_photons
 
+    def config_slice(self,start,end):
+        """Generate the configurations with config_id in [start,end) from the geometry grids
+
+        Unlike the configs attribute, the full configuration array is not materialized.
+
+        Parameters
+        ----------
+        start : int
+            The first config_id
+
+        end : int
+            One past the last config_id
+
+        Returns
+        -------
+        np.ndarray
+            (end-start)x7 array with the same layout as configs
+        """
+        if self._configs is not None:
+            return self._configs[start:end]
+        return self.config_rows(np.arange(start,end))
+
+    def config_rows(self,config_ids):
+        """Generate the configurations with the given config_id values from the geometry grids
+
+        Parameters
+        ----------
+        config_ids : array-like
+            The config_id values
+
+        Returns
+        -------
+        np.ndarray
+            Nx7 array with the same layout as configs
+        """
+        if self._n_phi_start == 0:
+            return coordinates_at(self.positions,self.directions,config_ids)
+        return volumes_at(self.voxels,config_ids)
+
     def draw_dir(self):
         import plotly.graph_objects as go
         import numpy as np
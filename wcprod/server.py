@@ -0,0 +1,364 @@
+import os, sys, json, time, stat, sqlite3
+import builtins, functools
+import queue, socket, socketserver, threading
+import numpy as np
+from . import db as wcprod_db_module
+from .db import wcprod_db
+
+# wcprod_db methods served to the clients: claims, file registration and read-only status queries
+# (administrative methods such as register_project, drop_project, set_partition, rebalance,
+# merge_from or export_counters are not exposed)
+SERVER_METHODS=['claim_config','claim_configs','release_config','heartbeat',
+    'get_random_config','lock_table','unlock_table',
+    'register_file','register_files','exist_file',
+    'list_projects','exist_project','exist_table','get_project_meta','get_config',
+    'list_positions','list_directions','list_voxels','query_region','locate_voxels',
+    'table_count','table_id','table_ids','get_table_ids','get_partition',
+    'list_files','progress','retry_stats']
+# methods whose writes are grouped into one register_files transaction by the server
+GROUP_COMMIT_METHODS=['register_file','register_files']
+# optional keys of a job configuration file for the DB connection (key => open_db keyword)
+DB_OPTION_KEYS=dict(DBWAL='wal',DBBusyTimeout='busy_timeout',DBSynchronous='synchronous',DBMaxRetries='max_retries')
+
+# sqlite3 exceptions raised again by the client with their own type (e.g. a locked database)
+SQLITE_ERRORS={error.__name__: error for error in [sqlite3.Error,sqlite3.DatabaseError,sqlite3.OperationalError,
+    sqlite3.IntegrityError,sqlite3.ProgrammingError,sqlite3.InterfaceError,sqlite3.InternalError,
+    sqlite3.NotSupportedError,sqlite3.DataError]}
+
+def is_address(name:str):
+    """Check if the given DB name is a wcprod server address (unix:PATH or tcp://HOST:PORT)"""
+    return str(name).startswith('unix:') or str(name).startswith('tcp://')
+
+def parse_address(address:str):
+    """Parse a wcprod server address
+
+    Parameters
+    ----------
+    address : str
+        unix:PATH for a Unix domain socket or tcp://HOST:PORT for a TCP socket
+
+    Returns
+    -------
+    tuple
+        (socket family, address accepted by socket.connect/bind)
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    if address.startswith('tcp://'):
+        host, port = address[len('tcp://'):].rsplit(':',1)
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"Invalid server address '{address}' (expected unix:PATH or tcp://HOST:PORT)")
+
+def open_db(name:str,**kwargs):
+    """Open the production database either directly or through a wcprod server
+
+    Parameters
+    ----------
+    name : str
+        A server address (see parse_address) or the path to the sqlite database file
+
+    kwargs : dict
+        Connection options passed to wcprod_db (ignored for a server address)
+
+    Returns
+    -------
+    wcprod_db or wcprod_client
+        The API instance
+    """
+    if is_address(name):
+        return wcprod_client(name)
+    return wcprod_db(name,**kwargs)
+
+def _is_socket(path:str):
+    """Check if the path is an existing Unix socket file"""
+    return os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode)
+
+def _encode(obj):
+    """JSON encoder for numpy types and iterables returned by wcprod_db"""
+    if isinstance(obj,np.ndarray):
+        return obj.tolist()
+    if isinstance(obj,np.generic):
+        return obj.item()
+    if hasattr(obj,'__iter__'):
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class _request:
+    """A request waiting to be executed by the DB thread"""
+    def __init__(self,method:str,args:list,kwargs:dict):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _handler(socketserver.StreamRequestHandler):
+    """Reads newline-delimited JSON requests from a client and writes one JSON response per request"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                msg = json.loads(line)
+                req = _request(msg['method'],msg.get('args',[]),msg.get('kwargs',{}))
+            except (ValueError,KeyError) as e:
+                self._reply(dict(error='ValueError',message=f'Invalid request: {e}'))
+                continue
+            self.server.wcprod.submit(req)
+            req.done.wait()
+            if req.error is None:
+                self._reply(dict(result=req.result))
+            else:
+                self._reply(dict(error=type(req.error).__name__,message=str(req.error)))
+
+    def _reply(self,msg:dict):
+        self.wfile.write((json.dumps(msg,default=_encode)+'\n').encode())
+        self.wfile.flush()
+
+
+class _tcp_server(socketserver.ThreadingMixIn,socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socketserver,'UnixStreamServer'):
+    class _unix_server(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class wcprod_server:
+
+    def __init__(self,dbname:str,address:str,batch_window:float=0.05,max_batch:int=1000,**kwargs):
+        """Constructor
+
+        Constructs a broker that owns the wcprod_db connection and serves requests from
+        batch jobs over a Unix or TCP socket. Requests are executed one at a time by a single
+        DB thread. Consecutive register_file(s) requests are grouped into one register_files
+        transaction (group commit). Only the methods in SERVER_METHODS are served.
+        There is no authentication: bind a TCP server to localhost (tcp://127.0.0.1:PORT),
+        or use a Unix socket, unless the network is trusted.
+
+        Parameters
+        ----------
+        dbname : str
+            Name of the database file to serve
+
+        address : str
+            unix:PATH or tcp://HOST:PORT to listen on (port 0 picks a free port)
+
+        batch_window : float (optional)
+            Seconds to wait for more requests to join a group commit
+
+        max_batch : int (optional)
+            The maximum number of requests executed in one batch
+
+        kwargs : dict
+            Connection options passed to wcprod_db
+        """
+        self._dbname = dbname
+        self._db_kwargs = kwargs
+        self._batch_window = float(batch_window)
+        self._max_batch = int(max_batch)
+        self._queue = queue.Queue()
+        self._running = False
+        self._ready = threading.Event()
+        self._init_error = None
+        self._worker = None
+
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                # a socket left by a previous server (never remove another kind of file)
+                if not _is_socket(addr):
+                    raise ValueError(f"Cannot listen on '{addr}': the file exists and is not a socket")
+                os.remove(addr)
+            self._server = _unix_server(addr,_handler)
+            self._address = address
+        else:
+            self._server = _tcp_server(addr,_handler)
+            self._address = 'tcp://%s:%d' % self._server.server_address[:2]
+        self._server.wcprod = self
+
+    @property
+    def address(self):
+        """The address clients should connect to"""
+        return self._address
+
+    def submit(self,req:_request):
+        """Queue a request for the DB thread"""
+        self._queue.put(req)
+
+    def start(self):
+        """Start the DB thread and serve clients in a background thread"""
+        self._start_worker()
+        threading.Thread(target=self._server.serve_forever,daemon=True).start()
+
+    def serve_forever(self):
+        """Start the DB thread and serve clients until interrupted"""
+        self._start_worker()
+        print('Serving',self._dbname,'at',self.address)
+        sys.stdout.flush()
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Stop serving and close the DB thread"""
+        if self._running:
+            self._server.shutdown()
+        self._server.server_close()
+        family, addr = parse_address(self._address)
+        if family == socket.AF_UNIX and _is_socket(addr):
+            os.remove(addr)
+        self._running = False
+        self._queue.put(None)
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def _start_worker(self):
+        self._running = True
+        self._worker = threading.Thread(target=self._run,daemon=True)
+        self._worker.start()
+        self._ready.wait()
+        if self._init_error is not None:
+            raise self._init_error
+
+    def _run(self):
+        # the sqlite connection must be created in the thread that uses it
+        try:
+            db = wcprod_db(self._dbname,**self._db_kwargs)
+        except Exception as e:
+            self._init_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        while True:
+            req = self._queue.get()
+            if req is None:
+                break
+            batch = [req]
+            deadline = time.time() + self._batch_window
+            while req.method in GROUP_COMMIT_METHODS and len(batch) < self._max_batch:
+                try:
+                    req = self._queue.get(timeout=max(0.,deadline-time.time()))
+                except queue.Empty:
+                    break
+                if req is None:
+                    self._queue.put(None)
+                    break
+                batch.append(req)
+                if not req.method in GROUP_COMMIT_METHODS:
+                    break
+            self._execute(db,batch)
+        db._conn.close()
+
+    def _execute(self,db:wcprod_db,batch:list):
+        """Execute a batch of requests, grouping consecutive registrations per project"""
+        pending = []
+        for req in batch:
+            if req.method in GROUP_COMMIT_METHODS:
+                pending.append(req)
+                continue
+            self._register(db,pending)
+            pending = []
+            try:
+                if not req.method in SERVER_METHODS:
+                    raise AttributeError(f"wcprod_db method '{req.method}' is not served")
+                req.result = getattr(db,req.method)(*req.args,**req.kwargs)
+                if hasattr(req.result,'__next__'):
+                    req.result = list(req.result)
+            except Exception as e:
+                req.error = e
+            req.done.set()
+        self._register(db,pending)
+
+    def _register(self,db:wcprod_db,reqs:list):
+        """Register the files of many register_file(s) requests with one register_files call per project"""
+        projects = dict()
+        for req in reqs:
+            try:
+                if req.method == 'register_file':
+                    args = dict(zip(['project','config_id','file_path','num_photons','duration'],req.args))
+                    args.update(req.kwargs)
+                    records = [(args['config_id'],args['file_path'],args['num_photons'],args['duration'])]
+                else:
+                    args = dict(zip(['project','records'],req.args))
+                    args.update(req.kwargs)
+                    records = [tuple(r) for r in args['records']]
+                projects.setdefault(args['project'],[]).append((req,records))
+            except Exception as e:
+                req.error = e
+                req.done.set()
+
+        for project, entries in projects.items():
+            records = [r for req,rs in entries for r in rs]
+            try:
+                result = db.register_files(project,records)
+            except Exception as e:
+                for req,rs in entries:
+                    req.error = e
+                    req.done.set()
+                continue
+            start = 0
+            for req,rs in entries:
+                req.result = result[start:start+len(rs)]
+                if req.method == 'register_file':
+                    req.result = req.result[0]
+                start += len(rs)
+                req.done.set()
+
+
+class wcprod_client:
+
+    def __init__(self,address:str,timeout:float=None):
+        """Constructor
+
+        Constructs a client of wcprod_server. The client provides the wcprod_db methods listed
+        in SERVER_METHODS: each call is sent to the server and executed there.
+
+        Parameters
+        ----------
+        address : str
+            unix:PATH or tcp://HOST:PORT of the server
+
+        timeout : float (optional)
+            Socket timeout in seconds
+        """
+        family, addr = parse_address(address)
+        self._address = address
+        self._sock = socket.socket(family,socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(addr)
+        self._rfile = self._sock.makefile('rb')
+
+    def close(self):
+        """Close the connection to the server"""
+        self._rfile.close()
+        self._sock.close()
+
+    def __getattr__(self,name:str):
+        if not name in SERVER_METHODS:
+            raise AttributeError(f"'wcprod_client' object has no attribute '{name}'")
+        return functools.wraps(getattr(wcprod_db,name))(lambda *args, **kwargs: self._call(name,args,kwargs))
+
+    def _call(self,method:str,args,kwargs):
+        msg = json.dumps(dict(method=method,args=list(args),kwargs=kwargs),default=_encode)
+        self._sock.sendall((msg+'\n').encode())
+        line = self._rfile.readline()
+        if not line:
+            raise ConnectionError(f'Connection to the wcprod server {self._address} closed')
+        res = json.loads(line)
+        if 'error' in res:
+            error = SQLITE_ERRORS.get(res['error'],getattr(wcprod_db_module,res['error'],getattr(builtins,res['error'],None)))
+            if not (isinstance(error,type) and issubclass(error,Exception)):
+                error = RuntimeError
+            raise error(res['message'])
+        return res['result']
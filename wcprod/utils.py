@@ -33,6 +33,25 @@ def get_config(name):
     print('No data found for config name:',name)
     raise NotImplementedError
 
+def load_counters(path, mmap_mode='r'):
+    """Load the production counters written by wcprod_db.export_counters
+
+    Parameters
+    ----------
+    path : str
+        The directory given to export_counters
+
+    mmap_mode : str (optional)
+        Memory-map mode passed to numpy.load (None to read the arrays into memory)
+
+    Returns
+    -------
+    dict
+        photon_ctr, file_ctr and timestamp arrays indexed by config_id
+    """
+    from .db import COUNTER_FILES
+    return {key: np.load(os.path.join(path, fname), mmap_mode=mmap_mode) for key, fname in COUNTER_FILES.items()}
+
 def positions(z_min,z_max,r_min,r_max,gap_size,nphi_initial=0,verbose=False):
     if r_min < 0 or r_max <= r_min:
         print('r_min must be positive and r_max must be larger than r_min')
@@ -143,6 +162,75 @@ def voxels(z_min,z_max,r_min,r_max,gap_size,nphi_initial,verbose=False):
     return vox, pts
 
 
+def voxel_edges(voxels):
+    """Recover the ring and z layer edges of the voxels generated by voxels()
+
+    Parameters
+    ----------
+    voxels : ndarray
+        Shape (N,6) voxel bounds (r0, r1, phi0, phi1, z0, z1)
+
+    Returns
+    -------
+    tuple
+        r_edges (nrings+1), the number of phi segments per ring (nrings), z_edges (nlayers+1)
+    """
+    # the voxels of a z layer are ordered by ring then phi, and the layers by z
+    batch = int(np.count_nonzero(voxels[:,4] == voxels[0,4]))
+    plane = voxels[:batch]
+    r_edges, ring_n = np.unique(plane[:,0], return_counts=True)
+    r_edges = np.append(r_edges, plane[-1,1])
+    z_edges = np.append(voxels[::batch,4], voxels[-1,5])
+    return r_edges, ring_n, z_edges
+
+def _locate_edges(edges, vals):
+    # bin [edges[i],edges[i+1]) of each value (the last bin includes the upper edge), -1 if outside
+    idx = np.searchsorted(edges, vals, side='right') - 1
+    upper = vals == edges[-1]
+    idx[upper] = np.searchsorted(edges, vals[upper], side='left') - 1
+    idx[~((vals >= edges[0]) & (vals <= edges[-1]))] = -1
+    return idx
+
+def locate_voxels(voxels, xyz):
+    """Find the voxel that contains each point
+
+    Parameters
+    ----------
+    voxels : ndarray
+        Shape (N,6) voxel bounds generated by voxels()
+
+    xyz : ndarray
+        Shape (M,3) points
+
+    Returns
+    -------
+    ndarray
+        Shape (M,) voxel index (-1 for a point outside the voxels)
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1,3)
+    r_edges, ring_n, z_edges = voxel_edges(voxels)
+    ring_offset = np.concatenate([[0], np.cumsum(ring_n)[:-1]])
+
+    r   = np.hypot(xyz[:,0], xyz[:,1])
+    phi = np.mod(np.degrees(np.arctan2(xyz[:,1], xyz[:,0])), 360.)
+    ring  = _locate_edges(r_edges, r)
+    layer = _locate_edges(z_edges, xyz[:,2])
+    valid = (ring >= 0) & (layer >= 0)
+    ring  = np.where(valid, ring, 0)
+
+    # n equal phi segments per ring
+    n = ring_n[ring]
+    seg = np.minimum((phi * n / 360.).astype(np.int64), n-1)
+    ids = layer * ring_n.sum() + ring_offset[ring] + seg
+    return np.where(valid, ids, -1)
+
+def direction_vectors(dirs):
+    # unit vectors of (theta, phi) directions in degrees
+    dirs = np.radians(np.asarray(dirs, dtype=float).reshape(-1,2))
+    return np.column_stack([np.sin(dirs[:,0])*np.cos(dirs[:,1]),
+                            np.sin(dirs[:,0])*np.sin(dirs[:,1]),
+                            np.cos(dirs[:,0])])
+
 def directions(gap_angle, nphi_initial=0):
     if nphi_initial > 0:
         return np.array([[0,0]])
@@ -158,26 +246,37 @@ def directions(gap_angle, nphi_initial=0):
     return np.column_stack([grid[0].flatten(),grid[1].flatten()])
 
 
-def coordinates(points, dirs):
-    idx_pts=np.arange(points.shape[0])
-    idx_dir=np.arange(dirs.shape[0])
-    
-    mesh = np.meshgrid(idx_pts,idx_dir)
-    mesh = np.column_stack([mesh[0].flatten(),mesh[1].flatten()])
-    
-    coords = np.zeros(shape=(len(idx_pts) * len(idx_dir),7),dtype=float)
-    coords[:,0:3] = points[mesh[:,0]]
-    coords[:,3:5] = dirs[mesh[:,1]]
-    coords[:,5]   = mesh[:,0]
-    coords[:,6]   = mesh[:,1]
+def coordinates(points, dirs, start=0, end=None):
+    if end is None:
+        end = len(points) * len(dirs)
+    return coordinates_at(points, dirs, np.arange(start, end))
+
+def coordinates_at(points, dirs, idx):
+    # config c is the point c % len(points) in the direction c // len(points),
+    # so any config can be generated without the full mesh
+    idx = np.asarray(idx, dtype=np.int64)
+    idx_pts = idx % len(points)
+    idx_dir = idx // len(points)
+
+    coords = np.zeros(shape=(len(idx),7),dtype=float)
+    coords[:,0:3] = points[idx_pts]
+    coords[:,3:5] = dirs[idx_dir]
+    coords[:,5]   = idx_pts
+    coords[:,6]   = idx_dir
     return coords
 
-def volumes(voxels):
+def volumes(voxels, start=0, end=None):
+
+    if end is None:
+        end = len(voxels)
+    return volumes_at(voxels, np.arange(start, end))
+
+def volumes_at(voxels, idx):
 
-    idx = np.arange(len(voxels))
+    idx = np.asarray(idx, dtype=np.int64)
 
-    vols = np.zeros(shape=(len(voxels),7),dtype=float)
-    vols[:,0:6] = voxels
+    vols = np.zeros(shape=(len(idx),7),dtype=float)
+    vols[:,0:6] = voxels[idx]
     vols[:,6]   = idx
 
     return vols